@@ -3,3 +3,12 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # 登出、修改密碼、刪除帳號時清除快取 Token 驗證的項目
+        from . import signals  # noqa: F401
+
+        # 每個資料庫連線都掛上計時 wrapper，讓請求的 Server-Timing 包含 SQL 耗時與查詢數
+        from django.db.backends.signals import connection_created
+        from .metrics import install_db_wrapper
+        connection_created.connect(install_db_wrapper, dispatch_uid='api.metrics.install_db_wrapper')
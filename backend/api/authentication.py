@@ -0,0 +1,128 @@
+"""
+快取 Token 驗證 (Cached Token Authentication)。
+
+DRF 的 TokenAuthentication 每個請求都會執行一次 token JOIN user 的查詢，而同一個使用者的 token 在短時間內
+會被反覆使用。這裡在它前面加上兩層快取，把 token 對應到 User 物件：
+
+1. process 內的 LRU (AUTH_TOKEN_CACHE_MAX_ENTRIES 筆)，不需要任何外部服務。
+2. 選用的 Django 快取 (AUTH_TOKEN_CACHE_ALIAS，例如本機的 Redis / Memcached)，讓多個 worker 共用。
+   快取鍵是 token 的 SHA-256，不會把 token 原文存進快取。
+
+兩層都只保留 AUTH_TOKEN_CACHE_TTL 秒 (設為 0 即停用)。以下情況會立即清除 (見 api/signals.py)：
+- 透過 dj_rest_auth 登出 (刪除 Token)、刪除帳號 (連帶刪除 Token)。
+- 使用者資料有變動 (修改密碼、停用帳號等)；只更新 last_login 時不清除。
+清除只會作用在目前的 process 與共用快取；其他 process 的 LRU 最多再沿用 TTL 秒，因此 TTL 應保持很短。
+"""
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+CACHE_KEY_PREFIX = 'auth-token:'
+
+
+def token_digest(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class TokenUserCache:
+    """token -> User 的兩層快取 (process 內 LRU + 選用的 Django 快取)。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # token 雜湊 -> (到期時間, User)
+
+    # --- 設定 ---
+    @property
+    def ttl(self):
+        return getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 30)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'AUTH_TOKEN_CACHE_MAX_ENTRIES', 1000)
+
+    @property
+    def shared(self):
+        alias = getattr(settings, 'AUTH_TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    # --- 基本操作 ---
+    def get(self, key):
+        """回傳快取中的 User (副本，避免不同請求共用同一個物件)，沒有或已過期時回傳 None。"""
+        if self.ttl <= 0:
+            return None
+        digest = token_digest(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                expires_at, user = entry
+                if expires_at >= time.monotonic():
+                    self._entries.move_to_end(digest)
+                    return copy.copy(user)
+                del self._entries[digest]
+
+        shared = self.shared
+        user = shared.get(CACHE_KEY_PREFIX + digest) if shared else None
+        if user is None:
+            return None
+        self._remember(digest, user)
+        return copy.copy(user)
+
+    def put(self, key, user):
+        if self.ttl <= 0:
+            return
+        digest = token_digest(key)
+        self._remember(digest, copy.copy(user))
+        shared = self.shared
+        if shared:
+            shared.set(CACHE_KEY_PREFIX + digest, user, self.ttl)
+
+    def _remember(self, digest, user):
+        with self._lock:
+            self._entries[digest] = (time.monotonic() + self.ttl, user)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # --- 清除 ---
+    def invalidate_token(self, key):
+        digest = token_digest(key)
+        with self._lock:
+            self._entries.pop(digest, None)
+        shared = self.shared
+        if shared:
+            shared.delete(CACHE_KEY_PREFIX + digest)
+
+    def invalidate_user(self, user_id, token_keys=()):
+        """清除某個使用者的所有項目；共用快取需要知道 token 原文才能組出快取鍵。"""
+        with self._lock:
+            for digest in [d for d, (_, user) in self._entries.items() if user.pk == user_id]:
+                del self._entries[digest]
+        shared = self.shared
+        if shared and token_keys:
+            shared.delete_many([CACHE_KEY_PREFIX + token_digest(key) for key in token_keys])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_user_cache = TokenUserCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """與 TokenAuthentication 相同的驗證規則 (含停用帳號的檢查)，但命中快取時不查詢資料庫。"""
+
+    def authenticate_credentials(self, key):
+        user = token_user_cache.get(key)
+        if user is not None:
+            # request.auth 與未命中時一樣是 Token 物件 (未查詢資料庫，只帶 key 與 user)
+            return user, self.get_model()(key=key, user=user)
+        user, token = super().authenticate_credentials(key)
+        token_user_cache.put(key, user)
+        return user, token
@@ -0,0 +1,111 @@
+"""
+批次收藏 / 批次刪除 (Bulk Favorites)。
+
+匯入或清除大量收藏時，前端原本要一筆一筆發送請求。這裡讓一次請求處理數百筆：
+
+1. 整批在同一個交易中完成，失敗時不會只寫入一半 (serialized_write，見 api/db.py)。
+2. 新增使用 bulk_create(ignore_conflicts=True)，搭配 (owner, url_hash) 唯一條件，
+   重複的網址 (不論是已收藏過，或同時有其他請求寫入) 都會被資料庫直接忽略，重送同一批也不會產生重複資料。
+3. 回傳逐筆結果，讓前端知道每個項目是新增、已存在、格式錯誤或找不到。
+4. 有資料變動時在同一個交易中遞增收藏的版本號 (DataVersion)，讓列表的 ETag 跟著改變。
+"""
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+
+from .db import serialized_write
+from .models import DataVersion, DogImage, hash_url
+
+URL_MAX_LENGTH = DogImage._meta.get_field('url').max_length
+validate_url = URLValidator()
+
+
+def check_url(url):
+    """回傳錯誤訊息，網址可用時回傳 None。"""
+    if len(url) > URL_MAX_LENGTH:
+        return f'網址長度不可超過 {URL_MAX_LENGTH} 字元。'
+    try:
+        validate_url(url)
+    except ValidationError:
+        return '請輸入有效的網址。'
+    return None
+
+
+def bulk_add(owner, urls):
+    """
+    批次收藏。回傳 (新增筆數, 逐筆結果)，結果順序與輸入相同，status 為：
+    created / exists (先前已收藏) / duplicate (同一批中重複) / invalid (網址格式錯誤)。
+    """
+    results = []
+    pending = {}  # url_hash -> 該網址在 results 中的位置
+    for url in urls:
+        error = check_url(url)
+        if error:
+            results.append({'url': url, 'status': 'invalid', 'error': error})
+            continue
+        url_hash = hash_url(url)
+        if url_hash in pending:
+            results.append({'url': url, 'status': 'duplicate'})
+            continue
+        pending[url_hash] = len(results)
+        results.append({'url': url, 'status': 'created'})
+
+    existing, ids = write_new(owner, pending, results)
+
+    created = 0
+    for url_hash, index in pending.items():
+        results[index]['id'] = ids.get(url_hash)
+        if url_hash in existing:
+            results[index]['status'] = 'exists'
+        else:
+            created += 1
+    return created, results
+
+
+@serialized_write
+def write_new(owner, pending, results):
+    """在同一個交易中寫入尚未收藏的網址，回傳 (已存在的 url_hash, url_hash -> id)。"""
+    existing = set(
+        DogImage.objects.filter(owner=owner, url_hash__in=pending).values_list('url_hash', flat=True)
+    )
+    DogImage.objects.bulk_create(
+        [
+            DogImage(owner=owner, url=results[index]['url'], url_hash=url_hash)
+            for url_hash, index in pending.items() if url_hash not in existing
+        ],
+        ignore_conflicts=True,
+    )
+    # ignore_conflicts 時資料庫不會回傳新資料的 id，這裡再以唯一鍵查回來
+    ids = dict(
+        DogImage.objects.filter(owner=owner, url_hash__in=pending).values_list('url_hash', 'id')
+    )
+    if len(pending) > len(existing):
+        DataVersion.objects.bump(owner.pk, DataVersion.FAVORITES)
+    return existing, ids
+
+
+@serialized_write
+def delete_owned(owner, ids):
+    """在同一個交易中刪除屬於 owner 的收藏，回傳實際刪除的 id。"""
+    found = set(DogImage.objects.filter(owner=owner, id__in=ids).values_list('id', flat=True))
+    if found:
+        DogImage.objects.filter(owner=owner, id__in=found).delete()
+        DataVersion.objects.bump(owner.pk, DataVersion.FAVORITES)
+    return found
+
+
+def bulk_remove(owner, ids):
+    """
+    批次刪除。只會刪除屬於 owner 的收藏；回傳 (刪除筆數, 逐筆結果)，status 為 deleted / not_found / duplicate。
+    """
+    found = delete_owned(owner, ids)
+
+    results = []
+    reported = set()
+    for pk in ids:
+        if pk in reported:
+            status = 'duplicate'
+        else:
+            status = 'deleted' if pk in found else 'not_found'
+        reported.add(pk)
+        results.append({'id': pk, 'status': status})
+    return len(found), results
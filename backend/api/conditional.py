@@ -0,0 +1,66 @@
+"""
+條件式 GET (ETag / Last-Modified / 304 Not Modified)。
+
+前端會頻繁輪詢收藏列表、對話列表與對話紀錄，但這些資料在兩次輪詢之間幾乎不會改變。
+每個使用者的每一類資料都有一個版本號 (DataVersion)，寫入時在同一個交易中遞增：
+
+1. 讀取時先取出版本號 (一個以唯一索引完成的查詢)，據此產生 ETag 與 Last-Modified。
+2. 用戶端帶上 If-None-Match (或 If-Modified-Since) 且版本沒變時直接回傳 304，
+   不查詢也不序列化資料本身。
+3. ETag 同時包含使用者、版本號與完整的查詢參數，不同頁、不同游標各自有自己的 ETag。
+4. 先讀版本號、再讀資料：兩者之間若有寫入，回應會是「舊版本號 + 新資料」，
+   用戶端下次帶著舊 ETag 來只會多拿一次 200，不會把舊資料當成最新的。
+
+回應一律加上 Cache-Control: private, no-cache 與 Vary: Authorization, Cookie，
+共用快取不會保存，瀏覽器每次使用前都必須重新驗證。
+Last-Modified 只精確到秒，同一秒內的多次寫入無法區分，用戶端應優先使用 ETag。
+"""
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from .models import DataVersion
+
+
+@dataclass
+class Validators:
+    etag: str
+    last_modified: datetime = None
+
+    @property
+    def timestamp(self):
+        return int(self.last_modified.timestamp()) if self.last_modified else None
+
+    def not_modified(self, request):
+        """用戶端的副本仍是最新時回傳 304 回應，否則回傳 None。"""
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.timestamp)
+        return self.apply(response) if response is not None else None
+
+    def apply(self, response):
+        """在回應加上 ETag / Last-Modified 與快取相關標頭 (只有成功的回應才帶驗證標頭)。"""
+        if response.status_code in (200, 304):
+            response['ETag'] = self.etag
+            if self.timestamp is not None:
+                response['Last-Modified'] = http_date(self.timestamp)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Authorization', 'Cookie'))
+        return response
+
+
+def make_etag(request, scope, version):
+    raw = f'{scope}:{request.user.pk}:{version}:{request.get_full_path()}'
+    return '"%s"' % hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+
+def validators(request, scope):
+    version, updated_at = DataVersion.objects.current(request.user.pk, scope)
+    return Validators(make_etag(request, scope, version), updated_at)
+
+
+async def avalidators(request, scope):
+    """validators 的非同步版本 (給 async view 使用)。"""
+    version, updated_at = await DataVersion.objects.acurrent(request.user.pk, scope)
+    return Validators(make_etag(request, scope, version), updated_at)
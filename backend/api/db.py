@@ -0,0 +1,137 @@
+"""
+SQLite 高併發模式的寫入序列化 (Serialized Writes / Group Commit)。
+
+SQLite 同一時間只允許一個寫入交易。多個請求同時寫入時 (發問、收藏)，
+每個交易都要搶同一把寫入鎖，搶不到的只能等待 busy_timeout 後重試，負載高時就會出現 "database is locked"。
+
+啟用 DB_WRITE_BATCHING 後 (搭配 settings 中的 SQLITE_CONCURRENT 模式)，寫入改由單一的 writer 執行緒執行：
+
+1. 各請求把寫入函式交給 WriteQueue，等待執行結果 (回傳值或例外會原樣交回呼叫端)。
+2. writer 執行緒一次取出最多 DB_WRITE_BATCH_MAX 筆，最多再等 DB_WRITE_BATCH_WAIT 秒湊齊，
+   在同一個短交易中依序執行並一次 commit，把多次 fsync 合併成一次。
+3. 每筆寫入各自包在 SAVEPOINT 中，一筆失敗只會回滾它自己，不影響同一批的其他寫入。
+
+未啟用時 (預設)，或呼叫端已經在交易中 (例如測試、巢狀呼叫) 時，直接在目前的執行緒以 transaction.atomic 執行，
+行為與原本完全相同。
+"""
+import functools
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    """一筆等待 writer 執行緒執行的寫入。"""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class WriteQueue:
+    """把同一個資料庫的寫入交給單一 writer 執行緒，並把同時到達的寫入合併成一個交易。"""
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, enabled=None):
+        self.using = using
+        self._enabled = enabled
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self.batches = 0
+        self.jobs = 0
+
+    # --- 設定 ---
+    @property
+    def enabled(self):
+        if self._enabled is not None:
+            return self._enabled
+        return getattr(settings, 'DB_WRITE_BATCHING', False)
+
+    @property
+    def batch_max(self):
+        return getattr(settings, 'DB_WRITE_BATCH_MAX', 50)
+
+    @property
+    def batch_wait(self):
+        return getattr(settings, 'DB_WRITE_BATCH_WAIT', 0.002)
+
+    # --- 提交寫入 ---
+    def run(self, fn):
+        """在交易中執行 fn 並回傳結果；啟用時交給 writer 執行緒與其他寫入一起 commit。"""
+        if (
+            not self.enabled
+            or connections[self.using].in_atomic_block
+            or threading.current_thread() is self._thread
+        ):
+            with transaction.atomic(using=self.using):
+                return fn()
+
+        job = _Job(fn)
+        self._ensure_writer()
+        self._queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.value
+
+    def _ensure_writer(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name=f'db-writer-{self.using}', daemon=True)
+                self._thread.start()
+
+    # --- writer 執行緒 ---
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        try:
+            with transaction.atomic(using=self.using):
+                for job in batch:
+                    try:
+                        with transaction.atomic(using=self.using):
+                            job.value = job.fn()
+                    except Exception as e:
+                        job.error = e
+        except Exception as e:
+            # commit 失敗時整批都沒有寫入
+            logger.warning(f"Write batch of {len(batch)} failed to commit: {e}")
+            for job in batch:
+                job.error = job.error or e
+        finally:
+            self.batches += 1
+            self.jobs += len(batch)
+            connections[self.using].close_if_unusable_or_obsolete()
+            for job in batch:
+                job.done.set()
+
+
+write_queue = WriteQueue()
+
+
+def serialized_write(fn):
+    """
+    裝飾器：以 write_queue 執行被裝飾的函式 (取代 transaction.atomic)。
+    未啟用 DB_WRITE_BATCHING 時等同於 transaction.atomic。
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return write_queue.run(functools.partial(fn, *args, **kwargs))
+    return wrapper
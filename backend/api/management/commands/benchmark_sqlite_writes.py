@@ -0,0 +1,171 @@
+"""
+比較 SQLite 各種設定在大量同時寫入時的吞吐量：
+
+    python manage.py benchmark_sqlite_writes --writers 32 --writes 50
+
+每個 profile 都使用一個全新的暫存資料庫檔案，writers 個執行緒同時執行「一輪對話」形狀的寫入
+(新增兩則訊息 + 更新 Session 計數，同 chat.services.save_turn)：
+
+- default：Django 預設設定 (rollback journal、DEFERRED 交易、每個請求重新連線)。
+- wal：settings.SQLITE_CONCURRENT_OPTIONS (WAL、busy_timeout、IMMEDIATE 交易) + 持久連線。
+- wal-batched：同 wal，並以 api.db.WriteQueue 由單一 writer 執行緒合併 commit。
+
+輸出每個 profile 成功 / 失敗 ("database is locked") 的次數、每秒寫入數與延遲百分位數；--json 輸出機器可讀的結果。
+"""
+import json
+import statistics
+import tempfile
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+from api.db import WriteQueue
+
+PROFILES = ('default', 'wal', 'wal-batched')
+
+
+def add_database(alias, path, profile):
+    """以暫存檔案註冊一個資料庫連線設定 (不會寫入 settings.DATABASES)。"""
+    concurrent = profile != 'default'
+    config = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': str(path),
+        'OPTIONS': dict(settings.SQLITE_CONCURRENT_OPTIONS) if concurrent else {},
+        'CONN_MAX_AGE': None if concurrent else 0,
+    }
+    connections.settings[alias] = connections.configure_settings({DEFAULT_DB_ALIAS: config, alias: config})[alias]
+
+
+def create_schema(alias, sessions):
+    with connections[alias].cursor() as cursor:
+        cursor.execute(
+            'CREATE TABLE bench_session (id INTEGER PRIMARY KEY, message_count INTEGER NOT NULL DEFAULT 0, '
+            'last_message_at TEXT)'
+        )
+        cursor.execute(
+            'CREATE TABLE bench_message (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id INTEGER NOT NULL, '
+            'role TEXT NOT NULL, content TEXT NOT NULL, created_at TEXT NOT NULL)'
+        )
+        cursor.executemany('INSERT INTO bench_session (id) VALUES (%s)', [(i,) for i in range(sessions)])
+    connections[alias].close()
+
+
+def write_turn(alias, session_id):
+    now = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with connections[alias].cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO bench_message (session_id, role, content, created_at) VALUES (%s, %s, %s, %s)',
+            [(session_id, 'user', '這是什麼品種？', now), (session_id, 'model', '這是一隻哈士奇！' * 20, now)],
+        )
+        cursor.execute(
+            'UPDATE bench_session SET message_count = message_count + 2, last_message_at = %s WHERE id = %s',
+            [now, session_id],
+        )
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_profile(profile, writers, writes):
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+        alias = f'benchmark_{profile}'
+        add_database(alias, Path(tmp) / 'bench.sqlite3', profile)
+        create_schema(alias, writers)
+        write_queue = WriteQueue(using=alias, enabled=True) if profile == 'wal-batched' else None
+
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(writers + 1)
+
+        def writer(session_id):
+            barrier.wait()
+            for _ in range(writes):
+                started = time.perf_counter()
+                try:
+                    if write_queue is not None:
+                        write_queue.run(partial(write_turn, alias, session_id))
+                    else:
+                        with transaction.atomic(using=alias):
+                            write_turn(alias, session_id)
+                except OperationalError as e:
+                    with lock:
+                        errors.append(str(e))
+                else:
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+                finally:
+                    if profile == 'default':
+                        # 預設設定不保留連線：模擬每個請求結束時關閉連線
+                        connections[alias].close()
+            connections[alias].close()
+
+        threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        with connections[alias].cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM bench_message')
+            rows = cursor.fetchone()[0]
+        connections[alias].close()
+
+    result = {
+        'profile': profile,
+        'writers': writers,
+        'ok': len(latencies),
+        'errors': len(errors),
+        'rows': rows,
+        'seconds': round(elapsed, 3),
+        'writes_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 2) if latencies else None,
+    }
+    if write_queue is not None and write_queue.batches:
+        result['mean_batch_size'] = round(write_queue.jobs / write_queue.batches, 1)
+    return result
+
+
+class Command(BaseCommand):
+    help = '比較 SQLite 預設設定與高併發模式 (WAL + 寫入序列化) 在大量同時寫入時的吞吐量'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=32, help='同時寫入的執行緒數 (預設 32)')
+        parser.add_argument('--writes', type=int, default=50, help='每個執行緒的寫入次數 (預設 50)')
+        parser.add_argument(
+            '--profiles', default=','.join(PROFILES), help=f'要比較的設定，以逗號分隔 (可用：{", ".join(PROFILES)})'
+        )
+        parser.add_argument('--json', action='store_true', help='以 JSON 輸出結果')
+
+    def handle(self, *args, **options):
+        profiles = [p.strip() for p in options['profiles'].split(',') if p.strip()]
+        unknown = set(profiles) - set(PROFILES)
+        if unknown:
+            self.stderr.write(self.style.ERROR(f'未知的 profile：{", ".join(sorted(unknown))}'))
+            return
+
+        results = [run_profile(profile, max(1, options['writers']), max(1, options['writes'])) for profile in profiles]
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, ensure_ascii=False, indent=2))
+            return
+        self.stdout.write(f"{'profile':<12} {'ok':>6} {'errors':>6} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+        for r in results:
+            self.stdout.write(
+                f"{r['profile']:<12} {r['ok']:>6} {r['errors']:>6} {r['writes_per_second'] or 0:>9} "
+                f"{r['p50_ms'] or '-':>8} {r['p99_ms'] or '-':>8}"
+            )
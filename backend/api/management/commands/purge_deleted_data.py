@@ -0,0 +1,30 @@
+"""
+執行等待中的背景清除 (刪除帳號 / 刪除全部對話，見 api/purge.py)：
+
+    python manage.py purge_deleted_data
+
+web process 的背景執行緒通常會自行完成清除；這個指令用於停用背景執行緒 (DATA_PURGE_IN_BACKGROUND = False)
+的部署，或在 process 中止後補做。--retry-failed 會把失敗的清除重新排入；可重複執行，結果相同。
+"""
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api import purge
+from api.models import DataPurge
+
+
+class Command(BaseCommand):
+    help = '分批刪除已標記刪除的帳號與對話資料'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='每批刪除的列數 (預設 DATA_PURGE_BATCH_SIZE)')
+        parser.add_argument('--retry-failed', action='store_true', help='重新執行先前失敗的清除')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            retried = DataPurge.objects.filter(status='failed').update(status='pending', updated_at=timezone.now())
+            self.stdout.write(f'重新排入 {retried} 筆失敗的清除')
+
+        count = purge.run_pending(options['batch_size'])
+        failed = DataPurge.objects.filter(status='failed').count()
+        self.stdout.write(self.style.SUCCESS(f'完成 {count} 筆清除') + (f'，{failed} 筆失敗' if failed else ''))
@@ -0,0 +1,269 @@
+"""
+請求耗時分析 (Server-Timing / Prometheus 直方圖 / 慢請求紀錄)。
+
+一輪對話變慢時，時間可能花在資料庫、下載狗狗圖片或呼叫 Gemini。這裡把每個請求的時間拆成幾個階段：
+
+- db：SQL 查詢 (以 connection.execute_wrapper 包住每個查詢，同時計算查詢數)。
+- fetch：對外下載圖片 (chat.fetch)。
+- ai：呼叫 Gemini (回覆、串流、摘要與上傳圖片)。
+- queue：等待發問的限流與 Gemini 同時呼叫名額 (chat.admission)。
+
+各階段以 phase() 標記，記錄在目前請求的 RequestTiming 上 (以 ContextVar 傳遞，async view 與 sync_to_async 也適用)。
+請求結束時由 api.middleware.ServerTimingMiddleware：
+
+1. 加上 Server-Timing 標頭 (瀏覽器開發者工具的 Timing 分頁可直接看到)。
+2. 依路由寫入直方圖，由 /metrics 以 Prometheus 文字格式輸出。
+3. 超過 SLOW_REQUEST_THRESHOLD 秒時寫一筆慢請求紀錄；啟用 SLOW_REQUEST_PROFILE 時附上 cProfile 結果。
+
+其他模組可以 register() 自己的 Counter / Gauge，一併由 /metrics 輸出 (例如 chat.resilience 的斷路器狀態)。
+
+注意：
+- 直方圖只存在目前的 process，多個 worker 時每個 worker 各自輸出 (Prometheus 依 instance 分開抓取)。
+- 同時進行的階段 (例如 async 版本中圖片下載與讀取歷史並行) 會各自計時，加總可能超過總時間。
+- 串流回應的 Server-Timing 只包含送出標頭之前的階段；直方圖則在串流結束後以完整的時間記錄。
+- 啟用 DB_WRITE_BATCHING 時由 writer 執行緒代為執行的寫入不計入 db 階段。
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+PHASES = ('db', 'fetch', 'ai', 'queue')
+
+_current = ContextVar('request_timing', default=None)
+
+
+class RequestTiming:
+    """一個請求的各階段累計耗時 (秒) 與次數。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.counts = dict.fromkeys(PHASES, 0)
+
+    def add(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def header(self, total):
+        """組成 Server-Timing 標頭的值 (毫秒)。"""
+        parts = []
+        for name, seconds in self.seconds.items():
+            if self.counts[name]:
+                desc = f'{self.counts[name]} queries' if name == 'db' else f'{self.counts[name]} calls'
+                parts.append(f'{name};dur={seconds * 1000:.1f};desc="{desc}"')
+        parts.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(parts)
+
+
+def current():
+    """目前請求的 RequestTiming；不在請求中 (例如背景工作、管理指令) 時為 None。"""
+    return _current.get()
+
+
+@contextmanager
+def activate(timing):
+    """在這段期間把 timing 設為目前的請求 (middleware 與串流回應使用)。"""
+    token = _current.set(timing)
+    try:
+        yield timing
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def phase(name):
+    """計時一個階段：with metrics.phase('fetch'): ...；不在請求中時不做任何事。"""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - started)
+
+
+def timed_iter(name, iterable):
+    """逐項計時一個 iterator (例如 Gemini 的串流回覆)，不把呼叫端處理每一段的時間算進去。"""
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def db_execute_wrapper(execute, sql, params, many, context):
+    """connection.execute_wrapper：把每個 SQL 查詢的時間記到目前請求的 db 階段。"""
+    with phase('db'):
+        return execute(sql, params, many, context)
+
+
+def install_db_wrapper(sender, connection, **kwargs):
+    """connection_created signal：每個資料庫連線建立時掛上 db_execute_wrapper (重新連線時不重複掛上)。"""
+    if db_execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_execute_wrapper)
+
+
+# =========================================
+# 直方圖 (Prometheus 文字格式)
+# =========================================
+
+def _format(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+class Histogram:
+    """最簡單的累計直方圖，輸出格式與 prometheus_client 相同 (_bucket / _sum / _count)。"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._lock = threading.Lock()
+        self._series = {}  # label 值 -> [各 bucket 次數, 總和, 次數]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = [(key, list(counts), total, count) for key, (counts, total, count) in sorted(self._series.items())]
+        for key, counts, total, count in snapshot:
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{_labels(pairs + [("le", _format(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(pairs)} {_format(total)}')
+            lines.append(f'{self.name}_count{_labels(pairs)} {count}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    """單調遞增的計數器 (_total)。"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}  # label 值 -> 累計值
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels.get(name, '')) for name in self.labelnames), 0)
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            snapshot = sorted(self._values.items())
+        for key, value in snapshot:
+            lines.append(f'{self.name}{_labels(list(zip(self.labelnames, key)))} {_format(value)}')
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Gauge:
+    """輸出時才呼叫 callback 取值的 gauge (例如斷路器目前的狀態)；callback 回傳 [(label 值, 數值)]。"""
+
+    def __init__(self, name, documentation, labelnames, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for key, value in self.callback():
+            lines.append(f'{self.name}{_labels(list(zip(self.labelnames, key)))} {_format(value)}')
+        return lines
+
+    def clear(self):
+        pass
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+request_duration = Histogram(
+    'http_request_duration_seconds', '請求總耗時 (秒)', ('method', 'route', 'status'), LATENCY_BUCKETS,
+)
+phase_duration = Histogram(
+    'http_request_phase_duration_seconds', '請求中各階段 (db / fetch / ai / queue) 的累計耗時 (秒)',
+    ('method', 'route', 'phase'), LATENCY_BUCKETS,
+)
+db_queries = Histogram(
+    'http_request_db_queries', '每個請求的 SQL 查詢數', ('method', 'route'), QUERY_BUCKETS,
+)
+REGISTRY = [request_duration, phase_duration, db_queries]
+
+
+def register(*collectors):
+    """加入其他模組的指標 (例如 chat.resilience 的斷路器狀態)，由 /metrics 一併輸出。"""
+    for collector in collectors:
+        if collector not in REGISTRY:
+            REGISTRY.append(collector)
+
+
+def observe(method, route, status, timing, total):
+    """請求 (或串流) 結束時寫入直方圖。"""
+    request_duration.observe(total, method=method, route=route, status=status)
+    for name, seconds in timing.seconds.items():
+        if timing.counts[name]:
+            phase_duration.observe(seconds, method=method, route=route, phase=name)
+    db_queries.observe(timing.counts['db'], method=method, route=route)
+
+
+def render():
+    """以 Prometheus 文字格式輸出所有直方圖。"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.clear()
@@ -0,0 +1,139 @@
+"""
+請求耗時 middleware：為每個請求建立 RequestTiming，結束時輸出 Server-Timing、寫入直方圖並記錄慢請求 (見 api/metrics.py)。
+
+同時支援 WSGI 與 ASGI；串流回應會在串流結束 (或用戶端中斷) 時才寫入直方圖與慢請求紀錄。
+慢請求紀錄 (SLOW_REQUEST_THRESHOLD) 預設關閉；SLOW_REQUEST_PROFILE 會讓每個同步請求都在 cProfile 下執行，
+成本很高，只應在排查問題時暫時開啟。
+"""
+import cProfile
+import io
+import logging
+import pstats
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics
+
+slow_logger = logging.getLogger('api.slow_requests')
+
+
+def route_of(request):
+    """以 URL 樣式 (例如 api/dogs/<pk>/) 作為直方圖的 route 標籤，避免每個 id 各自一組。"""
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+def start_profiler():
+    if not getattr(settings, 'SLOW_REQUEST_PROFILE', False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 同一時間只能有一個 profiler (其他執行緒正在分析)，這個請求就不分析
+        return None
+    return profiler
+
+
+def profile_report(profiler, limit=25):
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timing = metrics.RequestTiming()
+        profiler = start_profiler()
+        try:
+            with metrics.activate(timing):
+                response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        return self.finish(request, response, timing, profiler)
+
+    async def __acall__(self, request):
+        timing = metrics.RequestTiming()
+        with metrics.activate(timing):
+            response = await self.get_response(request)
+        return self.finish(request, response, timing, None)
+
+    def finish(self, request, response, timing, profiler):
+        if getattr(settings, 'SERVER_TIMING_ENABLED', True):
+            response['Server-Timing'] = timing.header(timing.elapsed())
+            # 跨來源的前端 (Vite 開發伺服器) 需要 Timing-Allow-Origin 才看得到 Server-Timing
+            if response.has_header('Access-Control-Allow-Origin'):
+                response['Timing-Allow-Origin'] = response['Access-Control-Allow-Origin']
+
+        def done():
+            self.record(request, response, timing, profiler)
+
+        if not response.streaming:
+            done()
+        elif response.is_async:
+            response.streaming_content = self.atimed_stream(response.streaming_content, timing, done)
+        else:
+            response.streaming_content = self.timed_stream(response.streaming_content, timing, done)
+        return response
+
+    # --- 串流回應：產生每一段時仍屬於這個請求，結束後才記錄 ---
+    @staticmethod
+    def timed_stream(content, timing, done):
+        iterator = iter(content)
+        try:
+            while True:
+                with metrics.activate(timing):
+                    try:
+                        chunk = next(iterator)
+                    except StopIteration:
+                        return
+                yield chunk
+        finally:
+            done()
+
+    @staticmethod
+    async def atimed_stream(content, timing, done):
+        iterator = aiter(content)
+        try:
+            while True:
+                with metrics.activate(timing):
+                    try:
+                        chunk = await anext(iterator)
+                    except StopAsyncIteration:
+                        return
+                yield chunk
+        finally:
+            done()
+
+    # --- 直方圖與慢請求紀錄 ---
+    def record(self, request, response, timing, profiler):
+        total = timing.elapsed()
+        route = route_of(request)
+        metrics.observe(request.method, route, response.status_code, timing, total)
+
+        threshold = getattr(settings, 'SLOW_REQUEST_THRESHOLD', None)
+        if threshold is None or total < threshold:
+            return
+        phases = ', '.join(
+            f'{name}={timing.seconds[name] * 1000:.1f}ms/{timing.counts[name]}' for name in metrics.PHASES
+        )
+        message = (
+            f'Slow request {request.method} {request.get_full_path()} ({route}) -> {response.status_code} '
+            f'in {total * 1000:.1f}ms [{phases}]'
+        )
+        if profiler is not None:
+            message += '\n' + profile_report(profiler)
+        slow_logger.warning(message)
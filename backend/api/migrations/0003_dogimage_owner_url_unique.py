@@ -0,0 +1,50 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:25
+
+from django.conf import settings
+import hashlib
+import logging
+
+from django.db import migrations, models
+
+logger = logging.getLogger(__name__)
+
+
+def fill_url_hash(apps, schema_editor):
+    """
+    既有的收藏補上 url_hash (與 api.models.hash_url 相同的算法)，
+    並移除同一個使用者重複收藏的網址 (保留最早的一筆)，才能建立唯一條件；刪除的筆數會寫入 log。
+    """
+    DogImage = apps.get_model('api', 'DogImage')
+    seen = set()
+    duplicates = []
+    for dog in DogImage.objects.only('id', 'owner_id', 'url').order_by('id').iterator():
+        url_hash = hashlib.sha256(dog.url.encode('utf-8')).hexdigest()
+        if (dog.owner_id, url_hash) in seen:
+            duplicates.append(dog.id)
+            continue
+        seen.add((dog.owner_id, url_hash))
+        DogImage.objects.filter(pk=dog.pk).update(url_hash=url_hash)
+    if duplicates:
+        DogImage.objects.filter(pk__in=duplicates).delete()
+        logger.warning(f'刪除 {len(duplicates)} 筆重複的收藏 (同一使用者的相同網址，保留最早的一筆): id={duplicates}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_dogimage_owner_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dogimage',
+            name='url_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_url_hash, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='dogimage',
+            constraint=models.UniqueConstraint(fields=('owner', 'url_hash'), name='dogimage_owner_url_uniq'),
+        ),
+    ]
@@ -9,9 +9,18 @@ migrate：
 """
 # 這段程式碼定義了 Django Model(模型)，
 # 用於表示和操作資料庫結構(Schema)中的 DogImage(狗狗圖片) 資料表。
-from django.db import models
+import hashlib
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
 from django.contrib.auth.models import User # 引入 Django 內建的 User 模型
 
+
+def hash_url(url):
+    """網址的 SHA-256 (64 字元)，作為 (owner, 網址) 唯一鍵，避免直接以 500 字元的網址建立索引。"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
 """ 
 DRF 讀取到 Model 名稱是 DogImage，
 它會自動將駝峰式命名（CamelCase）拆開變成 "Dog Image"，
@@ -23,14 +32,130 @@ class DogImage(models.Model):
     id = models.AutoField(primary_key=True)
     
     # owner 欄位：綁定使用者，如果使用者被刪除，圖片也一起刪除
-    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='images')
+    # 由 Meta.indexes 的 (owner, created_at, id) 複合索引涵蓋，不需要另一個單欄索引
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='images', db_index=False)
     
     # 儲存圖片的網址，內建格式驗證，長度上限 500 字元
     url = models.URLField(max_length=500)
 
+    # url 的 SHA-256，由 save() 自動填入 (bulk_create 不會呼叫 save()，需自行以 hash_url 填入)
+    url_hash = models.CharField(max_length=64, default='', editable=False)
+
     # 自動記錄圖片資料建立的時間戳記。
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # 收藏列表：WHERE owner_id = ? ORDER BY created_at DESC, id DESC (游標分頁)
+            models.Index(fields=['owner', '-created_at', '-id'], name='dogimage_owner_created_idx'),
+        ]
+        constraints = [
+            # 同一個使用者不能重複收藏同一張圖片 (批次匯入時靠這個條件忽略重複的資料)
+            models.UniqueConstraint(fields=['owner', 'url_hash'], name='dogimage_owner_url_uniq'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.url_hash = hash_url(self.url)
+        super().save(*args, **kwargs)
+
     # 定義物件的字串表達形式(有利於 Django Admin 後台顯示)。
     def __str__(self):
-        return f"Dog Image {self.id}"
\ No newline at end of file
+        return f"Dog Image {self.id}"
+
+
+class DataVersionManager(models.Manager):
+    def bump(self, user_id, scope):
+        """
+        遞增使用者某類資料的版本。需與資料的寫入放在同一個交易中，
+        讓讀取端不會看到「新版本號 + 舊資料」的組合 (那會讓舊資料一直被當成最新的)。
+        """
+        values = {'version': F('version') + 1, 'updated_at': timezone.now()}
+        if self.filter(user_id=user_id, scope=scope).update(**values):
+            return
+        try:
+            with transaction.atomic():
+                self.create(user_id=user_id, scope=scope, version=1)
+        except IntegrityError:
+            # 同時有另一個請求先建立了這一列
+            self.filter(user_id=user_id, scope=scope).update(**values)
+
+    def _current(self, user_id, scope):
+        return self.filter(user_id=user_id, scope=scope).values_list('version', 'updated_at')
+
+    def current(self, user_id, scope):
+        """回傳 (version, updated_at)；尚未有任何寫入時為 (0, None)。"""
+        return self._current(user_id, scope).first() or (0, None)
+
+    async def acurrent(self, user_id, scope):
+        return await self._current(user_id, scope).afirst() or (0, None)
+
+
+class DataVersion(models.Model):
+    """
+    每個使用者每一類資料 (收藏、對話) 的版本號，資料有寫入時遞增。
+    列表與對話紀錄以它產生 ETag / Last-Modified (見 api/conditional.py)，
+    前端輪詢時資料沒變就回傳 304，不必查詢或序列化資料本身。
+    """
+    FAVORITES = 'favorites'
+    CHAT = 'chat'
+    SCOPE_CHOICES = [(FAVORITES, '收藏'), (CHAT, '對話')]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='data_versions', db_index=False)
+    scope = models.CharField(max_length=20, choices=SCOPE_CHOICES)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = DataVersionManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope'], name='dataversion_user_scope_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.scope}@{self.version}"
+
+
+class DataPurge(models.Model):
+    """
+    背景清除工作：刪除帳號或刪除全部對話時，請求中只把資料標記為已刪除 (立即隱藏)，
+    實際的 DELETE 由 api/purge.py 以小批次、各自獨立的短交易在背景完成，避免長時間鎖住 SQLite。
+    deleted / total 為進度；total 是建立時估計的列數。
+    """
+    ACCOUNT = 'account'
+    CHAT = 'chat'
+    KIND_CHOICES = [(ACCOUNT, '帳號'), (CHAT, '全部對話')]
+
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),  # 等待清除
+        ('running', 'Running'),  # 清除中 (每一批都會更新 updated_at；太久沒更新代表執行的 process 已中止，可被接手)
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    # 刪除帳號時使用者本身最後也會被刪除，因此只記錄 id 而不是 ForeignKey，清除紀錄可以保留下來
+    user_pk = models.PositiveBigIntegerField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    total = models.PositiveBigIntegerField(default=0)
+    deleted = models.PositiveBigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']  # 先進先出
+        indexes = [
+            models.Index(fields=['status', 'updated_at']),
+        ]
+
+    @property
+    def progress(self):
+        """完成比例 (0 ~ 1)。"""
+        if self.status == 'done':
+            return 1.0
+        return min(1.0, self.deleted / self.total) if self.total else 0.0
+
+    def __str__(self):
+        return f"Purge {self.id} ({self.kind}, {self.status})"
@@ -0,0 +1,112 @@
+"""
+游標分頁 (Keyset Pagination)。
+
+收藏列表與對話列表原本一次回傳使用者的整張資料表，資料一多回應就會變得很大，資料庫也得整表掃描。
+這裡改用 (created_at, id) 作為游標，由新到舊逐頁讀取 (排序的時間欄位可用 ordering_field 指定)：
+
+1. 每一頁只查詢「比游標更舊」的資料：
+   WHERE created_at < c OR (created_at = c AND id < i) ORDER BY created_at DESC, id DESC LIMIT n
+   不像 OFFSET 分頁需要跳過前面所有資料，越後面的頁數也一樣快。
+2. 順序穩定：瀏覽途中有新資料寫入時，新資料只會出現在第一頁之前，不會讓後面的頁面重複或漏掉資料。
+3. 游標是不透明的字串 (base64)，前端只需把回應中的 next 原樣帶回即可，next 為 null 代表已經到底。
+4. 每頁筆數預設為 KEYSET_PAGE_SIZE，可用 ?page_size= 調整，上限為 KEYSET_MAX_PAGE_SIZE。
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = '無效的分頁游標。'
+    # 排序用的時間欄位，搭配 pk 組成游標；欄位值不可為 NULL
+    ordering_field = 'created_at'
+
+    def __init__(self, ordering_field=None):
+        if ordering_field is not None:
+            self.ordering_field = ordering_field
+
+    def get_page_size(self, request):
+        default = getattr(settings, 'KEYSET_PAGE_SIZE', 20)
+        maximum = getattr(settings, 'KEYSET_MAX_PAGE_SIZE', 100)
+        try:
+            size = int(query_params(request).get(self.page_size_query_param, default))
+        except (TypeError, ValueError):
+            return default
+        return min(max(size, 1), maximum)
+
+    # --- 游標編碼 ---
+    def encode_cursor(self, instance):
+        raw = f'{getattr(instance, self.ordering_field).isoformat()}|{instance.pk}'
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, request):
+        encoded = query_params(request).get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            value, pk = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii').split('|')
+            return datetime.fromisoformat(value), int(pk)
+        except (binascii.Error, UnicodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    # --- 分頁 ---
+    def page_queryset(self, queryset, request):
+        """套用游標條件與排序，多取一筆用來判斷是否還有下一頁。"""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        field = self.ordering_field
+        queryset = queryset.order_by(f'-{field}', '-pk')
+        if cursor is not None:
+            value, pk = cursor
+            queryset = queryset.filter(Q(**{f'{field}__lt': value}) | Q(**{field: value, 'pk__lt': pk}))
+        return queryset[:self.page_size + 1]
+
+    def _finish(self, rows):
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self._finish(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset 的非同步版本 (給 async view 使用)。"""
+        return self._finish([row async for row in self.page_queryset(queryset, request)])
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_paginated_data(self, data):
+        return {'next': self.get_next_link(), 'results': data}
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+def query_params(request):
+    # DRF Request 使用 query_params，Django HttpRequest (async view) 使用 GET
+    return getattr(request, 'query_params', request.GET)
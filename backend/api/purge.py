@@ -0,0 +1,231 @@
+"""
+刪除帳號 / 刪除全部對話的背景清除 (Chunked Background Purge)。
+
+原本這兩個操作在請求中一次連帶刪除 (cascade) 所有收藏、對話與訊息：資料量大的使用者會讓單一交易
+長時間持有 SQLite 的寫入鎖，同一時間其他人的發問與收藏都只能等待。現在分成兩段：
+
+1. 標記 (請求中，只有少數幾個 UPDATE)：
+   - 刪除全部對話：把使用者的 ChatSession 標記 deleted_at (ChatSession.objects 立即查不到)，
+     取消尚未完成的背景對話工作，並遞增對話的版本號。
+   - 刪除帳號：標記所有對話、刪除 Token、停用帳號並釋出使用者名稱與 Email (之後可以重新註冊)。
+   兩者都會建立一筆 DataPurge 記錄進度，請求的交易 commit 後喚醒背景清除。
+2. 清除 (背景)：依序刪除訊息、背景工作、Session (刪除帳號時再加上收藏與使用者本身)，
+   每批最多 DATA_PURGE_BATCH_SIZE 列，各自是一個獨立的短交易 (經由 api.db 的 write_queue，
+   與一般請求的寫入輪流執行)，批次之間暫停 DATA_PURGE_BATCH_PAUSE 秒，並在同一個交易中更新進度。
+
+每個 process 的背景執行緒在第一次有清除工作時才啟動 (DATA_PURGE_IN_BACKGROUND 為 False 時不啟動)。
+清除可以中斷後重來：process 中止時留下的工作 (超過 DATA_PURGE_STALE_SECONDS 沒有進度) 會被接手，
+也可以用 `python manage.py purge_deleted_data` 直接執行所有等待中的清除。
+"""
+import functools
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from chat.models import ChatJob, ChatMessage, ChatSession
+
+from .db import serialized_write, write_queue
+from .models import DataPurge, DataVersion, DogImage
+
+logger = logging.getLogger(__name__)
+
+
+def batch_size():
+    return getattr(settings, 'DATA_PURGE_BATCH_SIZE', 500)
+
+
+def batch_pause():
+    return getattr(settings, 'DATA_PURGE_BATCH_PAUSE', 0.05)
+
+
+def stale_seconds():
+    return getattr(settings, 'DATA_PURGE_STALE_SECONDS', 300)
+
+
+# =========================================
+# 標記 (請求中)
+# =========================================
+
+@serialized_write
+def delete_chats(user):
+    """隱藏使用者所有的對話並排入背景清除，回傳 DataPurge。"""
+    total = count_chats(user.pk)
+    hide_chats(user.pk)
+    DataVersion.objects.bump(user.pk, DataVersion.CHAT)
+    return schedule(user.pk, DataPurge.CHAT, total)
+
+
+@serialized_write
+def delete_account(user):
+    """停用帳號、隱藏所有資料並排入背景清除，回傳 DataPurge。"""
+    total = count_chats(user.pk) + DogImage.objects.filter(owner_id=user.pk).count() + 1
+    hide_chats(user.pk)
+    Token.objects.filter(user_id=user.pk).delete()
+    # 使用者名稱加上註冊時不允許的字元，不會和新的帳號重複；原本的名稱與 Email 立即可以重新註冊
+    user.username = f'deleted:{user.pk}'
+    user.email = ''
+    user.is_active = False
+    user.set_unusable_password()
+    user.save()
+    _delete_email_addresses(user.pk)
+    return schedule(user.pk, DataPurge.ACCOUNT, total)
+
+
+def count_chats(user_pk):
+    """使用者 (未刪除的) 對話要清除的列數：Session + 訊息 (讀取反正規化的 message_count) + 背景工作。"""
+    sessions = ChatSession.objects.filter(user_id=user_pk).aggregate(n=Count('id'), messages=Sum('message_count'))
+    jobs = ChatJob.objects.filter(session__user_id=user_pk, session__deleted_at__isnull=True).count()
+    return sessions['n'] + (sessions['messages'] or 0) + jobs
+
+
+def hide_chats(user_pk):
+    """標記使用者所有的 Session 為已刪除，並讓尚未完成的背景對話工作失敗 (worker 不會再為它們呼叫 Gemini)。"""
+    now = timezone.now()
+    ChatSession.objects.filter(user_id=user_pk).update(deleted_at=now)
+    ChatJob.objects.filter(
+        session__user_id=user_pk, session__deleted_at__isnull=False, status__in=('queued', 'running'),
+    ).update(status='failed', error='對話已刪除', lease_expires_at=None, updated_at=now)
+
+
+def _delete_email_addresses(user_pk):
+    """allauth 另外記錄的 Email (註冊時會檢查是否重複)。"""
+    from allauth.account.models import EmailAddress
+    EmailAddress.objects.filter(user_id=user_pk).delete()
+
+
+def schedule(user_pk, kind, total):
+    """建立清除工作；交易 commit 後才喚醒背景執行緒 (否則可能看不到剛建立的工作與標記)。"""
+    purge = DataPurge.objects.create(user_pk=user_pk, kind=kind, total=total)
+    if getattr(settings, 'DATA_PURGE_IN_BACKGROUND', True):
+        transaction.on_commit(purger.wake)
+    return purge
+
+
+# =========================================
+# 清除 (背景)
+# =========================================
+
+def steps(purge):
+    """依序要清除的 QuerySet：先刪子資料，最後才刪 Session / 使用者，每一步的 DELETE 都不需要再連帶刪除大量資料。"""
+    if purge.kind == DataPurge.CHAT:
+        sessions = ChatSession.all_objects.filter(user_id=purge.user_pk, deleted_at__isnull=False)
+    else:
+        sessions = ChatSession.all_objects.filter(user_id=purge.user_pk)
+    querysets = [
+        ChatMessage.objects.filter(session__in=sessions.values('pk')),
+        ChatJob.objects.filter(session__in=sessions.values('pk')),
+        sessions,
+    ]
+    if purge.kind == DataPurge.ACCOUNT:
+        querysets += [
+            DogImage.objects.filter(owner_id=purge.user_pk),
+            # 剩下的 Token、版本號、allauth 等資料只有少數幾列，由刪除使用者時連帶刪除
+            get_user_model().objects.filter(pk=purge.user_pk, is_active=False),
+        ]
+    return querysets
+
+
+def delete_batch(purge, queryset, size):
+    """刪除 queryset 的前 size 列並更新進度 (在呼叫端的交易中)，回傳刪除的列數 (含連帶刪除)。"""
+    ids = list(queryset.order_by('pk').values_list('pk', flat=True)[:size])
+    if not ids:
+        return 0
+    deleted, _ = queryset.model._base_manager.filter(pk__in=ids).delete()
+    DataPurge.objects.filter(pk=purge.pk).update(deleted=F('deleted') + deleted, updated_at=timezone.now())
+    return deleted
+
+
+def claim():
+    """領取下一筆等待中 (或執行的 process 已中止) 的清除工作；以條件式 UPDATE 確保只有一個執行者。"""
+    now = timezone.now()
+    candidates = DataPurge.objects.filter(
+        Q(status='pending') | Q(status='running', updated_at__lt=now - timedelta(seconds=stale_seconds()))
+    )[:20]
+    for purge in candidates:
+        claimed = DataPurge.objects.filter(pk=purge.pk, status=purge.status, updated_at=purge.updated_at).update(
+            status='running', updated_at=now,
+        )
+        if claimed:
+            purge.refresh_from_db()
+            return purge
+    return None
+
+
+def run(purge, size=None):
+    """分批清除到完成；失敗時標記 failed (資料仍維持隱藏，可用 purge_deleted_data --retry-failed 重試)。"""
+    size = size or batch_size()
+    try:
+        for queryset in steps(purge):
+            while write_queue.run(functools.partial(delete_batch, purge, queryset, size)):
+                # 讓出寫入鎖，其他請求的寫入不必排在整個清除之後
+                time.sleep(batch_pause())
+    except Exception as e:
+        logger.exception(f'DataPurge {purge.pk} failed')
+        DataPurge.objects.filter(pk=purge.pk).update(status='failed', error=str(e), updated_at=timezone.now())
+    else:
+        now = timezone.now()
+        DataPurge.objects.filter(pk=purge.pk).update(status='done', error='', updated_at=now, finished_at=now)
+    purge.refresh_from_db()
+    return purge
+
+
+def run_pending(size=None):
+    """執行所有可領取的清除工作，回傳完成 (或失敗) 的工作數。"""
+    count = 0
+    while (purge := claim()) is not None:
+        run(purge, size)
+        count += 1
+    return count
+
+
+class Purger:
+    """每個 process 一個背景執行緒，有清除工作時才啟動，做完就結束。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._again = False
+
+    def wake(self):
+        with self._lock:
+            if self._running:
+                # 執行緒可能已經查完、正要結束：請它再查一次
+                self._again = True
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._loop, name='data-purge', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        try:
+            while True:
+                try:
+                    run_pending()
+                except Exception:
+                    logger.exception('Data purge thread crashed')
+                with self._lock:
+                    if not self._again:
+                        self._running = False
+                        return
+                    self._again = False
+        finally:
+            # 這個執行緒自己開的資料庫連線
+            connections.close_all()
+
+    def wait(self, timeout=None):
+        """等待背景清除完成 (測試使用)。"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+purger = Purger()
@@ -0,0 +1,158 @@
+"""
+伺服器端的隨機狗狗池 (Random Dog Pool)。
+
+首頁每按一次「下一隻」，前端原本都要直接呼叫 dog.ceo 的 API，再從 dog.ceo 下載一張沒有快取的原圖。
+這裡改由後端預先準備好一池隨機圖片網址：
+
+1. 背景執行緒一次向 RANDOM_DOG_SOURCE_URL 要一批網址 (dog.ceo 的 /breeds/image/random/<n>)，
+   並先產生首頁要顯示的縮圖 (RANDOM_DOG_DISPLAY_WIDTH / RANDOM_DOG_DISPLAY_FORMAT，見 api/thumbnails.py)；
+   產生縮圖時原圖也存入 chat.image_cache，之後對這張圖發問也直接命中快取。
+   來源主機不在 THUMBNAIL_ALLOWED_HOSTS 中時只下載原圖。
+2. GET /api/dogs/random/ 從池中取出一個網址 (取出後就不再發給其他人)，只是記憶體操作。
+   回應的 display_url 指向已經產生好的縮圖，瀏覽器直接向本站載入，不必再從 dog.ceo 下載原圖。
+3. 池中剩餘數量低於 RANDOM_DOG_POOL_LOW_WATER 時，自動在背景補到 RANDOM_DOG_POOL_SIZE。
+4. 池是空的 (剛啟動或來源故障) 時，直接向來源要一個網址回傳 (不預熱)，請求不會因此失敗。
+
+每個 process 各自有一個池，背景執行緒在第一次取用時才啟動 (管理指令與測試不會多出執行緒)；
+圖片快取在磁碟上，由所有 process 共用。測試或壓測時可將 RANDOM_DOG_SOURCE_URL 指向本機的替身伺服器。
+"""
+import json
+import logging
+import threading
+from collections import deque
+
+from django.conf import settings
+
+from chat.fetch import FetchError, fetch
+from chat.image_cache import image_cache
+
+from . import thumbnails
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_batch():
+    """
+    向來源要一批隨機圖片網址。來源回應 dog.ceo 的格式：{"message": [網址...]} 或 {"message": "網址"}。
+    失敗時拋出 FetchError。
+    """
+    result = fetch(getattr(settings, 'RANDOM_DOG_SOURCE_URL', 'https://dog.ceo/api/breeds/image/random/50'))
+    try:
+        message = json.loads(result.content)['message']
+    except (ValueError, KeyError, TypeError) as e:
+        raise FetchError(f'隨機圖片來源的回應格式錯誤: {e}') from e
+    urls = [message] if isinstance(message, str) else message
+    return [url for url in urls if isinstance(url, str) and url.startswith(('http://', 'https://'))]
+
+
+def display_spec():
+    """首頁顯示的縮圖規格 (寬度, 格式)；寬度需為 THUMBNAIL_WIDTHS 之一。"""
+    return getattr(settings, 'RANDOM_DOG_DISPLAY_WIDTH', 640), getattr(settings, 'RANDOM_DOG_DISPLAY_FORMAT', 'webp')
+
+
+def display_url(url):
+    """首頁顯示用的縮圖網址；來源不支援縮圖時回傳 None (前端改用原圖)。"""
+    prefix = thumbnails.thumbnail_url(url)
+    if prefix is None:
+        return None
+    width, fmt = display_spec()
+    return f'{prefix}{width}.{fmt}'
+
+
+def warm(url):
+    """預先產生顯示用的縮圖 (連帶快取原圖)；失敗時拋出 FetchError 或 thumbnails.SourceImageError。"""
+    if thumbnails.is_allowed(url):
+        thumbnails.rendition_cache.get(url, *display_spec())
+    else:
+        image_cache.get(url)
+
+
+class RandomDogPool:
+    """預先下載好圖片的隨機網址池，由背景執行緒補滿。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._urls = deque()
+        self._thread = None
+        self.served = 0
+        self.misses = 0
+
+    # --- 設定 ---
+    @property
+    def size(self):
+        return getattr(settings, 'RANDOM_DOG_POOL_SIZE', 50)
+
+    @property
+    def low_water(self):
+        return getattr(settings, 'RANDOM_DOG_POOL_LOW_WATER', 20)
+
+    def __len__(self):
+        return len(self._urls)
+
+    # --- 取用 ---
+    def take(self):
+        """取出一個網址；池是空的時直接向來源要一個 (來源也失敗時拋出 FetchError)。"""
+        with self._lock:
+            url = self._urls.popleft() if self._urls else None
+            remaining = len(self._urls)
+        if remaining < self.low_water:
+            self.refill_in_background()
+        if url is not None:
+            self.served += 1
+            return url
+        self.misses += 1
+        urls = fetch_batch()
+        if not urls:
+            raise FetchError('隨機圖片來源沒有回傳任何網址')
+        return urls[0]
+
+    # --- 補充 ---
+    def refill_in_background(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.refill, name='random-dog-pool', daemon=True)
+            self._thread.start()
+
+    def refill(self):
+        """補到 RANDOM_DOG_POOL_SIZE 個網址，每個網址先準備好縮圖；來源失敗時留到下次取用再試。"""
+        try:
+            while len(self._urls) < self.size:
+                urls = fetch_batch()
+                if not urls:
+                    return
+                added = 0
+                for url in urls:
+                    if len(self._urls) >= self.size:
+                        break
+                    with self._lock:
+                        if url in self._urls:
+                            continue
+                    try:
+                        warm(url)
+                    except (FetchError, thumbnails.SourceImageError) as e:
+                        logger.info(f'Skipping random dog {url}: {e}')
+                        continue
+                    with self._lock:
+                        self._urls.append(url)
+                    added += 1
+                if not added:
+                    return
+        except FetchError as e:
+            logger.warning(f'Random dog pool refill failed: {e}')
+        except Exception:
+            logger.exception('Random dog pool refill crashed')
+
+    def wait(self, timeout=None):
+        """等待背景補充完成 (測試使用)。"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+            self.served = self.misses = 0
+
+
+random_dog_pool = RandomDogPool()
@@ -5,16 +5,76 @@
 2.自動化映射：繼承 ModelSerializer 後，DRF 會自動讀取 DogImage 的欄位定義，並根據模型屬性（如 URLField）自動生成相應的資料驗證邏輯。
 3.Meta 類別作用：透過 class Meta 進行配置，明確指定序列化的「對象（model）」與「範圍（fields）」，實現宣告式開發，大幅減少手動撰寫欄位代碼。
 """
+from django.conf import settings
 from rest_framework import serializers
-from .models import DogImage
+from .models import DataPurge, DogImage, hash_url
+from .thumbnails import thumbnail_url
 
 class DogImageSerializer(serializers.ModelSerializer):
     
     # 設定 owner 為唯讀，並顯示使用者名稱 (而不是 ID)
     owner = serializers.ReadOnlyField(source='owner.username')
+
+    # 縮圖網址前綴 (見 api/thumbnails.py)，前端接上 <寬度>.<格式>；來源不支援縮圖時為 null
+    thumbnail_url = serializers.SerializerMethodField()
     
     class Meta:
         # 指定要關聯的資料庫模型
         model = DogImage
-        # 轉換所有欄位 (id, url, created_at)
-        fields = ['id', 'owner', 'url', 'created_at']
\ No newline at end of file
+        # 轉換所有欄位 (id, url, created_at) 與縮圖網址
+        fields = ['id', 'owner', 'url', 'thumbnail_url', 'created_at']
+
+    def get_thumbnail_url(self, obj) -> str | None:
+        return thumbnail_url(obj.url)
+
+    def validate_url(self, value):
+        # 同一個使用者不能重複收藏同一張圖片 (對應資料庫的 dogimage_owner_url_uniq 唯一條件)
+        request = self.context.get('request')
+        if request is not None:
+            duplicates = DogImage.objects.filter(owner=request.user, url_hash=hash_url(value))
+            if self.instance is not None:
+                duplicates = duplicates.exclude(pk=self.instance.pk)
+            if duplicates.exists():
+                raise serializers.ValidationError('已經收藏過這張圖片。')
+        return value
+
+
+def bulk_max_items():
+    return getattr(settings, 'DOG_BULK_MAX_ITEMS', 500)
+
+
+class DogBulkCreateSerializer(serializers.Serializer):
+    """批次收藏的輸入：網址清單。個別網址的格式錯誤不會讓整批失敗，而是在結果中標記為 invalid。"""
+    urls = serializers.ListField(child=serializers.CharField(trim_whitespace=True), allow_empty=False)
+
+    def validate_urls(self, value):
+        if len(value) > bulk_max_items():
+            raise serializers.ValidationError(f'一次最多 {bulk_max_items()} 筆。')
+        return value
+
+
+class DogBulkDeleteSerializer(serializers.Serializer):
+    """批次刪除的輸入：收藏 id 清單。"""
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+
+    def validate_ids(self, value):
+        if len(value) > bulk_max_items():
+            raise serializers.ValidationError(f'一次最多 {bulk_max_items()} 筆。')
+        return value
+
+
+class DogBulkResultSerializer(serializers.Serializer):
+    """批次操作中單一項目的結果 (僅用於 API 文件)。"""
+    url = serializers.CharField(required=False)
+    id = serializers.IntegerField(required=False, allow_null=True)
+    status = serializers.ChoiceField(choices=['created', 'exists', 'duplicate', 'invalid', 'deleted', 'not_found'])
+    error = serializers.CharField(required=False)
+
+class DataPurgeSerializer(serializers.ModelSerializer):
+    """背景清除的進度：progress 為 0 ~ 1 的完成比例 (total 是建立時的估計值)。"""
+    progress = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = DataPurge
+        fields = ['id', 'kind', 'status', 'deleted', 'total', 'progress', 'created_at', 'finished_at']
+        read_only_fields = fields
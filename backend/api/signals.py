@@ -0,0 +1,26 @@
+"""
+清除快取 Token 驗證的項目 (見 api/authentication.py)。
+
+dj_rest_auth 的登出、修改密碼與刪除帳號都不是這個專案的 view，因此以 signal 接在資料的變動上：
+- Token 被刪除 (登出、刪除帳號時連帶刪除)：清除該 token。
+- User 被儲存 (修改密碼、停用帳號等)：清除該使用者的所有 token；只更新 last_login (每次登入) 時略過。
+"""
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from .authentication import token_user_cache
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    token_user_cache.invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def forget_changed_user(sender, instance, created, update_fields=None, **kwargs):
+    if created or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    keys = Token.objects.filter(user=instance).values_list('key', flat=True) if token_user_cache.shared else ()
+    token_user_cache.invalidate_user(instance.pk, keys)
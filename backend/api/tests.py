@@ -2,7 +2,36 @@ from django.urls import reverse  # 用於反查 URL，避免在程式碼中寫
 from rest_framework import status  # 引入標準 HTTP 狀態碼常數，增加程式碼可讀性 (如 HTTP_200_OK)
 from rest_framework.test import APITestCase  # DRF 提供的測試基類，內建了強大的測試客戶端 (APIClient)
 from django.contrib.auth.models import User # 引入 User 模型
-from .models import DogImage  # 引入我們要測試的資料庫模型
+from rest_framework.authtoken.models import Token
+from . import metrics, purge, thumbnails
+from .authentication import token_user_cache
+from .db import WriteQueue
+from .models import DataPurge, DataVersion, DogImage  # 引入我們要測試的資料庫模型
+from .random_dogs import RandomDogPool
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from pathlib import Path
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.db import connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.loader import MigrationLoader
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from chat.image_cache import CachedImage, image_cache
+from chat.models import ChatJob, ChatMessage, ChatSession
+
 
 class DogApiTests(APITestCase):
     """
@@ -56,11 +85,13 @@ class DogApiTests(APITestCase):
         
         # 斷言 2: 檢查回傳的資料筆數是否正確 (setUp 建立了一筆，所以長度應為 1)
         # response.data 是 DRF 解析後的 JSON 資料 (Python 字典/列表格式)
-        self.assertEqual(len(response.data), 1)
+        # 列表採用游標分頁，資料放在 results 中，next 為 None 代表沒有下一頁
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
         
         # 斷言 3: 檢查回傳的內容細節
         # 確認第一筆資料 (index 0) 的 'url' 欄位是否與我們建立時的資料一致
-        self.assertEqual(response.data[0]['url'], self.dog_data['url'])
+        self.assertEqual(response.data['results'][0]['url'], self.dog_data['url'])
 
     # --- 測試 2: 新增收藏 (POST) ---
     def test_create_favorite_dog(self):
@@ -69,7 +100,8 @@ class DogApiTests(APITestCase):
         預期結果：伺服器回傳 201 Created，測試專用資料庫中的總筆數增加，且新資料內容正確。
         """
         # 準備要新增的 Payload (請求內容)
-        new_dog_data = {'url': 'https://google.com/不存在的圖.jpg'}
+        # 同一個使用者不能重複收藏同一張圖片，因此使用與 setUp 不同的網址
+        new_dog_data = {'url': 'https://google.com/另一張不存在的圖.jpg'}
         
         # 發送 POST 請求
         # format='json' 告訴測試客戶端將資料序列化為 JSON 格式，並設定 Content-Type application/json
@@ -101,4 +133,703 @@ class DogApiTests(APITestCase):
         
         # 斷言 2: 檢查資料庫狀態
         # 唯一的資料被刪除後，資料庫應該要是空的 (count 為 0)
-        self.assertEqual(DogImage.objects.count(), 0)
\ No newline at end of file
+        self.assertEqual(DogImage.objects.count(), 0)
+
+class KeysetPaginationTests(APITestCase):
+    """
+    針對收藏列表游標分頁的測試。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='pager', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('dogimage-list')
+        # 建立 5 筆收藏，並刻意讓其中 3 筆的建立時間完全相同，確認 id 能區分同一時間的資料
+        dogs = [DogImage.objects.create(owner=self.user, url=f'https://images.dog.ceo/{i}.jpg') for i in range(5)]
+        DogImage.objects.filter(id__in=[d.id for d in dogs[1:4]]).update(created_at=dogs[1].created_at)
+        self.expected_ids = list(DogImage.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def walk(self, page_size):
+        """依照回應中的 next 一路讀到最後一頁，回傳讀到的 id 與頁數。"""
+        ids, pages, url = [], 0, f'{self.url}?page_size={page_size}'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [dog['id'] for dog in response.data['results']]
+            pages += 1
+            url = response.data['next']
+        return ids, pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        ids, pages = self.walk(page_size=2)
+
+        self.assertEqual(ids, self.expected_ids)
+        self.assertEqual(pages, 3)
+
+    def test_new_rows_do_not_shift_later_pages(self):
+        """測試情境：讀完第一頁後有新收藏寫入，後續頁面不應重複或漏掉資料。"""
+        first = self.client.get(self.url, {'page_size': 2})
+        DogImage.objects.create(owner=self.user, url='https://images.dog.ceo/new.jpg')
+
+        second = self.client.get(first.data['next'])
+
+        self.assertEqual([d['id'] for d in second.data['results']], self.expected_ids[2:4])
+
+    def test_invalid_cursor_returns_404(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_page_size_is_capped(self):
+        with self.settings(KEYSET_MAX_PAGE_SIZE=3):
+            response = self.client.get(self.url, {'page_size': 1000})
+        self.assertEqual(len(response.data['results']), 3)
+
+
+class DogQueryTests(APITestCase):
+    """
+    熱門查詢的回歸測試：
+    1. 每個端點的查詢次數固定，不會隨資料筆數增加 (避免 N+1)。
+    2. 收藏列表的查詢使用 (owner, created_at, id) 複合索引 (以 EXPLAIN 檢查，僅限 SQLite)。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='queries', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.dogs = [DogImage.objects.create(owner=self.user, url=f'https://images.dog.ceo/{i}.jpg') for i in range(30)]
+        # 版本號那一列只會在第一次寫入時建立，這裡先建好，量測的是之後每次請求的查詢次數
+        DataVersion.objects.bump(self.user.pk, DataVersion.FAVORITES)
+
+    def test_list_query_count_is_constant(self):
+        # 讀取版本號 (產生 ETag) + 一頁收藏
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('dogimage-list'), {'page_size': 100})
+        self.assertEqual(len(response.data['results']), 30)
+
+    def test_detail_endpoints_query_counts(self):
+        url = reverse('dogimage-detail', args=[self.dogs[0].id])
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        # 檢查是否重複收藏 + 交易 (SAVEPOINT) 中寫入並遞增版本號
+        with self.assertNumQueries(5):
+            self.client.post(reverse('dogimage-list'), {'url': 'https://images.dog.ceo/new.jpg'}, format='json')
+        with self.assertNumQueries(5):
+            self.client.delete(url)
+
+    def test_user_delete_query_count(self):
+        # 請求中只標記 (停用帳號、隱藏對話、刪除 token、建立清除工作)，查詢數與資料量無關
+        with self.assertNumQueries(11):
+            response = self.client.delete(reverse('user-delete'))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN 輸出格式依資料庫而異')
+    def test_list_query_uses_owner_created_index(self):
+        plan = DogImage.objects.filter(owner=self.user).order_by('-created_at', '-id')[:21].explain()
+        self.assertIn('dogimage_owner_created_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class DogBulkApiTests(APITestCase):
+    """
+    針對批次收藏 / 批次刪除端點的測試。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='bulk', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.existing = DogImage.objects.create(owner=self.user, url='https://images.dog.ceo/old.jpg')
+        self.bulk_url = reverse('dogimage-bulk-create')
+        self.bulk_delete_url = reverse('dogimage-bulk-delete')
+        DataVersion.objects.bump(self.user.pk, DataVersion.FAVORITES)
+
+    def test_bulk_create_reports_each_item(self):
+        urls = [f'https://images.dog.ceo/{i}.jpg' for i in range(200)]
+        payload = urls + ['https://images.dog.ceo/old.jpg', urls[0], 'not a url']
+
+        response = self.client.post(self.bulk_url, {'urls': payload}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['created'], 200)
+        statuses = [item['status'] for item in response.data['results']]
+        self.assertEqual(statuses[-3:], ['exists', 'duplicate', 'invalid'])
+        self.assertEqual(response.data['results'][-3]['id'], self.existing.id)
+        self.assertEqual(DogImage.objects.filter(owner=self.user).count(), 201)
+
+    def test_bulk_create_is_idempotent_and_runs_fixed_queries(self):
+        urls = [f'https://images.dog.ceo/{i}.jpg' for i in range(100)]
+        # 交易 (SAVEPOINT) + 查詢既有資料 + bulk_create + 查回 id + 遞增版本號，不隨筆數增加
+        with self.assertNumQueries(6):
+            self.client.post(self.bulk_url, {'urls': urls}, format='json')
+
+        response = self.client.post(self.bulk_url, {'urls': urls}, format='json')
+
+        self.assertEqual(response.data['created'], 0)
+        self.assertEqual(DogImage.objects.filter(owner=self.user).count(), 101)
+
+    def test_bulk_create_rejects_oversized_batch(self):
+        with self.settings(DOG_BULK_MAX_ITEMS=2):
+            response = self.client.post(self.bulk_url, {'urls': ['https://a.com/1.jpg'] * 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_delete_only_touches_own_rows(self):
+        other = User.objects.create_user(username='other', password='password')
+        others_dog = DogImage.objects.create(owner=other, url='https://images.dog.ceo/old.jpg')
+
+        response = self.client.post(
+            self.bulk_delete_url, {'ids': [self.existing.id, others_dog.id, self.existing.id]}, format='json'
+        )
+
+        self.assertEqual(response.data['deleted'], 1)
+        self.assertEqual([item['status'] for item in response.data['results']], ['deleted', 'not_found', 'duplicate'])
+        self.assertTrue(DogImage.objects.filter(id=others_dog.id).exists())
+        self.assertFalse(DogImage.objects.filter(owner=self.user).exists())
+
+    def test_single_create_rejects_duplicate(self):
+        response = self.client.post(reverse('dogimage-list'), {'url': self.existing.url}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ConditionalGetTests(APITestCase):
+    """
+    收藏列表的 ETag / Last-Modified / 304 測試。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='etag', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('dogimage-list')
+        self.client.post(self.url, {'url': 'https://images.dog.ceo/1.jpg'}, format='json')
+
+    def test_unchanged_list_returns_304_without_reading_favorites(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertIn('Last-Modified', response)
+        self.assertIn('private', response['Cache-Control'])
+
+        # 只讀取版本號，不查詢也不序列化收藏
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_every_write_changes_the_etag(self):
+        etags = [self.client.get(self.url)['ETag']]
+
+        response = self.client.post(self.url, {'url': 'https://images.dog.ceo/2.jpg'}, format='json')
+        etags.append(self.client.get(self.url)['ETag'])
+        self.client.delete(reverse('dogimage-detail', args=[response.data['id']]))
+        etags.append(self.client.get(self.url)['ETag'])
+        self.client.post(reverse('dogimage-bulk-create'), {'urls': ['https://images.dog.ceo/3.jpg']}, format='json')
+        etags.append(self.client.get(self.url)['ETag'])
+        # 沒有任何變動的批次操作不會改變版本
+        self.client.post(reverse('dogimage-bulk-create'), {'urls': ['https://images.dog.ceo/3.jpg']}, format='json')
+        etags.append(self.client.get(self.url)['ETag'])
+
+        self.assertEqual(len(set(etags)), 4)
+        self.assertEqual(etags[-1], etags[-2])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etags[0])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_etag_depends_on_user_and_query(self):
+        etag = self.client.get(self.url)['ETag']
+        self.assertNotEqual(self.client.get(self.url, {'page_size': 1})['ETag'], etag)
+
+        other = User.objects.create_user(username='other', password='password')
+        self.client.force_authenticate(user=other)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [])
+
+
+class CachedTokenAuthTests(APITestCase):
+    """
+    快取 Token 驗證：命中時不查詢 token / user，登出、修改密碼與刪除帳號後立即失效。
+    """
+
+    def setUp(self):
+        token_user_cache.clear()
+        self.user = User.objects.create_user(username='cached', password='old-password-123')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.url = reverse('dogimage-list')
+        DataVersion.objects.bump(self.user.pk, DataVersion.FAVORITES)
+
+    def test_repeated_requests_skip_the_token_query(self):
+        # token JOIN user + 版本號 + 收藏
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_logout_invalidates_token(self):
+        self.client.get(self.url)
+        response = self.client.post('/api/auth/logout/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_password_change_and_deactivation_reload_user(self):
+        self.client.get(self.url)
+        response = self.client.post('/api/auth/password/change/', {
+            'new_password1': 'new-password-456', 'new_password2': 'new-password-456',
+        })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # 快取已清除：重新查詢 token / user
+        with self.assertNumQueries(3):
+            self.client.get(self.url)
+
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.user.refresh_from_db()
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_user_delete_invalidates_token(self):
+        self.client.get(self.url)
+        response = self.client.delete(reverse('user-delete'))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_shared_cache_is_used_across_processes(self):
+        with self.settings(
+            AUTH_TOKEN_CACHE_ALIAS='tokens',
+            CACHES={'tokens': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tokens'}},
+        ):
+            self.client.get(self.url)
+            token_user_cache.clear()  # 模擬另一個 process：本機 LRU 是空的，但共用快取有資料
+            with self.assertNumQueries(2):
+                self.client.get(self.url)
+
+            self.client.post('/api/auth/logout/')
+            token_user_cache.clear()
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class WriteQueueTests(TransactionTestCase):
+    """
+    寫入序列化 (api/db.py)：同時到達的寫入由 writer 執行緒合併 commit，單筆失敗不影響同一批的其他寫入。
+    使用 TransactionTestCase，writer 執行緒才看得到測試中建立的資料。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='writer', password='password')
+
+    @override_settings(DB_WRITE_BATCH_WAIT=0.05)
+    def test_concurrent_writes_are_grouped_and_isolated(self):
+        write_queue = WriteQueue(enabled=True)
+        results = {}
+
+        def add(i):
+            if i == 3:
+                raise ValueError('bad write')
+            return DogImage.objects.create(owner=self.user, url=f'https://images.dog.ceo/{i}.jpg').id
+
+        def submit(i):
+            try:
+                results[i] = write_queue.run(partial(add, i))
+            except ValueError as e:
+                results[i] = e
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsInstance(results[3], ValueError)
+        self.assertEqual(DogImage.objects.count(), 9)
+        self.assertEqual(write_queue.jobs, 10)
+        self.assertLess(write_queue.batches, 10)
+
+    def test_disabled_queue_runs_inline_in_a_transaction(self):
+        write_queue = WriteQueue(enabled=False)
+        with self.assertRaises(ZeroDivisionError):
+            write_queue.run(lambda: (DogImage.objects.create(owner=self.user, url='https://a.com/1.jpg'), 1 / 0))
+        self.assertFalse(DogImage.objects.exists())
+        self.assertEqual(write_queue.batches, 0)
+
+    def test_benchmark_command_reports_every_profile(self):
+        # 指令會動態註冊暫存資料庫的連線，測試框架不允許在測試中這麼做，因此以子 process 執行
+        completed = subprocess.run(
+            [sys.executable, 'manage.py', 'benchmark_sqlite_writes', '--writers', '4', '--writes', '3', '--json'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        )
+        results = json.loads(completed.stdout)
+        self.assertEqual([r['profile'] for r in results], ['default', 'wal', 'wal-batched'])
+        for result in results:
+            self.assertEqual(result['ok'] + result['errors'], 12)
+            self.assertEqual(result['rows'], result['ok'] * 2)
+
+
+class RequestTimingTests(APITestCase):
+    """針對請求耗時 middleware (Server-Timing)、/metrics 與慢請求紀錄的測試。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='timing', password='password')
+        self.client.force_authenticate(user=self.user)
+        DogImage.objects.create(url='https://images.dog.ceo/breeds/husky/1.jpg', owner=self.user)
+        DataVersion.objects.bump(self.user.pk, DataVersion.FAVORITES)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_server_timing_reports_db_time_and_queries(self):
+        response = self.client.get(reverse('dogimage-list'))
+
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="2 queries", total;dur=[\d.]+$')
+
+    def test_metrics_endpoint_renders_histograms(self):
+        self.client.get(reverse('dogimage-list'))
+
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode('utf-8')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertRegex(body, r'http_request_duration_seconds_count\{method="GET",route="[^"]*dogs[^"]*",status="200"\} 1')
+        self.assertRegex(body, r'http_request_db_queries_bucket\{method="GET",route="[^"]*dogs[^"]*",le="2"\} 1')
+        self.assertRegex(body, r'http_request_phase_duration_seconds_count\{[^}]*phase="db"\} 1')
+
+    def test_metrics_access_is_restricted(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.8').status_code, 403)
+        with override_settings(METRICS_TOKEN='scrape-secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-secret')
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD=0, SLOW_REQUEST_PROFILE=True)
+    def test_slow_request_is_logged_with_profile(self):
+        with self.assertLogs('api.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('dogimage-list'))
+
+        self.assertIn('GET /api/dogs/', logs.output[0])
+        self.assertIn('db=', logs.output[0])
+        self.assertIn('function calls', logs.output[0])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram('demo_seconds', 'demo', ('route',), (0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, route='a"b')
+
+        lines = histogram.collect()
+
+        self.assertIn('demo_seconds_bucket{route="a\\"b",le="0.1"} 1', lines)
+        self.assertIn('demo_seconds_bucket{route="a\\"b",le="1"} 2', lines)
+        self.assertIn('demo_seconds_bucket{route="a\\"b",le="+Inf"} 3', lines)
+        self.assertIn('demo_seconds_count{route="a\\"b"} 3', lines)
+
+
+class ThumbnailTests(APITestCase):
+    """針對收藏圖片縮圖代理 (api/thumbnails.py) 的測試。原圖下載以 mock 取代。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='thumbs', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        self.dog = DogImage.objects.create(url=self.url, owner=self.user)
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(THUMBNAIL_CACHE_DIR=Path(tmp)))
+        self.source = self.enterContext(mock.patch('api.thumbnails.image_cache.get', return_value=CachedImage(
+            url=self.url, sha256='0' * 64, content=make_jpeg(1200, 800), content_type='image/jpeg',
+        )))
+
+    def thumbnail_base(self):
+        response = self.client.get(reverse('dogimage-detail', args=[self.dog.id]))
+        return response.data['thumbnail_url']
+
+    def test_rendition_is_resized_and_cached(self):
+        base = self.thumbnail_base()
+        self.client.logout()  # <img> 不會帶 Token，只靠網址中的簽章
+
+        response = self.client.get(base + '320.webp')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        with Image.open(io.BytesIO(response.content)) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 213)))
+
+        # 第二次直接讀磁碟快取，不再取得原圖
+        again = self.client.get(base + '320.webp')
+        self.assertEqual(again.content, response.content)
+        self.assertEqual(self.source.call_count, 1)
+
+        jpeg = self.client.get(base + '160.jpg')
+        self.assertEqual(jpeg['Content-Type'], 'image/jpeg')
+        self.assertLess(len(jpeg.content), len(self.source.return_value.content) // 10)
+
+    def test_thumbnail_url_is_stable(self):
+        """測試情境：同一張圖片在不同時間產生的縮圖網址必須相同，immutable 的瀏覽器/CDN 快取才有效。"""
+        first = thumbnails.thumbnail_url(self.url)
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            second = thumbnails.thumbnail_url(self.url)
+
+        self.assertEqual(first, second)
+
+    def test_invalid_requests_return_404(self):
+        base = self.thumbnail_base()
+        self.assertEqual(self.client.get(base + '333.webp').status_code, 404)
+        self.assertEqual(self.client.get(base + '320.gif').status_code, 404)
+        self.assertEqual(self.client.get(base[:-3] + 'xx/320.webp').status_code, 404)
+
+        # 簽章正確但主機不在允許清單中 (例如設定變更後) 也不代理
+        with override_settings(THUMBNAIL_ALLOWED_HOSTS=[]):
+            self.assertEqual(self.client.get(base + '320.webp').status_code, 404)
+        self.source.assert_not_called()
+
+    def test_unsupported_host_has_no_thumbnail(self):
+        other = DogImage.objects.create(url='http://127.0.0.1:8000/internal.jpg', owner=self.user)
+        response = self.client.get(reverse('dogimage-detail', args=[other.id]))
+        self.assertIsNone(response.data['thumbnail_url'])
+
+    def test_undecodable_source_returns_502(self):
+        self.source.return_value = CachedImage(url=self.url, sha256='1' * 64, content=b'not an image',
+                                               content_type='image/jpeg')
+        with self.assertLogs('api.views', 'WARNING'):
+            response = self.client.get(self.thumbnail_base() + '320.jpg')
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+
+    def test_cache_evicts_least_recently_used(self):
+        base = self.thumbnail_base()
+        with override_settings(THUMBNAIL_CACHE_MAX_BYTES=1):
+            self.client.get(base + '160.webp')
+            self.client.get(base + '320.webp')
+        self.assertLessEqual(len(list(thumbnails.rendition_cache.root.glob('*/*'))), 1)
+
+
+def make_jpeg(width, height):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 150, 100)).save(output, 'JPEG', quality=95)
+    return output.getvalue()
+
+
+class _RandomDogSource(BaseHTTPRequestHandler):
+    """隨機狗狗來源的本機替身：/random 回傳 dog.ceo 格式的一批網址，其他路徑回傳圖片。"""
+    batch = 3
+    counter = 0
+    image_requests = 0
+
+    def do_GET(self):
+        cls = type(self)
+        base = f'http://127.0.0.1:{self.server.server_port}'
+        if self.path == '/random':
+            urls = [f'{base}/breeds/husky/{cls.counter + i}.jpg' for i in range(cls.batch)] + [f'{base}/missing.jpg']
+            cls.counter += cls.batch
+            body, content_type, code = json.dumps({'message': urls, 'status': 'success'}).encode(), 'application/json', 200
+        elif self.path == '/down':
+            body, content_type, code = b'', 'text/plain', 503
+        elif self.path == '/missing.jpg':
+            body, content_type, code = b'', 'text/plain', 404
+        else:
+            cls.image_requests += 1
+            body, content_type, code = make_jpeg(32, 32), 'image/jpeg', 200
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RandomDogPoolTests(APITestCase):
+    """針對伺服器端隨機狗狗池 (api/random_dogs.py) 的測試，來源與圖片都由本機替身伺服器提供。"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _RandomDogSource)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(
+            CHAT_IMAGE_CACHE_DIR=Path(tmp),
+            THUMBNAIL_CACHE_DIR=Path(tmp) / 'thumbnails',
+            RANDOM_DOG_SOURCE_URL=f'{self.base_url}/random',
+            RANDOM_DOG_POOL_SIZE=5,
+            RANDOM_DOG_POOL_LOW_WATER=2,
+        ))
+        self.pool = RandomDogPool()
+        self.enterContext(mock.patch('api.views.random_dog_pool', self.pool))
+        self.addCleanup(self.pool.wait)
+        _RandomDogSource.image_requests = 0
+
+    def test_refill_warms_images_and_skips_broken_ones(self):
+        self.pool.refill()
+
+        self.assertEqual(len(self.pool), 5)
+        self.assertEqual(_RandomDogSource.image_requests, 5)
+        url = self.pool.take()
+        self.assertNotIn('missing', url)
+        # 圖片已經在本機快取中，不會再向來源下載
+        image_cache.get(url)
+        self.assertEqual(_RandomDogSource.image_requests, 5)
+
+    def test_endpoint_serves_from_pool_without_login(self):
+        # 池是空的：直接向來源要一個網址，並在背景補充
+        first = self.client.get(reverse('dogimage-random'))
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertEqual(first['Cache-Control'], 'no-store')
+        self.assertEqual(self.pool.misses, 1)
+
+        self.pool.wait()
+        self.assertEqual(len(self.pool), 5)
+
+        second = self.client.get(reverse('dogimage-random'))
+        self.assertEqual(self.pool.served, 1)
+        self.assertNotEqual(second.data['url'], first.data['url'])
+        self.assertIsNone(second.data['display_url'])  # 本機替身不在縮圖的允許清單中
+
+    @override_settings(THUMBNAIL_ALLOWED_HOSTS=['127.0.0.1'])
+    def test_display_thumbnail_is_prerendered(self):
+        self.pool.refill()
+        self.assertEqual(_RandomDogSource.image_requests, 5)
+
+        response = self.client.get(reverse('dogimage-random'))
+        display_url = response.data['display_url']
+        self.assertTrue(display_url.endswith('/640.webp'))
+
+        # 瀏覽器向本站載入縮圖：已經預先產生，不會再向來源下載
+        thumbnail = self.client.get(display_url)
+        self.assertEqual(thumbnail.status_code, status.HTTP_200_OK)
+        self.assertEqual(thumbnail['Content-Type'], 'image/webp')
+        self.assertEqual(_RandomDogSource.image_requests, 5)
+
+    def test_source_failure_returns_502(self):
+        with override_settings(RANDOM_DOG_SOURCE_URL=f'{self.base_url}/down'), \
+                self.assertLogs('api', 'WARNING') as logs:
+            response = self.client.get(reverse('dogimage-random'))
+            self.pool.wait()
+
+        self.assertEqual(response.status_code, status.HTTP_502_BAD_GATEWAY)
+        self.assertTrue(any('refill failed' in line for line in logs.output))
+
+
+@override_settings(DATA_PURGE_BATCH_PAUSE=0)
+class DataPurgeTests(APITestCase):
+    """
+    針對刪除帳號 / 刪除全部對話的背景清除 (api/purge.py) 的測試：
+    請求中只標記並立即隱藏，資料由 run_pending 分批刪除 (測試中背景執行緒不會啟動，on_commit 不執行)。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='purge', password='password', email='purge@example.com')
+        self.other = User.objects.create_user(username='other', password='password')
+        self.client.force_authenticate(user=self.user)
+        for owner in (self.user, self.other):
+            for i in range(3):
+                session = ChatSession.objects.create(user=owner, image_url=f'https://images.dog.ceo/{i}.jpg')
+                for role in ('user', 'model', 'user', 'model'):
+                    ChatMessage.objects.create(session=session, role=role, content='汪')
+                ChatSession.objects.filter(pk=session.pk).update(message_count=4)
+                DogImage.objects.create(owner=owner, url=f'https://images.dog.ceo/{i}.jpg')
+        self.job = ChatJob.objects.create(session=ChatSession.objects.filter(user=self.user).first(), prompt='品種？')
+
+    def test_chat_purge_hides_immediately_then_deletes_in_batches(self):
+        response = self.client.delete(reverse('chat-ask'), format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response['Location'], reverse('data-purge', args=[response.data['purge_id']]))
+        # 已經查不到，但資料還在；尚未執行的背景工作不會再呼叫 Gemini
+        self.assertFalse(ChatSession.objects.filter(user=self.user).exists())
+        self.assertEqual(ChatMessage.objects.filter(session__user=self.user).count(), 12)
+        self.job.refresh_from_db()
+        self.assertEqual(self.job.status, 'failed')
+        self.assertEqual(self.client.get(reverse('chat-ask')).data['results'], [])
+        # 同一張圖片可以立即開始新的對話 (舊的 Session 不佔用唯一鍵)
+        fresh = ChatSession.objects.create(user=self.user, image_url='https://images.dog.ceo/0.jpg')
+
+        progress = self.client.get(response['Location']).data
+        self.assertEqual((progress['status'], progress['total'], progress['progress']), ('pending', 16, 0.0))
+
+        with mock.patch('api.purge.delete_batch', wraps=purge.delete_batch) as delete_batch:
+            self.assertEqual(purge.run_pending(size=5), 1)
+        # 訊息 3 批 + 工作 1 批 + Session 1 批，每一步最後再確認一次沒有剩下的資料
+        self.assertEqual(delete_batch.call_count, 8)
+
+        progress = self.client.get(response['Location']).data
+        self.assertEqual((progress['status'], progress['deleted'], progress['progress']), ('done', 16, 1.0))
+        self.assertEqual(list(ChatSession.all_objects.filter(user=self.user)), [fresh])
+        self.assertEqual(ChatMessage.objects.filter(session__user=self.other).count(), 12)
+        self.assertEqual(DogImage.objects.filter(owner=self.user).count(), 3)
+
+    def test_account_purge_deactivates_then_deletes_everything(self):
+        response = self.client.delete(reverse('user-delete'))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.is_active)
+        # 使用者名稱與 Email 立即釋出
+        User.objects.create_user(username='purge', password='password', email='purge@example.com')
+        self.assertEqual(DogImage.objects.filter(owner=self.user).count(), 3)
+
+        purge.run_pending(size=2)
+
+        job = DataPurge.objects.get(user_pk=self.user.pk)
+        self.assertEqual((job.kind, job.status, job.progress), (DataPurge.ACCOUNT, 'done', 1.0))
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertFalse(ChatSession.all_objects.filter(user_id=self.user.pk).exists())
+        self.assertFalse(DogImage.objects.filter(owner_id=self.user.pk).exists())
+        self.assertEqual(DogImage.objects.filter(owner=self.other).count(), 3)
+        self.assertEqual(ChatSession.objects.filter(user=self.other).count(), 3)
+
+    def test_progress_is_private_and_stale_purges_are_resumed(self):
+        stale = DataPurge.objects.create(user_pk=self.other.pk, kind=DataPurge.CHAT, status='running')
+        ChatSession.objects.filter(user=self.other).update(deleted_at=timezone.now())
+        self.assertEqual(self.client.get(reverse('data-purge', args=[stale.pk])).status_code, status.HTTP_404_NOT_FOUND)
+
+        # 執行中的清除還有進度時不會被接手，太久沒有進度 (process 已中止) 才會
+        self.assertIsNone(purge.claim())
+        DataPurge.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+        call_command('purge_deleted_data', stdout=io.StringIO())
+
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'done')
+        self.assertFalse(ChatSession.all_objects.filter(user=self.other).exists())
+
+
+class FavoriteUniqueMigrationTests(TransactionTestCase):
+    """0003_dogimage_owner_url_unique 建立唯一條件前會刪除重複的收藏，並記錄刪除的筆數。"""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('api', target)])
+        return executor.loader.project_state([('api', target)]).apps
+
+    def test_duplicate_favorites_are_removed_and_logged(self):
+        old = self.migrate('0002_dogimage_owner_created_idx')
+        user = old.get_model('auth', 'User').objects.create(username='legacy')
+        OldDogImage = old.get_model('api', 'DogImage')
+        first = OldDogImage.objects.create(owner_id=user.pk, url='https://images.dog.ceo/a.jpg')
+        duplicate = OldDogImage.objects.create(owner_id=user.pk, url='https://images.dog.ceo/a.jpg')
+        other = OldDogImage.objects.create(owner_id=user.pk, url='https://images.dog.ceo/b.jpg')
+
+        with self.assertLogs('api.migrations.0003_dogimage_owner_url_unique', 'WARNING') as logs:
+            self.migrate('0003_dogimage_owner_url_unique')
+        # 回到最新的 schema，後續的測試使用完整的資料表
+        self.migrate(MigrationLoader(connection).graph.leaf_nodes('api')[0][1])
+
+        self.assertIn('刪除 1 筆重複的收藏', logs.output[0])
+        self.assertIn(str(duplicate.pk), logs.output[0])
+        self.assertEqual(set(DogImage.objects.values_list('pk', flat=True)), {first.pk, other.pk})
@@ -0,0 +1,170 @@
+"""
+收藏圖片的縮圖代理 (Thumbnail Proxy) 與磁碟縮圖快取。
+
+收藏列表的卡片只有幾百像素寬，直接載入 dog.ceo 的原圖會多下載好幾倍的位元組。這裡由後端產生縮圖：
+
+1. 簽章網址：收藏的序列化結果帶有 thumbnail_url (/api/thumbnails/<簽章>/)，簽章內容就是圖片網址。
+   <img> 無法帶 Authorization 標頭，因此以簽章取代驗證：只有伺服器簽過的網址才能取得縮圖，
+   也只接受 THUMBNAIL_ALLOWED_HOSTS 中的主機，不會變成任意網址的代理。
+2. 固定規格：前端在後面加上 <寬度>.<格式> (例如 320.webp)，寬度只能是 THUMBNAIL_WIDTHS 之一，
+   格式為 webp 或 jpg，快取的組合數因此是有限的。
+3. 縮圖依網址雜湊 + 規格存放在 THUMBNAIL_CACHE_DIR，命中時不必讀取原圖；
+   未命中時才透過 chat.image_cache 取得原圖 (下載、重新驗證與磁碟快取)，JPEG 以 draft 模式縮小解碼。
+   總容量超過 THUMBNAIL_CACHE_MAX_BYTES 時依最後存取時間淘汰。
+4. 同一個網址的縮圖內容不會改變，回應帶 Cache-Control: public, max-age=一年, immutable，
+   瀏覽器與 CDN 之後都不必再詢問伺服器。
+"""
+import io
+import os
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+from chat.image_cache import atomic_write, image_cache, url_key
+
+SIGNING_SALT = 'api.thumbnails'
+MAX_AGE = 365 * 24 * 60 * 60  # 縮圖回應的快取期限 (一年)
+
+# 網址中的副檔名 -> (Pillow 格式, Content-Type)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+
+class InvalidThumbnail(Exception):
+    """簽章錯誤、規格不支援或主機不在允許清單中 (一律以 404 回應)。"""
+
+
+class SourceImageError(Exception):
+    """原圖無法解碼 (不是圖片、格式不支援或尺寸過大)。"""
+
+
+def widths():
+    return tuple(getattr(settings, 'THUMBNAIL_WIDTHS', (160, 320, 640)))
+
+
+def is_allowed(url):
+    host = urlsplit(url).hostname or ''
+    return urlsplit(url).scheme in ('http', 'https') and host in getattr(settings, 'THUMBNAIL_ALLOWED_HOSTS', ())
+
+
+def thumbnail_url(url):
+    """收藏圖片的縮圖網址前綴 (不含 <寬度>.<格式>)；主機不在允許清單中時回傳 None，前端改用原圖。"""
+    if not is_allowed(url):
+        return None
+    # 不帶時間戳記 (signing.dumps 會帶)：同一張圖片的網址固定不變，瀏覽器與 CDN 的快取 (immutable) 才能重複使用
+    token = signing.Signer(salt=SIGNING_SALT).sign_object(url, compress=True)
+    # 只回傳到簽章為止的前綴，由前端接上 <寬度>.<格式>
+    return reverse('dog-thumbnail', args=[token, 1, 'jpg']).removesuffix('1.jpg')
+
+
+def unsign(token):
+    try:
+        url = signing.Signer(salt=SIGNING_SALT).unsign_object(token)
+    except signing.BadSignature:
+        raise InvalidThumbnail('簽章無效')
+    if not is_allowed(url):
+        raise InvalidThumbnail('不允許的圖片來源')
+    return url
+
+
+def render(content, width, fmt):
+    """把原圖縮到指定寬度 (不放大)，回傳編碼後的位元組。"""
+    pil_format, _ = FORMATS[fmt]
+    quality = getattr(settings, 'THUMBNAIL_QUALITY', 80)
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            return _render(image, width, pil_format, quality)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise SourceImageError(f'無法處理原圖: {e}') from e
+
+
+def _render(image, width, pil_format, quality):
+    if image.format == 'JPEG' and image.width > width:
+        # 以 DCT 縮放直接解碼成接近目標的尺寸，不必先解出整張原圖
+        # 兩個邊都至少保留目標寬度，EXIF 旋轉 90 度後仍然足夠
+        image.draft('RGB', (width, width))
+    image = ImageOps.exif_transpose(image)
+    if image.width > width:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.Resampling.LANCZOS)
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif pil_format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    output = io.BytesIO()
+    if pil_format == 'JPEG':
+        image.save(output, pil_format, quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(output, pil_format, quality=quality, method=4)
+    return output.getvalue()
+
+
+class RenditionCache:
+    """
+    縮圖的磁碟快取：依 (網址雜湊, 寬度, 格式) 存放；同一個網址的縮圖視為不會改變，因此不需要重新驗證。
+    與 chat.image_cache 相同，以 mtime 作為最後存取時間，超過容量上限時由舊到新刪除。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return Path(getattr(settings, 'THUMBNAIL_CACHE_DIR', settings.BASE_DIR / '.cache' / 'thumbnails'))
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'THUMBNAIL_CACHE_MAX_BYTES', 128 * 1024 * 1024)
+
+    def _path(self, url, width, fmt):
+        key = url_key(url)
+        return self.root / key[:2] / f'{key}-{width}.{fmt}'
+
+    def get(self, url, width, fmt):
+        """
+        回傳 (縮圖位元組, Content-Type)。
+        原圖下載失敗時拋出 chat.fetch.FetchError，無法解碼時拋出 SourceImageError。
+        """
+        if width not in widths() or fmt not in FORMATS:
+            raise InvalidThumbnail('不支援的縮圖規格')
+        path = self._path(url, width, fmt)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            data = render(image_cache.get(url).content, width, fmt)
+            atomic_write(path, data)
+            self.evict()
+        return data, FORMATS[fmt][1]
+
+    def evict(self):
+        with self._lock:
+            files = []
+            total = 0
+            for path in self.root.glob('*/*'):
+                if path.name.startswith('.tmp-'):
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+rendition_cache = RenditionCache()
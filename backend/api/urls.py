@@ -11,7 +11,7 @@ API 根索引：DefaultRouter 會額外提供一個自動生成的 API Root 頁
 """
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import DogImageViewSet, UserDeleteView
+from .views import DataPurgeView, DogImageViewSet, UserDeleteView, thumbnail_view
 
 # 初始化一個 DRF 的路由器 (Router)，用於自動生成 API 路由。
 router = DefaultRouter()
@@ -33,4 +33,10 @@ urlpatterns = [
     
     # 使用者刪除帳號的路由
     path('auth/user/delete/', UserDeleteView.as_view(), name='user-delete'),
+
+    # 刪除全部對話後的背景清除進度，對應 /api/purges/<id>/
+    path('purges/<int:pk>/', DataPurgeView.as_view(), name='data-purge'),
+
+    # 收藏圖片的縮圖：<簽章>/<寬度>.<格式>，例如 /api/thumbnails/<token>/320.webp
+    path('thumbnails/<str:token>/<int:width>.<str:fmt>', thumbnail_view, name='dog-thumbnail'),
 ]
\ No newline at end of file
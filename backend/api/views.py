@@ -6,19 +6,39 @@
 3.宣告式關聯：透過 serializer_class 綁定先前的序列化器，讓 ViewSet 知道如何處理資料的輸入驗證與輸出轉換。
 """
 from rest_framework import viewsets, permissions  # 新增 permissions
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
-from rest_framework import viewsets
-from .models import DogImage
-from .serializers import DogImageSerializer
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.http import require_GET
+from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.response import Response
+import logging
+from chat.fetch import FetchError
+from . import conditional, metrics, purge, random_dogs, thumbnails
+from .db import serialized_write
+from .bulk import bulk_add, bulk_remove
+from .models import DataPurge, DataVersion, DogImage
+from .pagination import KeysetPagination
+from .random_dogs import random_dog_pool
+from .serializers import (
+    DataPurgeSerializer, DogImageSerializer, DogBulkCreateSerializer, DogBulkDeleteSerializer, DogBulkResultSerializer,
+)
 # 匯入 drf-spectacular 的文件工具
-from drf_spectacular.utils import extend_schema, extend_schema_view
+from drf_spectacular.utils import extend_schema, extend_schema_view, inline_serializer
+from rest_framework import serializers
+
+logger = logging.getLogger(__name__)
 
 # 使用裝飾器為 ViewSet 的各種動作添加「中文說明」，貼在目標函式的頭上即可
 @extend_schema_view(
     # list: 對應 GET /api/dogs/ (取得清單)
     list=extend_schema(
         summary="取得圖片收藏列表",
-        description="回傳所有已收藏的狗狗圖片資料。列表會依照建立時間由新到舊排序，最新的在最上面。"
+        description="回傳已收藏的狗狗圖片資料。列表會依照建立時間由新到舊排序，最新的在最上面。"
+                    "結果以游標分頁：回應中的 next 為下一頁網址，null 代表已經到底；可用 page_size 調整每頁筆數。"
+                    "回應帶有 ETag / Last-Modified，收藏沒有變動時以 If-None-Match 重新請求會得到 304。"
     ),
     # create: 對應 POST /api/dogs/ (新增)
     create=extend_schema(
@@ -58,13 +78,96 @@ class DogImageViewSet(viewsets.ModelViewSet):
     # 1. 加上警衛：只有登入的使用者才能存取
     permission_classes = [permissions.IsAuthenticated]
 
+    # 以 (created_at, id) 游標分頁，收藏再多也只讀取一頁的資料
+    pagination_class = KeysetPagination
+
     # 2. 過濾視野：只回傳「我是主人」的圖片
     def get_queryset(self):
-        return DogImage.objects.filter(owner=self.request.user).order_by('-created_at')
+        # select_related：序列化 owner.username 時不必每筆再查一次使用者
+        return DogImage.objects.filter(owner=self.request.user).select_related('owner').order_by('-created_at', '-id')
 
     # 3. 自動標記：存檔時，自動把 owner 填成目前登入的使用者
+    # 每次寫入都在同一個交易中遞增收藏的版本號，讓列表的 ETag 跟著改變
+    # serialized_write 等同 transaction.atomic；SQLite 高併發模式下改由 writer 執行緒合併 commit (見 api/db.py)
+    @serialized_write
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
+        DataVersion.objects.bump(self.request.user.pk, DataVersion.FAVORITES)
+
+    @serialized_write
+    def perform_update(self, serializer):
+        serializer.save()
+        DataVersion.objects.bump(self.request.user.pk, DataVersion.FAVORITES)
+
+    @serialized_write
+    def perform_destroy(self, instance):
+        instance.delete()
+        DataVersion.objects.bump(self.request.user.pk, DataVersion.FAVORITES)
+
+    # 條件式 GET：收藏沒有變動時直接回傳 304，不查詢也不序列化 (見 api/conditional.py)
+    def list(self, request, *args, **kwargs):
+        validators = conditional.validators(request, DataVersion.FAVORITES)
+        return validators.not_modified(request) or validators.apply(super().list(request, *args, **kwargs))
+
+    # 隨機狗狗：從後端預先下載好圖片的網址池中取出一個 (見 api/random_dogs.py)，不需要登入
+    @extend_schema(
+        summary="取得一張隨機狗狗圖片",
+        description="從伺服器的隨機圖片池取出一個圖片網址 (收藏與發問使用)。"
+                    "display_url 為顯示用的縮圖網址，縮圖已預先產生在伺服器的快取中；來源不支援縮圖時為 null，改用原圖。",
+        responses={
+            200: inline_serializer('RandomDogResponse', {
+                'url': serializers.URLField(),
+                'display_url': serializers.CharField(allow_null=True),
+            }),
+            502: None,
+        },
+    )
+    @action(detail=False, methods=['get'], url_path='random', permission_classes=[permissions.AllowAny],
+            pagination_class=None)
+    def random(self, request):
+        try:
+            url = random_dog_pool.take()
+        except FetchError as e:
+            logger.warning(f"Random dog source failed: {e}")
+            return Response({'error': '無法取得隨機圖片，請稍後再試。'}, status=status.HTTP_502_BAD_GATEWAY)
+        response = Response({'url': url, 'display_url': random_dogs.display_url(url)})
+        # 每次都是不同的圖片，不可被快取
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    # 4. 批次操作：一次請求處理數百筆，整批在同一個交易中完成 (見 api/bulk.py)
+    @extend_schema(
+        summary="批次收藏圖片",
+        description="一次收藏多張圖片 (上限 DOG_BULK_MAX_ITEMS 筆)。已收藏過或同一批中重複的網址會被略過，"
+                    "格式錯誤的網址不影響其他項目；回傳逐筆結果，重送同一批也不會產生重複資料。",
+        request=DogBulkCreateSerializer,
+        responses=inline_serializer('DogBulkCreateResponse', {
+            'created': serializers.IntegerField(),
+            'results': DogBulkResultSerializer(many=True),
+        }),
+    )
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_create(self, request):
+        serializer = DogBulkCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        created, results = bulk_add(request.user, serializer.validated_data['urls'])
+        return Response({'created': created, 'results': results}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        summary="批次移除收藏",
+        description="一次刪除多筆收藏 (上限 DOG_BULK_MAX_ITEMS 筆)。只會刪除自己的收藏，找不到的 id 會在結果中標記為 not_found。",
+        request=DogBulkDeleteSerializer,
+        responses=inline_serializer('DogBulkDeleteResponse', {
+            'deleted': serializers.IntegerField(),
+            'results': DogBulkResultSerializer(many=True),
+        }),
+    )
+    @action(detail=False, methods=['post'], url_path='bulk-delete')
+    def bulk_delete(self, request):
+        serializer = DogBulkDeleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        deleted, results = bulk_remove(request.user, serializer.validated_data['ids'])
+        return Response({'deleted': deleted, 'results': results}, status=status.HTTP_200_OK)
 
 # 使用者刪除帳號的 View
 # 使用 generics.DestroyAPIView，這是 DRF 專門用來處理「刪除」動作的通用視圖
@@ -72,7 +175,8 @@ from rest_framework import generics
 
 @extend_schema(
     summary="刪除使用者帳號",
-    description="永久刪除當前登入使用者的帳號及所有相關資料 (例如收藏的圖片)。此動作無法復原。",
+    description="永久刪除當前登入使用者的帳號及所有相關資料 (例如收藏的圖片)。此動作無法復原。"
+                "帳號會立即停用 (Token 失效、使用者名稱可重新註冊)，資料則在背景分批清除。",
     responses={204: None}
 )
 class UserDeleteView(generics.DestroyAPIView):
@@ -81,4 +185,52 @@ class UserDeleteView(generics.DestroyAPIView):
     # 覆寫 get_object，不需從 URL 讀取 ID，直接回傳「當前登入的使用者」
     # 這樣可以確保使用者只能刪除「自己」的帳號
     def get_object(self):
-        return self.request.user
\ No newline at end of file
+        return self.request.user
+
+    # 不在請求中連帶刪除所有資料：只停用帳號並排入背景清除 (見 api/purge.py)
+    def perform_destroy(self, instance):
+        purge.delete_account(instance)
+
+
+@extend_schema(summary="查詢背景清除進度", responses={200: DataPurgeSerializer})
+class DataPurgeView(generics.RetrieveAPIView):
+    """刪除全部對話後回傳的清除工作 (只能查詢自己的)。"""
+    permission_classes = [permissions.IsAuthenticated]
+    serializer_class = DataPurgeSerializer
+
+    def get_queryset(self):
+        return DataPurge.objects.filter(user_pk=self.request.user.pk)
+
+
+# Prometheus 指標 (不屬於 REST API，因此用一般的 Django view，也不出現在 API 文件中)
+def metrics_allowed(request):
+    """設定 METRICS_TOKEN 時比對 Bearer token，否則只允許 METRICS_ALLOWED_IPS 中的來源。"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        scheme, _, value = request.headers.get('Authorization', '').partition(' ')
+        return scheme.lower() == 'bearer' and constant_time_compare(value.strip(), token)
+    return request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ())
+
+
+@require_GET
+def metrics_view(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# 收藏圖片的縮圖 (<img> 無法帶 Token，改以網址中的簽章驗證，見 api/thumbnails.py)
+@require_GET
+def thumbnail_view(request, token, width, fmt):
+    try:
+        url = thumbnails.unsign(token)
+        data, content_type = thumbnails.rendition_cache.get(url, width, fmt)
+    except thumbnails.InvalidThumbnail:
+        raise Http404('找不到縮圖')
+    except (FetchError, thumbnails.SourceImageError) as e:
+        logger.warning(f"Thumbnail failed for {width}.{fmt}: {e}")
+        return HttpResponse('無法取得原圖', status=502, content_type='text/plain; charset=utf-8')
+    response = HttpResponse(data, content_type=content_type)
+    # 網址 (簽章 + 規格) 對應的內容不會改變
+    response['Cache-Control'] = f'public, max-age={thumbnails.MAX_AGE}, immutable'
+    return response
@@ -0,0 +1,316 @@
+"""
+Gemini 呼叫的流量控制 (Admission Control)。
+
+原本發問一律直接呼叫 Gemini：單一使用者可以連續送出大量發問耗盡配額，Gemini 回傳 429 時也只是把錯誤轉給使用者。
+這裡分成兩層，讓短暫的超量變成幾秒的排隊，而不是失敗：
+
+1. 每位使用者的 token bucket (ChatAskThrottle，DRF throttle)：
+   每分鐘 CHAT_ASK_RATE 次，可累積 CHAT_ASK_BURST 次的額度。額度用完時，
+   async 版本 (AsyncChatView) 若下一個額度在 CHAT_ASK_MAX_DELAY 秒內就會出現，請求先以 asyncio.sleep 等待再處理，
+   再更多才回傳 429 與 Retry-After；同步版本等待會佔住整個 worker 執行緒，因此一律直接回傳 429 與 Retry-After。
+2. 全域的 Gemini 同時呼叫上限 (ConcurrencyGate)：
+   同時最多 CHAT_AI_MAX_CONCURRENCY 個呼叫，其餘依序在佇列中等待 (最多 CHAT_AI_MAX_QUEUE 個、
+   最久 CHAT_AI_QUEUE_TIMEOUT 秒)；佇列已滿或等待逾時才回傳 503 (Overloaded)。
+3. 配額感知的退讓：Gemini 回傳 429 時，有效上限減半 (最少 1)，並暫停放行 CHAT_AI_BACKOFF_SECONDS 秒；
+   之後每次成功的呼叫讓上限加 1，直到回到設定值 (AIMD)。
+
+等待的時間計入請求的 queue 階段 (api.metrics)，可在 Server-Timing 與 /metrics 看到。
+兩者的狀態都只存在目前的 process，多個 worker 時每個 worker 各自計算 (總上限為 worker 數 × 設定值)。
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+from google.genai import errors
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+from api import metrics
+
+ASYNC_POLL_INTERVAL = 0.02  # async 呼叫在佇列中等待時檢查名額的間隔 (秒)
+
+
+def is_quota_error(e):
+    """Gemini 的配額用盡錯誤 (429 Resource Exhausted)。"""
+    return isinstance(e, errors.ClientError) and (getattr(e, 'code', None) == 429 or '429' in str(e))
+
+
+class AskThrottled(APIException):
+    """發問太頻繁 (429)；內容與其他對話錯誤相同使用 error 欄位，DRF 會依 wait 加上 Retry-After。"""
+    status_code = status.HTTP_429_TOO_MANY_REQUESTS
+
+    def __init__(self, wait):
+        self.wait = max(1, math.ceil(wait))
+        super().__init__({'error': f'發問太頻繁，請在 {self.wait} 秒後再試。'})
+
+
+class Overloaded(Exception):
+    """Gemini 呼叫的等待佇列已滿或等待逾時 (503)。"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# =========================================
+# 每位使用者的 token bucket
+# =========================================
+
+class TokenBuckets:
+    """
+    以 GCRA 實作的 token bucket：每個使用者只記錄「理論到達時間」(tat)，不需要定期補充額度。
+    最多記錄 CHAT_ASK_MAX_ENTRIES 位使用者 (LRU 淘汰；被淘汰等同額度已補滿)。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tat = OrderedDict()
+
+    # --- 設定 ---
+    @property
+    def rate(self):
+        return getattr(settings, 'CHAT_ASK_RATE', 10)
+
+    @property
+    def burst(self):
+        return getattr(settings, 'CHAT_ASK_BURST', 5)
+
+    @property
+    def max_delay(self):
+        return getattr(settings, 'CHAT_ASK_MAX_DELAY', 3)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'CHAT_ASK_MAX_ENTRIES', 10000)
+
+    def reserve(self, key, max_delay=None):
+        """
+        預約一次發問，回傳 (是否允許, 秒數)：
+        允許時秒數為處理前需要等待的時間 (通常是 0)；拒絕時為建議的 Retry-After，且不佔用額度。
+        max_delay 為可接受的最長等待秒數 (預設 CHAT_ASK_MAX_DELAY)，0 表示額度用完就拒絕。
+        """
+        if not self.rate:
+            return True, 0.0
+        if max_delay is None:
+            max_delay = self.max_delay
+        interval = 60 / self.rate
+        now = time.monotonic()
+        with self._lock:
+            tat = max(self._tat.get(key, now), now) + interval
+            delay = tat - now - self.burst * interval
+            if delay > max_delay:
+                return False, delay - max_delay
+            self._tat[key] = tat
+            self._tat.move_to_end(key)
+            while len(self._tat) > self.max_entries:
+                self._tat.popitem(last=False)
+        return True, max(0.0, delay)
+
+    def clear(self):
+        with self._lock:
+            self._tat.clear()
+
+
+ask_buckets = TokenBuckets()
+
+
+class ChatAskThrottle(BaseThrottle):
+    """
+    發問 (POST) 的每位使用者限流 (同步 view 使用)，GET / DELETE 不受限制。
+    額度用完時直接回傳 429 與 Retry-After，不在 worker 執行緒中等待 (等待只在 async 版本的 athrottle)。
+    """
+
+    def allow_request(self, request, view):
+        if request.method != 'POST':
+            return True
+        allowed, seconds = ask_buckets.reserve(request.user.pk, max_delay=0)
+        if not allowed:
+            self.retry_after = seconds
+            return False
+        return True
+
+    def wait(self):
+        return self.retry_after
+
+
+async def athrottle(user):
+    """AsyncChatView 使用的版本：允許時等待後回傳，超量時拋出 AskThrottled。"""
+    allowed, seconds = ask_buckets.reserve(user.pk)
+    if not allowed:
+        raise AskThrottled(seconds)
+    if seconds:
+        with metrics.phase('queue'):
+            await asyncio.sleep(seconds)
+
+
+# =========================================
+# 全域同時呼叫上限
+# =========================================
+
+class ConcurrencyGate:
+    """同時進行的 Gemini 呼叫上限、有上限的等待佇列，以及 429 之後的 AIMD 退讓。"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._limit = None  # 429 之後的有效上限；None 表示等於設定值
+        self._paused_until = 0.0
+        self.throttled = 0
+        self.rejected = 0
+
+    # --- 設定 ---
+    @property
+    def max_concurrency(self):
+        return getattr(settings, 'CHAT_AI_MAX_CONCURRENCY', 8)
+
+    @property
+    def max_queue(self):
+        return getattr(settings, 'CHAT_AI_MAX_QUEUE', 32)
+
+    @property
+    def queue_timeout(self):
+        return getattr(settings, 'CHAT_AI_QUEUE_TIMEOUT', 10)
+
+    @property
+    def backoff_seconds(self):
+        return getattr(settings, 'CHAT_AI_BACKOFF_SECONDS', 5)
+
+    @property
+    def limit(self):
+        """目前的有效上限。"""
+        return min(self._limit or self.max_concurrency, self.max_concurrency)
+
+    @property
+    def active(self):
+        return self._active
+
+    @property
+    def waiting(self):
+        return self._waiting
+
+    # --- 取得 / 釋放名額 ---
+    def acquire(self):
+        """取得一個名額；需要排隊時阻塞等待，佇列已滿或逾時拋出 Overloaded。"""
+        with self._cond:
+            if self._admit(queued=False):
+                return
+            self._enqueue()
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while not self._admit(queued=True):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject('等待逾時')
+                    self._cond.wait(min(remaining, self._pause_remaining() or remaining))
+            finally:
+                self._waiting -= 1
+
+    async def aacquire(self):
+        """acquire 的非同步版本：以輪詢等待，不佔用執行緒，被取消時不會留下名額。"""
+        with self._cond:
+            if self._admit(queued=False):
+                return
+            self._enqueue()
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                with self._cond:
+                    if self._admit(queued=True):
+                        return
+                    if time.monotonic() >= deadline:
+                        self._reject('等待逾時')
+                await asyncio.sleep(ASYNC_POLL_INTERVAL)
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    # --- 依上游回應調整 ---
+    def on_success(self):
+        with self._cond:
+            if self._limit is not None:
+                self._limit += 1
+                if self._limit >= self.max_concurrency:
+                    self._limit = None
+                self._cond.notify_all()
+
+    def on_throttled(self):
+        """Gemini 回傳 429：上限減半並暫停放行一段時間。"""
+        with self._cond:
+            self.throttled += 1
+            self._limit = max(1, self.limit // 2)
+            self._paused_until = time.monotonic() + self.backoff_seconds
+
+    def reset(self):
+        with self._cond:
+            self._limit = None
+            self._paused_until = 0.0
+            self.throttled = self.rejected = 0
+            self._cond.notify_all()
+
+    # --- 內部工具 (呼叫時需持有鎖) ---
+    def _admit(self, queued):
+        # 新來的請求不插隊：已有人在排隊時一律先排隊
+        if (not queued and self._waiting) or self._active >= self.limit or self._pause_remaining():
+            return False
+        self._active += 1
+        return True
+
+    def _enqueue(self):
+        if self._waiting >= self.max_queue:
+            self._reject('等待佇列已滿')
+        self._waiting += 1
+
+    def _reject(self, reason):
+        self.rejected += 1
+        raise Overloaded(f'Gemini 呼叫{reason}', retry_after=max(1, math.ceil(self._pause_remaining())))
+
+    def _pause_remaining(self):
+        return max(0.0, self._paused_until - time.monotonic())
+
+
+gate = ConcurrencyGate()
+
+
+@contextmanager
+def slot():
+    """在一個 Gemini 呼叫期間佔用名額：with admission.slot(): ...；等待時間計入 queue 階段。"""
+    with metrics.phase('queue'):
+        gate.acquire()
+    try:
+        yield
+    except Exception as e:
+        if is_quota_error(e):
+            gate.on_throttled()
+        raise
+    else:
+        gate.on_success()
+    finally:
+        gate.release()
+
+
+@asynccontextmanager
+async def aslot():
+    """slot 的非同步版本。"""
+    with metrics.phase('queue'):
+        await gate.aacquire()
+    try:
+        yield
+    except Exception as e:
+        if is_quota_error(e):
+            gate.on_throttled()
+        raise
+    else:
+        gate.on_success()
+    finally:
+        gate.release()
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ChatConfig(AppConfig):
     name = "chat"
+
+    def ready(self):
+        # 預先建立 process 共用的 Gemini client，避免第一個請求承擔初始化成本
+        from .genai_client import client_registry
+        client_registry.warmup()
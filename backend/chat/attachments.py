@@ -0,0 +1,195 @@
+"""
+每個對話 Session 的圖片附件管理 (Image Attachments)。
+
+原本每一輪對話都把整張圖片的位元組重新附加到請求中，但模型在第一輪就已經看過這張圖了。
+這裡改為每個 Session 只登記一次圖片，之後的對話以 handle 引用：
+
+1. 第一輪：取得圖片 (chat.image_cache) 後交給 ImageStore 登記，取得 handle / uri 與到期時間，
+   存在 ChatSession 的 image_* 欄位。
+2. 之後的對話：handle 仍有效時直接組成引用用的 Part，不需要下載或上傳圖片；
+   距離到期不足 CHAT_IMAGE_HANDLE_REFRESH_MARGIN 秒時重新登記。
+3. ImageStore 可抽換 (CHAT_IMAGE_STORE)：
+   - GeminiFileStore：上傳到 Gemini Files API (檔案約保留 48 小時)，以 file uri 引用。
+   - LocalImageStore：不連網的替代實作，handle 就是本機磁碟快取中的內容雜湊，送出時才讀取本機檔案。
+4. 登記失敗不應讓發問失敗：記錄警告後改以原本的方式直接附加圖片位元組。
+5. 登記或附加之前先正規化圖片 (chat.image_normalize：縮小、去除中繼資料並重新編碼)，
+   Attachment 的 sha256 與 mime_type 都是正規化後的結果。
+"""
+import asyncio
+import io
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from google.genai import types
+
+from api import metrics
+
+from .genai_client import get_client
+from .image_cache import image_cache
+from .image_normalize import normalize
+from .models import ChatSession
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Attachment:
+    """已登記的圖片：handle 為提供者端的識別碼，uri 用於組成 Part。"""
+    handle: str
+    uri: str
+    mime_type: str
+    sha256: str
+    expires_at: datetime = None
+
+
+class ImageStore:
+    """圖片登記的介面。"""
+
+    def upload(self, image):
+        """登記一張 CachedImage，回傳 Attachment。"""
+        raise NotImplementedError
+
+    async def aupload(self, image):
+        return await sync_to_async(self.upload)(image)
+
+    def part(self, attachment):
+        """以 Attachment 組成送給模型的 Part；handle 已失效時回傳 None。"""
+        raise NotImplementedError
+
+
+class GeminiFileStore(ImageStore):
+    """透過 Gemini Files API 上傳圖片，之後的對話以 file uri 引用。"""
+
+    def _config(self, image):
+        return types.UploadFileConfig(mime_type=image.content_type, display_name=image.sha256)
+
+    def _attachment(self, file, image):
+        return Attachment(
+            handle=file.name,
+            uri=file.uri,
+            mime_type=file.mime_type or image.content_type,
+            sha256=image.sha256,
+            expires_at=file.expiration_time,
+        )
+
+    def upload(self, image):
+        with metrics.phase('ai'):
+            file = get_client().files.upload(file=io.BytesIO(image.content), config=self._config(image))
+        return self._attachment(file, image)
+
+    async def aupload(self, image):
+        with metrics.phase('ai'):
+            file = await get_client().aio.files.upload(file=io.BytesIO(image.content), config=self._config(image))
+        return self._attachment(file, image)
+
+    def part(self, attachment):
+        return types.Part.from_uri(file_uri=attachment.uri, mime_type=attachment.mime_type)
+
+
+class LocalImageStore(ImageStore):
+    """
+    不連網的替代實作：圖片本來就存在本機磁碟快取中，handle 即為內容雜湊。
+    送出時仍會附加圖片位元組，但不必再經過網址索引或重新下載；圖片本體被淘汰時視為 handle 失效。
+    """
+
+    def upload(self, image):
+        ttl = getattr(settings, 'CHAT_LOCAL_IMAGE_HANDLE_TTL', 24 * 60 * 60)
+        return Attachment(
+            handle=image.sha256,
+            uri=f'local://{image.sha256}',
+            mime_type=image.content_type,
+            sha256=image.sha256,
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+        )
+
+    def part(self, attachment):
+        content = image_cache.read_blob(attachment.sha256)
+        if content is None:
+            return None
+        return types.Part.from_bytes(data=content, mime_type=attachment.mime_type)
+
+
+def get_store():
+    return import_string(getattr(settings, 'CHAT_IMAGE_STORE', 'chat.attachments.GeminiFileStore'))()
+
+
+def inline_part(image):
+    """直接附加圖片位元組的 Part (登記失敗時的退路)。"""
+    return types.Part.from_bytes(data=image.content, mime_type=image.content_type)
+
+
+def stored_attachment(session):
+    """讀取 Session 上仍有效的 Attachment；沒有、即將到期或已到期時回傳 None。"""
+    if not session.image_handle:
+        return None
+    margin = timedelta(seconds=getattr(settings, 'CHAT_IMAGE_HANDLE_REFRESH_MARGIN', 10 * 60))
+    if session.image_expires_at is not None and session.image_expires_at - margin <= timezone.now():
+        return None
+    return Attachment(
+        handle=session.image_handle,
+        uri=session.image_uri,
+        mime_type=session.image_mime_type,
+        sha256=session.image_sha256,
+        expires_at=session.image_expires_at,
+    )
+
+
+def remember(session, attachment):
+    """把新登記的 Attachment 寫回 Session。"""
+    fields = {
+        'image_handle': attachment.handle,
+        'image_uri': attachment.uri,
+        'image_mime_type': attachment.mime_type,
+        'image_sha256': attachment.sha256,
+        'image_expires_at': attachment.expires_at,
+    }
+    ChatSession.objects.filter(pk=session.pk).update(**fields)
+    for name, value in fields.items():
+        setattr(session, name, value)
+
+
+def attach_image(session, image_url):
+    """
+    回傳 (圖片內容雜湊, 送給模型的 Part)。
+    Session 已有有效 handle 時不會下載或上傳圖片。
+    """
+    store = get_store()
+    attachment = stored_attachment(session)
+    if attachment is not None:
+        part = store.part(attachment)
+        if part is not None:
+            return attachment.sha256, part
+
+    image = normalize(image_cache.get(image_url))
+    try:
+        attachment = store.upload(image)
+    except Exception as e:
+        logger.warning(f"ChatSession {session.pk} image upload failed, sending inline: {e}")
+        return image.sha256, inline_part(image)
+    remember(session, attachment)
+    return image.sha256, store.part(attachment) or inline_part(image)
+
+
+async def aattach_image(session, image_url):
+    """attach_image 的非同步版本。"""
+    store = get_store()
+    attachment = stored_attachment(session)
+    if attachment is not None:
+        part = await sync_to_async(store.part)(attachment)
+        if part is not None:
+            return attachment.sha256, part
+
+    # 解碼與重新編碼佔用 CPU，放到執行緒中進行
+    image = await asyncio.to_thread(normalize, await image_cache.aget(image_url))
+    try:
+        attachment = await store.aupload(image)
+    except Exception as e:
+        logger.warning(f"ChatSession {session.pk} image upload failed, sending inline: {e}")
+        return image.sha256, inline_part(image)
+    await sync_to_async(remember)(session, attachment)
+    return image.sha256, await sync_to_async(store.part)(attachment) or inline_part(image)
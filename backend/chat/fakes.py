@@ -0,0 +1,195 @@
+"""
+不連網的替身 (Test Doubles)。
+
+FakeGenAIClient 模仿 google-genai Client 中本專案會用到的介面
+(client.chats.create → chat.send_message / chat.send_message_stream、client.models.generate_content、client.files.upload，以及 client.aio 的非同步版本)，
+可透過 override_client() 注入，或在 settings 設定
+CHAT_GENAI_CLIENT_FACTORY = 'chat.fakes.FakeGenAIClient' 讓整個 process 使用它。
+"""
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import timedelta
+
+import httpx
+from django.conf import settings
+from django.utils import timezone
+from google.genai import types
+
+
+@dataclass
+class FakeResponse:
+    """對應 GenerateContentResponse，只提供本專案會讀取的 text 屬性。"""
+    text: str
+
+
+def request_timeout(config):
+    """config (GenerateContentConfig) 中的 HTTP 逾時秒數；沒有設定時為 None。"""
+    http_options = getattr(config, 'http_options', None)
+    timeout = getattr(http_options, 'timeout', None)
+    return timeout / 1000 if timeout is not None else None
+
+
+def simulate_latency(client, config):
+    """模擬延遲；延遲超過這次呼叫的逾時時，等到逾時後拋出 httpx.ReadTimeout (同真正的 SDK)。"""
+    timeout = request_timeout(config)
+    if timeout is not None and client.latency > timeout:
+        time.sleep(timeout)
+        raise httpx.ReadTimeout('fake Gemini call timed out')
+    if client.latency:
+        time.sleep(client.latency)
+
+
+async def asimulate_latency(client, config):
+    """simulate_latency 的非同步版本。"""
+    timeout = request_timeout(config)
+    if timeout is not None and client.latency > timeout:
+        await asyncio.sleep(timeout)
+        raise httpx.ReadTimeout('fake Gemini call timed out')
+    if client.latency:
+        await asyncio.sleep(client.latency)
+
+
+class FakeChat:
+    def __init__(self, client, model, history):
+        self.client = client
+        self.model = model
+        self.history = list(history or [])
+
+    def record(self, message, config):
+        self.client.calls.append({
+            'model': self.model, 'history': self.history, 'message': message, 'timeout': request_timeout(config),
+        })
+
+    def send_message(self, message, config=None):
+        self.record(message, config)
+        simulate_latency(self.client, config)
+        self.client.maybe_fail()
+        return FakeResponse(text=self.client.reply)
+
+    def send_message_stream(self, message, config=None):
+        """逐段產生回覆；有設定 token_rate 時，每段之間依速率暫停。"""
+        self.record(message, config)
+        simulate_latency(self.client, config)
+        self.client.maybe_fail()
+        reply = self.client.reply
+        size = self.client.chunk_size
+        for start in range(0, len(reply), size):
+            if self.client.token_rate:
+                time.sleep(1 / self.client.token_rate)
+            yield FakeResponse(text=reply[start:start + size])
+
+
+class FakeAsyncChat(FakeChat):
+    """對應 client.aio.chats.create() 建立的非同步對話。"""
+
+    async def send_message(self, message, config=None):
+        self.record(message, config)
+        await asimulate_latency(self.client, config)
+        self.client.maybe_fail()
+        return FakeResponse(text=self.client.reply)
+
+
+class FakeModels:
+    """對應 client.models (單次產生內容，用於對話摘要)。"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def record(self, model, contents, config):
+        self.client.generate_calls.append({'model': model, 'contents': contents, 'timeout': request_timeout(config)})
+
+    def generate_content(self, model, contents, config=None, **kwargs):
+        self.record(model, contents, config)
+        simulate_latency(self.client, config)
+        self.client.maybe_fail()
+        return FakeResponse(text=self.client.summary)
+
+
+class FakeAsyncModels(FakeModels):
+    async def generate_content(self, model, contents, config=None, **kwargs):
+        self.record(model, contents, config)
+        await asimulate_latency(self.client, config)
+        self.client.maybe_fail()
+        return FakeResponse(text=self.client.summary)
+
+
+class FakeFiles:
+    """對應 client.files (Files API)，上傳的檔案只記錄在 client.uploads。"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def upload(self, file, config=None, **kwargs):
+        name = f'files/fake-{len(self.client.uploads) + 1}'
+        uploaded = types.File(
+            name=name,
+            uri=f'https://generativelanguage.googleapis.com/v1beta/{name}',
+            mime_type=getattr(config, 'mime_type', None) or 'image/jpeg',
+            size_bytes=len(file.read()),
+            expiration_time=timezone.now() + timedelta(hours=48),
+        )
+        self.client.uploads.append(uploaded)
+        return uploaded
+
+
+class FakeAsyncFiles(FakeFiles):
+    async def upload(self, file, config=None, **kwargs):
+        return super().upload(file, config, **kwargs)
+
+
+class FakeChats:
+    def __init__(self, client, chat_class=FakeChat):
+        self.client = client
+        self.chat_class = chat_class
+
+    def create(self, model, history=None, **kwargs):
+        return self.chat_class(self.client, model, history)
+
+
+class FakeAio:
+    """對應 client.aio (非同步介面)。"""
+
+    def __init__(self, client):
+        self.chats = FakeChats(client, FakeAsyncChat)
+        self.models = FakeAsyncModels(client)
+        self.files = FakeAsyncFiles(client)
+
+
+class FakeGenAIClient:
+    """
+    假的 Gemini client。
+    - reply: 每次回覆的固定文字
+    - latency: 每次呼叫模擬的延遲秒數 (首個 token 之前的等待時間)
+    - token_rate: 串流時每秒產生的段數 (None 表示不限速)
+    - chunk_size: 串流時每段的字元數
+    - errors: 依序拋出的例外清單，用完後恢復正常回覆 (模擬暫時性故障)
+    - summary: models.generate_content (對話摘要) 回傳的固定文字
+    - calls: 記錄所有對話呼叫，方便測試驗證傳入的歷史紀錄、訊息與逾時 (秒)；摘要呼叫記錄在 generate_calls
+      (延遲超過呼叫的逾時時拋出 httpx.ReadTimeout)
+    未指定的參數會從 settings 的 CHAT_FAKE_GENAI_* 讀取。
+    """
+
+    def __init__(self, api_key=None, reply=None, latency=None, token_rate=None, chunk_size=4, errors=None,
+                 summary='使用者詢問了狗狗的品種與照顧方式。'):
+        self.api_key = api_key
+        self.reply = reply if reply is not None else getattr(settings, 'CHAT_FAKE_GENAI_REPLY', '這是一隻可愛的狗狗！')
+        self.latency = latency if latency is not None else getattr(settings, 'CHAT_FAKE_GENAI_LATENCY', 0)
+        self.token_rate = token_rate if token_rate is not None else getattr(settings, 'CHAT_FAKE_GENAI_TOKEN_RATE', None)
+        self.chunk_size = chunk_size
+        self.errors = list(errors or [])
+        self.summary = summary
+        self.calls = []
+        self.generate_calls = []
+        self.uploads = []
+        self.chats = FakeChats(self)
+        self.models = FakeModels(self)
+        self.files = FakeFiles(self)
+        self.aio = FakeAio(self)
+
+    def maybe_fail(self):
+        if self.errors:
+            raise self.errors.pop(0)
+
+    def close(self):
+        pass
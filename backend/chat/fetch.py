@@ -0,0 +1,304 @@
+"""
+對外 HTTP 下載層 (Outbound Fetch)。
+
+所有對外下載 (目前主要是狗狗圖片) 都應透過這裡，而不是直接呼叫 requests.get：
+
+1. 連線池：同步端共用一個 requests.Session，依主機保留 keep-alive 連線，避免每輪對話重新握手 TCP/TLS。
+2. 逾時：分別設定連線逾時與讀取逾時，慢速的來源不會無限期佔住 worker。
+3. 大小上限：以串流方式讀取，超過上限立即中斷並拋出 ResponseTooLarge。
+4. 內容類型偵測：依檔案開頭的 magic bytes 判斷真實格式，不再寫死 image/jpeg。
+5. 同步 (fetch) 與非同步 (afetch) 兩種介面，分別給同步與 async view 使用。
+6. 下載時間計入請求的 fetch 階段 (api.metrics，會出現在 Server-Timing 與 /metrics)。
+7. 韌性 (chat.resilience)：整個下載有總期限 (CHAT_FETCH_DEADLINE)，連線錯誤、逾時與 5xx 以指數退避重試，
+   每個主機各有一個斷路器；設定 CHAT_FETCH_HEDGE_AFTER 時，較慢的下載會再送出一個對沖請求。
+"""
+import asyncio
+import threading
+import weakref
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from api import metrics
+
+from . import resilience
+
+CHUNK_SIZE = 64 * 1024
+
+# 視為暫時性失敗 (值得重試) 的 HTTP 狀態碼：5xx 以外的部分
+RETRYABLE_STATUS = {408, 429}
+
+
+class FetchError(Exception):
+    """對外下載失敗 (連線錯誤、逾時或非預期的 HTTP 狀態碼)。retryable 表示是否為暫時性失敗。"""
+
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class ResponseTooLarge(FetchError):
+    """回應內容超過 CHAT_FETCH_MAX_BYTES 上限。"""
+
+
+@dataclass
+class FetchResult:
+    """下載結果。status_code 為 304 時 content 為空。"""
+    url: str
+    status_code: int
+    content: bytes = b''
+    content_type: str = ''
+    headers: CaseInsensitiveDict = field(default_factory=CaseInsensitiveDict)
+
+    @property
+    def not_modified(self):
+        return self.status_code == 304
+
+
+# 常見圖片格式的檔頭特徵 (magic bytes)
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def sniff_content_type(data, declared=None):
+    """
+    依內容開頭判斷真實的圖片格式。
+    無法辨識時退回伺服器宣告的 Content-Type (僅接受 image/*)，兩者皆無則回傳 None。
+    """
+    head = bytes(data[:16])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+
+    declared = (declared or '').split(';')[0].strip().lower()
+    if declared.startswith('image/'):
+        return declared
+    return None
+
+
+def _connect_timeout():
+    return getattr(settings, 'CHAT_FETCH_CONNECT_TIMEOUT', 3.05)
+
+
+def _read_timeout():
+    return getattr(settings, 'CHAT_FETCH_READ_TIMEOUT', 10)
+
+
+def _max_bytes():
+    return getattr(settings, 'CHAT_FETCH_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def _pool_size():
+    return getattr(settings, 'CHAT_FETCH_POOL_SIZE', 10)
+
+
+def _hedge_after():
+    return getattr(settings, 'CHAT_FETCH_HEDGE_AFTER', None)
+
+
+def _known_upstreams():
+    return getattr(settings, 'CHAT_FETCH_UPSTREAMS', ('dog.ceo', 'images.dog.ceo'))
+
+
+def _upstream(url):
+    """
+    斷路器與重試指標的上游名稱：已知的圖片來源依主機區分，其他主機一律共用 fetch:other。
+    網址由使用者提供，若每個主機都建立斷路器，斷路器與 /metrics 的標籤會無限增加。
+    """
+    host = (urlsplit(url).hostname or '').lower()
+    return f'fetch:{host}' if host in _known_upstreams() else 'fetch:other'
+
+
+def _retryable(e):
+    return isinstance(e, FetchError) and e.retryable
+
+
+def _status_error(url, status_code):
+    return FetchError(
+        f'下載 {url} 失敗: HTTP {status_code}', retryable=status_code >= 500 or status_code in RETRYABLE_STATUS,
+    )
+
+
+def _timeout_error(url):
+    return FetchError(f'下載 {url} 失敗: 超過期限', retryable=True)
+
+
+def _check_declared_length(headers, url):
+    length = headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > _max_bytes():
+        raise ResponseTooLarge(f'{url} 回應大小 {length} bytes 超過上限 {_max_bytes()} bytes')
+
+
+def _build_result(url, status_code, content, headers):
+    # requests 與 httpx 的 headers 型別不同，統一轉為不分大小寫的字典
+    headers = CaseInsensitiveDict(headers)
+    return FetchResult(
+        url=url,
+        status_code=status_code,
+        content=content,
+        content_type=sniff_content_type(content, headers.get('Content-Type')) or '',
+        headers=headers,
+    )
+
+
+# =========================================
+# 同步介面
+# =========================================
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """取得 process 共用的 requests.Session (第一次呼叫時建立)。"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_connections: 保留連線池的主機數；pool_maxsize: 每個主機的最大連線數
+                adapter = HTTPAdapter(pool_connections=_pool_size(), pool_maxsize=_pool_size())
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def fetch(url, headers=None):
+    """以共用連線池下載網址內容，回傳 FetchResult (200 或 304)；暫時性失敗會在期限內重試。"""
+    upstream = _upstream(url)
+
+    def attempt(deadline):
+        return resilience.hedged(lambda: _fetch(url, headers, deadline), _hedge_after(), upstream)
+
+    with metrics.phase('fetch'):
+        try:
+            return resilience.call(
+                attempt, policy=resilience.fetch_policy(), breaker=resilience.breakers.get(upstream),
+                retryable=_retryable,
+            )
+        except resilience.CircuitOpen as e:
+            raise FetchError(f'下載 {url} 失敗: {e}') from e
+
+
+# requests 的例外中屬於暫時性失敗的部分 (網址格式錯誤等不重試)
+_TRANSIENT_REQUESTS_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+def _fetch(url, headers, deadline):
+    remaining = deadline.remaining()
+    if not remaining:
+        raise _timeout_error(url)
+    try:
+        response = get_session().get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=(min(_connect_timeout(), remaining), min(_read_timeout(), remaining)),
+        )
+    except requests.RequestException as e:
+        raise FetchError(f'下載 {url} 失敗: {e}', retryable=isinstance(e, _TRANSIENT_REQUESTS_ERRORS)) from e
+
+    with response:
+        if response.status_code == 304:
+            return _build_result(url, 304, b'', response.headers)
+        if response.status_code >= 400:
+            raise _status_error(url, response.status_code)
+
+        _check_declared_length(response.headers, url)
+        chunks = []
+        total = 0
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                total += len(chunk)
+                if total > _max_bytes():
+                    raise ResponseTooLarge(f'{url} 回應大小超過上限 {_max_bytes()} bytes')
+                if deadline.expired:
+                    # 讀取逾時只限制每次讀取的間隔，緩慢但持續送資料的來源要以總期限中斷
+                    raise _timeout_error(url)
+                chunks.append(chunk)
+        except requests.RequestException as e:
+            raise FetchError(f'下載 {url} 失敗: {e}', retryable=isinstance(e, _TRANSIENT_REQUESTS_ERRORS)) from e
+
+        return _build_result(url, response.status_code, b''.join(chunks), response.headers)
+
+
+# =========================================
+# 非同步介面
+# =========================================
+
+# httpx.AsyncClient 綁定在建立它的 event loop 上，因此每個 loop 各自保留一個 client
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """取得目前 event loop 共用的 httpx.AsyncClient。"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(_read_timeout(), connect=_connect_timeout()),
+            limits=httpx.Limits(max_connections=_pool_size(), max_keepalive_connections=_pool_size()),
+            follow_redirects=True,
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def afetch(url, headers=None):
+    """fetch 的非同步版本，行為與回傳值相同。"""
+    upstream = _upstream(url)
+
+    async def attempt(deadline):
+        return await resilience.ahedged(lambda: _afetch(url, headers, deadline), _hedge_after(), upstream)
+
+    with metrics.phase('fetch'):
+        try:
+            return await resilience.acall(
+                attempt, policy=resilience.fetch_policy(), breaker=resilience.breakers.get(upstream),
+                retryable=_retryable,
+            )
+        except resilience.CircuitOpen as e:
+            raise FetchError(f'下載 {url} 失敗: {e}') from e
+
+
+_TRANSIENT_HTTPX_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+async def _afetch(url, headers, deadline):
+    remaining = deadline.remaining()
+    if not remaining:
+        raise _timeout_error(url)
+    timeout = httpx.Timeout(min(_read_timeout(), remaining), connect=min(_connect_timeout(), remaining))
+    try:
+        async with get_async_client().stream('GET', url, headers=headers, timeout=timeout) as response:
+            if response.status_code == 304:
+                return _build_result(url, 304, b'', response.headers)
+            if response.status_code >= 400:
+                raise _status_error(url, response.status_code)
+
+            _check_declared_length(response.headers, url)
+            chunks = []
+            total = 0
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                total += len(chunk)
+                if total > _max_bytes():
+                    raise ResponseTooLarge(f'{url} 回應大小超過上限 {_max_bytes()} bytes')
+                if deadline.expired:
+                    raise _timeout_error(url)
+                chunks.append(chunk)
+            return _build_result(url, response.status_code, b''.join(chunks), response.headers)
+    except httpx.HTTPError as e:
+        raise FetchError(f'下載 {url} 失敗: {e}', retryable=isinstance(e, _TRANSIENT_HTTPX_ERRORS)) from e
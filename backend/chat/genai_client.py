@@ -0,0 +1,103 @@
+"""
+Gemini 客戶端登錄處 (Client Registry)。
+
+genai.Client 內部持有 HTTP 連線池與認證設定，每個請求都重新建立會白白丟掉這些資源。
+這裡讓每個 worker process 只建立一個 client 並在請求之間重複使用：
+
+1. 延遲建立：第一次呼叫 get_client() 時才建立，之後直接回傳同一個實體。
+2. 金鑰輪替：偵測到 GEMINI_API_KEY 改變時自動重建 client。
+3. Fork 安全：偵測到 process id 改變 (例如 gunicorn preload 後 fork) 時重建，避免共用父行程的連線。
+4. 可注入：透過 CHAT_GENAI_CLIENT_FACTORY 設定或 override_client()，測試與壓測可以換成不連網的假 client。
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from google import genai
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """管理整個 process 共用的 Gemini client。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._api_key = None
+        self._pid = None
+        self._override = None
+
+    def _factory(self):
+        # 可在 settings 以字串路徑指定替代的 client 類別，例如 'chat.fakes.FakeGenAIClient'
+        path = getattr(settings, 'CHAT_GENAI_CLIENT_FACTORY', None)
+        return import_string(path) if path else genai.Client
+
+    def get_client(self):
+        """取得目前 process 的 client；金鑰或 process 改變時會自動重建。"""
+        if self._override is not None:
+            return self._override
+
+        api_key = os.environ.get('GEMINI_API_KEY')
+        pid = os.getpid()
+        client = self._client
+        if client is not None and self._api_key == api_key and self._pid == pid:
+            return client
+
+        with self._lock:
+            if self._client is None or self._api_key != api_key or self._pid != pid:
+                old_client, old_pid = self._client, self._pid
+                self._client = self._factory()(api_key=api_key)
+                self._api_key = api_key
+                self._pid = pid
+                # 只關閉本 process 建立的舊 client；fork 來的連線屬於父行程，不應在這裡關閉
+                if old_client is not None and old_pid == pid:
+                    self._close(old_client)
+            return self._client
+
+    def warmup(self):
+        """在 AppConfig.ready() 預先建立 client，讓第一個請求不必負擔初始化成本。"""
+        if self._override is None and not os.environ.get('GEMINI_API_KEY') \
+                and not getattr(settings, 'CHAT_GENAI_CLIENT_FACTORY', None):
+            logger.info('GEMINI_API_KEY 未設定，略過 Gemini client 預熱')
+            return
+        try:
+            self.get_client()
+        except Exception as e:
+            # 預熱失敗不應阻止 Django 啟動，等到實際請求時再回報錯誤
+            logger.warning(f'Gemini client 預熱失敗: {e}')
+
+    def reset(self):
+        """丟棄目前的 client，下次呼叫 get_client() 時重新建立。"""
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._close(self._client)
+            self._client = self._api_key = self._pid = None
+
+    @contextmanager
+    def override_client(self, client):
+        """暫時以指定的 client 取代真實 client (測試與壓測用)。"""
+        previous = self._override
+        self._override = client
+        try:
+            yield client
+        finally:
+            self._override = previous
+
+    def _close(self, client):
+        close = getattr(client, 'close', None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            logger.debug(f'關閉舊的 Gemini client 失敗: {e}')
+
+
+# 整個 process 共用的登錄處實體
+client_registry = ClientRegistry()
+get_client = client_registry.get_client
+override_client = client_registry.override_client
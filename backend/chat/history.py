@@ -0,0 +1,160 @@
+"""
+依 token 預算裁切的對話歷史 (History Windowing)。
+
+原本每一輪都會把整段對話重送給 Gemini，請求大小、延遲與費用都隨對話長度線性成長。
+這裡改為：
+
+1. 最近幾輪對話在 token 預算 (CHAT_HISTORY_TOKEN_BUDGET) 內原文保留。
+2. 超出預算時，把較早的對話連同既有摘要濃縮成新的摘要，存在 ChatSession.summary，
+   並以 summary_until 記錄已併入摘要的最後一則訊息；之後只讀取這之後的訊息。
+3. 濃縮時一次裁到預算的 CHAT_HISTORY_KEEP_RATIO (預設一半)，之後數輪都不必再摘要，
+   因此長對話的每輪成本大致固定。
+
+摘要失敗不應讓發問失敗：記錄警告後改送尚未摘要的完整訊息，下一輪再試。
+摘要呼叫與發問一樣經過 services.call_gemini (逾時、CHAT_AI_DEADLINE 期限、重試與斷路器)，不會無限期佔用同時呼叫的名額。
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from api import metrics
+
+from . import admission, services
+from .genai_client import get_client
+from .models import ChatSession
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "以下是使用者與 AI 針對一張狗狗圖片的對話。"
+    "請將「既有摘要」與「新的對話」合併成一段不超過 {max_chars} 字的繁體中文摘要，"
+    "保留使用者關心的問題、已經給出的結論與重要細節，不要加入新的資訊。\n\n"
+    "既有摘要：\n{summary}\n\n新的對話：\n{transcript}"
+)
+
+
+def token_budget():
+    return getattr(settings, 'CHAT_HISTORY_TOKEN_BUDGET', 2000)
+
+
+def estimate_tokens(text):
+    """
+    粗估 token 數：以 UTF-8 位元組數 / 4 估算 (英文約 4 字元一個 token，中文約 1 字一個 token)。
+    只用來決定裁切位置，不需要精確，也避免每輪額外呼叫 count_tokens API。
+    """
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+def split_window(messages, budget, keep_ratio):
+    """
+    決定哪些訊息要併入摘要。messages 為依時間排序的 (id, role, content)。
+    回傳 (to_fold, keep)；總量未超出預算時 to_fold 為空。
+    需要摘要時，從最新往回保留到 budget * keep_ratio 為止，且保留區一定從使用者的提問開始，
+    讓「提問 / 回覆」成對地留在同一邊。最後一輪一定保留。
+    """
+    sizes = [estimate_tokens(content) for _, _, content in messages]
+    if sum(sizes) <= budget:
+        return [], list(messages)
+
+    target = budget * keep_ratio
+    start = len(messages)
+    used = 0
+    for i in range(len(messages) - 1, -1, -1):
+        if used + sizes[i] > target and start < len(messages) and messages[start][1] == 'user':
+            break
+        used += sizes[i]
+        start = i
+    return list(messages[:start]), list(messages[start:])
+
+
+def summary_prompt(summary, folded):
+    transcript = '\n'.join(
+        f"{'使用者' if role == 'user' else 'AI'}：{content}" for _, role, content in folded
+    )
+    return SUMMARY_PROMPT.format(
+        max_chars=getattr(settings, 'CHAT_HISTORY_SUMMARY_MAX_CHARS', 600),
+        summary=summary or '(無)',
+        transcript=transcript,
+    )
+
+
+def summary_model():
+    return getattr(settings, 'CHAT_HISTORY_SUMMARY_MODEL', None) or settings.CHAT_GEMINI_MODEL
+
+
+def with_summary(summary, keep):
+    """組合送給模型的歷史：摘要以一組「提問 / 回覆」放在最前面，後面接原文保留的訊息。"""
+    history = []
+    if summary:
+        history.append(('user', f"(先前對話的摘要)\n{summary}"))
+        history.append(('model', "了解，我會參考這段摘要繼續回答。"))
+    history.extend((role, content) for _, role, content in keep)
+    return history
+
+
+def save_summary(session, folded, summary):
+    """
+    寫入新摘要。以條件式 UPDATE 確認 summary_until 沒有被其他請求先更新，
+    同一個 Session 同時有兩個請求在摘要時只會採用其中一個結果。
+    """
+    updated = ChatSession.objects.filter(pk=session.pk, summary_until=session.summary_until).update(
+        summary=summary, summary_until=folded[-1][0],
+    )
+    if updated:
+        session.summary = summary
+        session.summary_until = folded[-1][0]
+    return updated
+
+
+def pending_messages(session):
+    return session.messages.filter(id__gt=session.summary_until).order_by('created_at', 'id') \
+        .values_list('id', 'role', 'content')
+
+
+def load_window(session):
+    """回傳送給模型的歷史紀錄 (role, content)；必要時先更新 Session 的滾動摘要。"""
+    messages = list(pending_messages(session))
+    folded, keep = split_window(messages, token_budget(), getattr(settings, 'CHAT_HISTORY_KEEP_RATIO', 0.5))
+    if not folded:
+        return with_summary(session.summary, keep)
+
+    try:
+        with admission.slot(), metrics.phase('ai'):
+            response = services.call_gemini(lambda config: get_client().models.generate_content(
+                model=summary_model(), contents=summary_prompt(session.summary, folded), config=config,
+            ))
+        summary = (response.text or '').strip()
+    except Exception as e:
+        logger.warning(f"ChatSession {session.pk} summary failed: {e}")
+        return with_summary(session.summary, messages)
+
+    if not summary:
+        return with_summary(session.summary, messages)
+    save_summary(session, folded, summary)
+    return with_summary(summary, keep)
+
+
+async def aload_window(session):
+    """load_window 的非同步版本，以 client.aio 產生摘要。"""
+    messages = [row async for row in pending_messages(session)]
+    folded, keep = split_window(messages, token_budget(), getattr(settings, 'CHAT_HISTORY_KEEP_RATIO', 0.5))
+    if not folded:
+        return with_summary(session.summary, keep)
+
+    try:
+        async with admission.aslot():
+            with metrics.phase('ai'):
+                response = await services.acall_gemini(lambda config: get_client().aio.models.generate_content(
+                    model=summary_model(), contents=summary_prompt(session.summary, folded), config=config,
+                ))
+        summary = (response.text or '').strip()
+    except Exception as e:
+        logger.warning(f"ChatSession {session.pk} summary failed: {e}")
+        return with_summary(session.summary, messages)
+
+    if not summary:
+        return with_summary(session.summary, messages)
+    await sync_to_async(save_summary)(session, folded, summary)
+    return with_summary(summary, keep)
+
@@ -0,0 +1,265 @@
+"""
+狗狗圖片的本機磁碟快取 (Content-addressed Disk Cache)。
+
+ChatView 每一輪對話都需要同一張 dog.ceo 圖片的二進位內容，
+這個模組負責把下載過的圖片存在本機磁碟，避免每次都重新下載：
+
+1. 內容定址：圖片本體依 SHA-256 存放於 blobs/，不同網址但內容相同的圖片只會存一份。
+2. 網址索引：meta/ 下以網址雜湊為檔名，記錄對應的內容雜湊、ETag 與 Last-Modified。
+3. 重新驗證：快取過期後帶上 If-None-Match / If-Modified-Since 詢問來源，304 時直接沿用本機檔案。
+   實際的網路下載交給 chat.fetch (連線池、逾時與大小上限)。
+4. LRU 淘汰：總容量超過上限時，依最後存取時間 (mtime) 由舊到新刪除圖片本體。
+   平時只累計寫入的容量，超過上限時才掃描整個目錄。
+5. 讀取時使用 mmap 記憶體映射，讓作業系統的頁面快取直接服務重複讀取。
+"""
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+
+from .fetch import FetchError, afetch, fetch, sniff_content_type
+
+
+@dataclass
+class CachedImage:
+    """快取查詢結果：圖片內容與其中繼資料。"""
+    url: str
+    sha256: str
+    content: bytes
+    content_type: str
+
+
+def atomic_write(path, data):
+    """先寫入暫存檔再 rename，確保其他 worker 不會讀到寫一半的檔案。"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def url_key(url):
+    """將網址轉成固定長度的索引鍵 (避免超長網址直接當檔名)。"""
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+class ImageCache:
+    """
+    以磁碟為儲存媒介的圖片快取。
+    所有設定皆在使用時才讀取 settings，方便測試時以 override_settings 切換目錄與容量。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 各快取目錄的圖片本體總容量估計值 (上次掃描的結果 + 之後這個 process 寫入的容量)；
+        # 其他 process 寫入的容量要到下次掃描才會算進來
+        self._totals = {}
+
+    # --- 設定 ---
+    @property
+    def root(self):
+        return Path(getattr(settings, 'CHAT_IMAGE_CACHE_DIR', settings.BASE_DIR / '.cache' / 'chat_images'))
+
+    @property
+    def max_bytes(self):
+        return getattr(settings, 'CHAT_IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CHAT_IMAGE_CACHE_TTL', 3600)
+
+    # --- 路徑 ---
+    def _blob_path(self, sha256):
+        return self.root / 'blobs' / sha256[:2] / sha256
+
+    def _meta_path(self, url):
+        key = url_key(url)
+        return self.root / 'meta' / key[:2] / f'{key}.json'
+
+    # --- 公開介面 ---
+    def get(self, url):
+        """
+        取得圖片內容：
+        - 快取仍新鮮 (TTL 內)：直接讀取本機檔案，不發出任何網路請求。
+        - 快取過期：帶條件標頭重新驗證，304 沿用本機檔案，200 則寫入新內容。
+        - 無快取：完整下載並寫入。
+        """
+        meta, headers = self._lookup(url)
+        if meta and headers is None:
+            cached = self._load(url, meta)
+            if cached is not None:
+                return cached
+            # 圖片本體剛被 (其他 worker 的) 淘汰刪除：當作沒有快取重新下載
+            meta, headers = None, {}
+        cached = self._handle_fetch(url, meta, fetch(url, headers=headers))
+        if cached is None:
+            cached = self._refetched(url, fetch(url))
+        return cached
+
+    async def aget(self, url):
+        """get 的非同步版本，網路下載改用 afetch，磁碟寫入與淘汰移到執行緒中進行。"""
+        meta, headers = self._lookup(url)
+        if meta and headers is None:
+            cached = self._load(url, meta)
+            if cached is not None:
+                return cached
+            meta, headers = None, {}
+        result = await afetch(url, headers=headers)
+        cached = await asyncio.to_thread(self._handle_fetch, url, meta, result)
+        if cached is None:
+            result = await afetch(url)
+            cached = await asyncio.to_thread(self._refetched, url, result)
+        return cached
+
+    def store(self, url, content, content_type='', headers=None):
+        """將下載到的圖片寫入快取，並更新網址索引。"""
+        headers = headers or {}
+        sha256 = self.put_blob(content)
+        meta = {
+            'sha256': sha256,
+            'size': len(content),
+            'content_type': content_type or sniff_content_type(content) or 'image/jpeg',
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'checked_at': time.time(),
+        }
+        self._write_meta(url, meta)
+        self.evict()
+        return CachedImage(url=url, sha256=sha256, content=content, content_type=meta['content_type'])
+
+    def put_blob(self, content):
+        """依內容雜湊寫入圖片本體 (已存在時不重寫)，回傳雜湊；不經過網址索引 (例如正規化後的圖片)。"""
+        sha256 = hashlib.sha256(content).hexdigest()
+        blob_path = self._blob_path(sha256)
+        if not blob_path.exists():
+            self._atomic_write(blob_path, content)
+            with self._lock:
+                if self.root in self._totals:
+                    self._totals[self.root] += len(content)
+        return sha256
+
+    def read_blob(self, sha256):
+        """依內容雜湊直接讀取圖片本體 (不經過網址索引)；已被淘汰時回傳 None。"""
+        path = self._blob_path(sha256)
+        try:
+            # 更新 mtime 作為 LRU 的「最近使用」時間
+            os.utime(path)
+            return self._read_blob(path)
+        except FileNotFoundError:
+            return None
+
+    def evict(self):
+        """
+        總容量超過上限時，依 mtime (最後存取時間) 由舊到新刪除圖片本體。
+        容量估計值未超過上限時直接返回；只有第一次與超過上限時才掃描目錄。
+        """
+        with self._lock:
+            root = self.root
+            if self._totals.get(root, self.max_bytes + 1) <= self.max_bytes:
+                return
+
+            blobs = []
+            total = 0
+            for path in (root / 'blobs').glob('*/*'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+            if total > self.max_bytes:
+                blobs.sort()
+                for _, size, path in blobs:
+                    if total <= self.max_bytes:
+                        break
+                    path.unlink(missing_ok=True)
+                    total -= size
+            self._totals[root] = total
+
+    # --- 內部工具 ---
+    def _lookup(self, url):
+        """
+        查詢網址索引，回傳 (meta, 重新驗證用的條件標頭)。
+        標頭為 None 代表快取仍新鮮可直接使用；meta 為 None 代表沒有可用的快取。
+        """
+        meta = self._read_meta(url)
+        if not meta or not self._blob_path(meta['sha256']).exists():
+            return None, {}
+        if time.time() - meta['checked_at'] < self.ttl:
+            return meta, None
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return meta, headers
+
+    def _handle_fetch(self, url, meta, result):
+        """
+        處理下載結果；304 但本機沒有可用的內容 (網址索引或圖片本體已被淘汰) 時回傳 None，
+        呼叫端需不帶條件標頭重新下載，不可把 304 的空內容當成圖片存起來。
+        """
+        if result.not_modified:
+            cached = self._load(url, meta) if meta else None
+            if cached is not None:
+                meta['checked_at'] = time.time()
+                self._write_meta(url, meta)
+            return cached
+        return self.store(url, result.content, result.content_type, result.headers)
+
+    def _refetched(self, url, result):
+        """不帶條件標頭重新下載的結果；來源仍回傳 304 時視為下載失敗。"""
+        cached = self._handle_fetch(url, None, result)
+        if cached is None:
+            raise FetchError(f'下載 {url} 失敗: 沒有條件標頭卻收到 HTTP 304')
+        return cached
+
+    def _load(self, url, meta):
+        """讀取網址索引指向的圖片本體；本體已被淘汰 (檢查與讀取之間被其他 worker 刪除) 時回傳 None。"""
+        content = self.read_blob(meta['sha256'])
+        if content is None:
+            return None
+        return CachedImage(
+            url=url,
+            sha256=meta['sha256'],
+            content=content,
+            content_type=meta.get('content_type', 'image/jpeg'),
+        )
+
+    def _read_blob(self, path):
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm[:]
+
+    def _read_meta(self, url):
+        try:
+            with open(self._meta_path(url), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, url, meta):
+        self._atomic_write(self._meta_path(url), json.dumps(meta).encode('utf-8'))
+
+    def _atomic_write(self, path, data):
+        atomic_write(path, data)
+
+
+# 整個 process 共用的快取實體
+image_cache = ImageCache()
@@ -0,0 +1,153 @@
+"""
+送給 Gemini 之前的圖片正規化 (Image Normalization)。
+
+dog.ceo 的原圖大小與格式不一，原本直接把下載到的位元組送給 Gemini，請求內容與圖片 token 數都跟著原圖變大。
+這裡在登記 / 附加圖片之前先處理一次：
+
+1. 以 Pillow 解碼判斷真實格式 (不依賴網址副檔名或來源的 Content-Type)，依 EXIF 方向轉正。
+2. 長邊縮到 CHAT_IMAGE_MAX_DIMENSION 以內 (不放大)；JPEG 以 draft 模式直接縮小解碼。
+3. 以 CHAT_IMAGE_FORMAT / CHAT_IMAGE_QUALITY 重新編碼，不寫入 EXIF、ICC 等中繼資料；
+   透明圖片轉成 JPEG 時鋪上白色背景。
+4. 結果依「原圖內容雜湊 + 規格」快取：正規化後的圖片存入 chat.image_cache 的 blobs/ (內容定址，
+   LocalImageStore 也能直接讀取)，normalized/ 下的索引記錄對應的雜湊；之後同一張圖不必再解碼。
+
+原圖已經是目標格式、不需縮小或轉正，而且重新編碼不會更小時，直接沿用原圖。
+無法解碼的內容 (不是圖片或格式不支援) 記錄後原樣送出，不會讓發問失敗。
+"""
+import io
+import json
+import logging
+
+from django.conf import settings
+from PIL import ExifTags, Image, ImageOps
+
+from .image_cache import CachedImage, atomic_write, image_cache
+
+logger = logging.getLogger(__name__)
+
+# Pillow 格式 -> Content-Type (皆為 Gemini 支援的圖片格式)
+OUTPUT_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'WEBP': 'image/webp',
+    'PNG': 'image/png',
+}
+
+
+def enabled():
+    return getattr(settings, 'CHAT_IMAGE_NORMALIZE', True)
+
+
+def max_dimension():
+    return getattr(settings, 'CHAT_IMAGE_MAX_DIMENSION', 768)
+
+
+def output_format():
+    return getattr(settings, 'CHAT_IMAGE_FORMAT', 'JPEG').upper()
+
+
+def quality():
+    return getattr(settings, 'CHAT_IMAGE_QUALITY', 85)
+
+
+def spec():
+    """目前的正規化規格，作為快取鍵的一部分；調整設定後舊的結果自然不再命中。"""
+    return f'{max_dimension()}-{output_format().lower()}-{quality()}'
+
+
+def normalize(image):
+    """
+    回傳正規化後的 CachedImage (sha256 為正規化後內容的雜湊)。
+    停用、無法解碼或不需處理時回傳原本的 image。
+    """
+    if not enabled():
+        return image
+    index_path = image_cache.root / 'normalized' / image.sha256[:2] / f'{image.sha256}-{spec()}.json'
+    cached = _load(index_path, image)
+    if cached is not None:
+        return cached
+
+    try:
+        encoded = encode(image.content)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logger.info(f'Sending {image.url} without normalization: {e}')
+        return image
+
+    if encoded is None:
+        result = image
+    else:
+        content, content_type = encoded
+        sha256 = image_cache.put_blob(content)
+        image_cache.evict()
+        result = CachedImage(url=image.url, sha256=sha256, content=content, content_type=content_type)
+    atomic_write(index_path, json.dumps({
+        'sha256': result.sha256,
+        'content_type': result.content_type,
+        'size': len(result.content),
+        'source_size': len(image.content),
+    }).encode('utf-8'))
+    return result
+
+
+def _load(index_path, image):
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if meta['sha256'] == image.sha256:
+        return image
+    content = image_cache.read_blob(meta['sha256'])
+    if content is None:
+        # 正規化後的圖片已被淘汰，重新產生
+        return None
+    return CachedImage(url=image.url, sha256=meta['sha256'], content=content, content_type=meta['content_type'])
+
+
+def encode(content):
+    """
+    解碼、轉正、縮小並重新編碼，回傳 (位元組, Content-Type)；原圖已經合用時回傳 None。
+    無法解碼時拋出 OSError / ValueError / DecompressionBombError。
+    """
+    pil_format = output_format()
+    limit = max_dimension()
+    with Image.open(io.BytesIO(content)) as source:
+        source_format = source.format
+        has_metadata = 'exif' in source.info
+        rotated = source.getexif().get(ExifTags.Base.Orientation, 1) != 1
+        needs_resize = max(source.size) > limit
+        if source_format == 'JPEG' and needs_resize:
+            # 以 DCT 縮放直接解碼成接近目標的尺寸，不必先解出整張原圖
+            source.draft('RGB', (limit, limit))
+        image = ImageOps.exif_transpose(source)
+        if max(image.size) > limit:
+            image.thumbnail((limit, limit), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        _prepare(image, pil_format).save(output, pil_format, **_save_options(pil_format))
+
+    data = output.getvalue()
+    if source_format == pil_format and not (needs_resize or rotated or has_metadata) and len(data) >= len(content):
+        return None
+    return data, OUTPUT_FORMATS[pil_format]
+
+
+def _prepare(image, pil_format):
+    """轉成目標格式可以編碼的色彩模式。"""
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if pil_format == 'JPEG':
+        if has_alpha:
+            rgba = image.convert('RGBA')
+            background = Image.new('RGB', rgba.size, 'white')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            return background
+        return image if image.mode in ('RGB', 'L') else image.convert('RGB')
+    if image.mode in ('RGB', 'RGBA', 'L'):
+        return image
+    return image.convert('RGBA' if has_alpha else 'RGB')
+
+
+def _save_options(pil_format):
+    if pil_format == 'JPEG':
+        return {'quality': quality(), 'optimize': True}
+    if pil_format == 'WEBP':
+        return {'quality': quality(), 'method': 4}
+    return {'optimize': True}
@@ -0,0 +1,133 @@
+"""
+以資料庫實作的背景對話工作佇列 (Job Queue)。
+
+慢速的 Gemini 呼叫移出 HTTP 請求流程：view 只負責建立 ChatJob 並回傳 202，
+由 `python manage.py chat_worker` 啟動的 worker process 領取並執行。
+
+1. 領取 (claim)：以「條件式 UPDATE」搶工作，只有一個 worker 能成功，不需要資料庫層級的鎖 (SQLite 也適用)。
+2. 租約 (lease)：領取時寫入租約到期時間；worker 當掉時，租約到期後工作會被其他 worker 重新領取，
+   每次領取都計入嘗試次數，讓 worker 一再當掉 (OOM 等) 的工作也會在 max_attempts 後標記為 failed。
+3. 重試：可重試的錯誤以指數退避重新排入佇列，超過 max_attempts 後標記為 failed。
+4. 順序：同一個 ChatSession 內的工作依建立順序逐一執行，前一筆未完成前不會領取下一筆。
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from google.genai import errors
+
+from . import services
+from .models import ChatJob
+
+logger = logging.getLogger(__name__)
+
+UNFINISHED = ('queued', 'running')
+
+
+def lease_seconds():
+    return getattr(settings, 'CHAT_JOB_LEASE_SECONDS', 120)
+
+
+def enqueue(session, prompt):
+    """建立一筆等待執行的對話工作。"""
+    return ChatJob.objects.create(
+        session=session,
+        prompt=prompt,
+        max_attempts=getattr(settings, 'CHAT_JOB_MAX_ATTEMPTS', 3),
+    )
+
+
+def claim(worker_id, batch=20):
+    """
+    領取下一筆可執行的工作，沒有可執行的工作時回傳 None。
+    可執行 = 已到 run_after 的 queued 工作，或租約已過期、仍有嘗試次數的 running 工作；
+    且同一個 Session 中沒有更早、尚未完成的工作。
+    """
+    now = timezone.now()
+    # 租約過期且已用完嘗試次數：執行它的 worker 每次都當掉，不再重新領取
+    expired = ChatJob.objects.filter(
+        status='running', lease_expires_at__lt=now, attempts__gte=F('max_attempts')
+    ).update(status='failed', error='執行逾時或 worker 中止', lease_expires_at=None, updated_at=now)
+    if expired:
+        logger.warning(f"{expired} ChatJob(s) failed after exhausting attempts on expired leases")
+    # 被同一個 Session 中更早的工作擋住的直接在查詢中排除，
+    # 否則單一 Session 積壓大量工作時會佔滿整批候選，其他 Session 可執行的工作永遠領不到
+    earlier_pending = ChatJob.objects.filter(
+        session_id=OuterRef('session_id'), id__lt=OuterRef('id'), status__in=UNFINISHED
+    )
+    candidates = ChatJob.objects.filter(
+        Q(status='queued', run_after__lte=now)
+        | Q(status='running', lease_expires_at__lt=now, attempts__lt=F('max_attempts')),
+        ~Exists(earlier_pending),
+    ).order_by('id')[:batch]
+
+    for job in candidates:
+        # 條件式 UPDATE：只有在狀態與租約都和剛才讀到的一樣時才會成功，確保同一筆工作只被一個 worker 領取
+        claimed = ChatJob.objects.filter(
+            id=job.id, status=job.status, lease_expires_at=job.lease_expires_at
+        ).update(
+            status='running',
+            lease_owner=worker_id,
+            lease_expires_at=now + timedelta(seconds=lease_seconds()),
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def is_retryable(error):
+    """Gemini 回傳 4xx (配額用盡 429 除外) 代表請求本身有問題，重試也不會成功。"""
+    if isinstance(error, errors.ClientError):
+        return getattr(error, 'code', None) == 429
+    return True
+
+
+def run_job(job, worker_id):
+    """執行已領取的工作，成功時寫入對話並標記完成，失敗時依規則重試或標記失敗。"""
+    session = job.session
+    try:
+        ai_text = services.generate_reply(session, session.image_url, job.prompt)
+    except Exception as e:
+        logger.warning(f"ChatJob {job.id} attempt {job.attempts} failed: {e}")
+        fail(job, worker_id, e)
+        return job
+
+    with transaction.atomic():
+        # 只有仍持有租約時才寫入，避免租約過期後被其他 worker 重複執行而存成兩份對話
+        updated = ChatJob.objects.filter(id=job.id, status='running', lease_owner=worker_id).update(
+            status='done', result=ai_text, error='', lease_expires_at=None, updated_at=timezone.now(),
+        )
+        if updated:
+            services.save_turn(session, job.prompt, ai_text)
+        else:
+            logger.warning(f"ChatJob {job.id} lease lost by {worker_id}; result discarded")
+
+    job.refresh_from_db()
+    return job
+
+
+def fail(job, worker_id, error):
+    now = timezone.now()
+    if is_retryable(error) and job.attempts < job.max_attempts:
+        # 指數退避：第 1 次失敗等 2 秒、第 2 次 4 秒...
+        changes = {'status': 'queued', 'run_after': now + timedelta(seconds=2 ** job.attempts)}
+    else:
+        changes = {'status': 'failed'}
+    ChatJob.objects.filter(id=job.id, status='running', lease_owner=worker_id).update(
+        error=str(error), lease_expires_at=None, updated_at=now, **changes,
+    )
+    job.refresh_from_db()
+
+
+def process_next(worker_id):
+    """領取並執行一筆工作；回傳執行過的工作，沒有工作時回傳 None。"""
+    job = claim(worker_id)
+    if job is None:
+        return None
+    return run_job(job, worker_id)
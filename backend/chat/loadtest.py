@@ -0,0 +1,314 @@
+"""
+端對端壓力測試 (Load Benchmark Harness)，由 python manage.py benchmark_load 執行。
+
+在同一個 process 中以多個執行緒、透過 Django 測試 client 走完整的 middleware → 驗證 → view → ORM 流程，
+外部相依全部換成本機替身，因此結果只反映這個專案本身的成本：
+
+- Gemini：FakeGenAIClient (chat.fakes)，可設定首個 token 前的延遲與串流速率。
+- 狗狗圖片：本機 HTTP 伺服器 (ImageServer)，回傳固定的 JPEG，圖片快取放在暫存目錄。
+- 資料庫：全新的暫存 SQLite 檔案 (與 settings 相同的設定，含 SQLITE_CONCURRENT)，結束後刪除。
+
+每種操作 (收藏 CRUD、讀取對話紀錄、發問、串流發問...) 依權重隨機混合，
+記錄每個請求的延遲、狀態碼與 SQL 查詢數，最後彙整成 p50 / p95 / p99、每秒請求數與每請求查詢數。
+查詢數以請求所在執行緒的連線計算；啟用 DB_WRITE_BATCHING 時由 writer 執行緒代為執行的寫入不會計入。
+"""
+import itertools
+import json
+import platform
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import django
+from django.db import connection, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+# 最小的 JPEG 檔頭 + 填充內容，chat.fetch 會依 magic bytes 判斷為 image/jpeg
+JPEG_BYTES = b'\xff\xd8\xff\xe0' + b'dog' * 2000
+
+BREEDS = ['husky', 'corgi', 'shiba', 'poodle', 'beagle', 'akita', 'pug', 'samoyed']
+PROMPTS = ['這是什麼品種？', '牠怕冷嗎？', '牠需要多少運動量？', '毛髮要怎麼整理？', '適合住在公寓嗎？', '壽命大概多長？']
+
+# 預設的操作權重：以前端實際的使用情境為準，讀取遠多於寫入
+DEFAULT_MIX = {
+    'favorites_list': 30,
+    'favorite_add': 8,
+    'favorite_remove': 4,
+    'sessions_list': 10,
+    'history_read': 25,
+    'chat_turn': 15,
+    'chat_stream': 8,
+}
+
+
+def parse_mix(value):
+    """解析 'favorites_list=30,chat_turn=10' 形式的權重設定。"""
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f'未知的操作：{name} (可用：{", ".join(OPERATIONS)})')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# =========================================
+# 本機圖片伺服器
+# =========================================
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(JPEG_BYTES)))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(JPEG_BYTES)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageServer:
+    """在隨機埠號啟動的狗狗圖片伺服器，任何路徑都回傳同一張 JPEG。"""
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def image_url(self, breed, n):
+        return f'{self.base_url}/breeds/{breed}/{n}.jpg'
+
+
+# =========================================
+# 操作
+# =========================================
+
+@dataclass
+class Worker:
+    """一個模擬使用者：自己的 client、token 與收藏 / 對話狀態。"""
+    client: Client
+    images: list
+    rng: random.Random
+    image_server: ImageServer
+    use_etags: bool = False
+    favorite_ids: list = field(default_factory=list)
+    etags: dict = field(default_factory=dict)
+
+    def get(self, path, data=None):
+        headers = {}
+        key = (path, tuple(sorted((data or {}).items())))
+        if self.use_etags and key in self.etags:
+            headers['HTTP_IF_NONE_MATCH'] = self.etags[key]
+        response = self.client.get(path, data, **headers)
+        if self.use_etags and response.get('ETag'):
+            self.etags[key] = response['ETag']
+        return response
+
+
+def op_favorites_list(worker):
+    return worker.get('/api/dogs/')
+
+
+def op_favorite_add(worker):
+    url = worker.image_server.image_url(worker.rng.choice(BREEDS), uuid.uuid4().hex)
+    response = worker.client.post('/api/dogs/', {'url': url}, content_type='application/json')
+    if response.status_code == 201:
+        worker.favorite_ids.append(response.json()['id'])
+    return response
+
+
+def op_favorite_remove(worker):
+    if not worker.favorite_ids:
+        return op_favorite_add(worker)
+    pk = worker.favorite_ids.pop(worker.rng.randrange(len(worker.favorite_ids)))
+    return worker.client.delete(f'/api/dogs/{pk}/')
+
+
+def op_sessions_list(worker):
+    return worker.get('/api/chat/ask/')
+
+
+def op_history_read(worker):
+    return worker.get('/api/chat/ask/', {'image_url': worker.rng.choice(worker.images)})
+
+
+def op_chat_turn(worker):
+    return worker.client.post('/api/chat/ask/', {
+        'image_url': worker.rng.choice(worker.images), 'prompt': worker.rng.choice(PROMPTS),
+    }, content_type='application/json')
+
+
+def op_chat_stream(worker):
+    response = worker.client.post('/api/chat/ask/stream/', {
+        'image_url': worker.rng.choice(worker.images), 'prompt': worker.rng.choice(PROMPTS),
+    }, content_type='application/json')
+    if response.streaming:
+        b''.join(response.streaming_content)
+    return response
+
+
+OPERATIONS = {
+    'favorites_list': op_favorites_list,
+    'favorite_add': op_favorite_add,
+    'favorite_remove': op_favorite_remove,
+    'sessions_list': op_sessions_list,
+    'history_read': op_history_read,
+    'chat_turn': op_chat_turn,
+    'chat_stream': op_chat_stream,
+}
+
+
+# =========================================
+# 統計
+# =========================================
+
+def percentile(values, pct):
+    """最近秩 (nearest-rank) 百分位數；values 需已排序。"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(len(values) * pct / 100)) - 1))]
+
+
+class Recorder:
+    """收集每個請求的 (操作, 延遲, 狀態碼, 查詢數)，執行緒安全。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+
+    def add(self, op, seconds, status, queries):
+        with self._lock:
+            self.samples.append((op, seconds, status, queries))
+
+    def summarize(self, elapsed):
+        by_op = {}
+        for op, seconds, status, queries in self.samples:
+            by_op.setdefault(op, []).append((seconds, status, queries))
+        operations = {op: summarize_samples(samples, elapsed) for op, samples in sorted(by_op.items())}
+        totals = summarize_samples([s[1:] for s in self.samples], elapsed)
+        return totals, operations
+
+
+def summarize_samples(samples, elapsed):
+    latencies = sorted(seconds for seconds, _, _ in samples)
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _ in samples if status >= 400),
+        'requests_per_second': round(len(samples) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+        'mean_ms': ms(sum(latencies) / len(latencies) if latencies else None),
+        'queries_per_request': round(sum(q for _, _, q in samples) / len(samples), 2) if samples else None,
+        'statuses': statuses,
+    }
+
+
+# =========================================
+# 執行
+# =========================================
+
+def seed(users, favorites_per_user, image_server):
+    """建立測試使用者 (含 Token) 與初始收藏，回傳 [(token, 收藏 id 清單)]。"""
+    from django.contrib.auth.models import User
+    from rest_framework.authtoken.models import Token
+
+    from api.models import DogImage
+
+    accounts = []
+    for i in range(users):
+        user = User.objects.create_user(username=f'bench-{i}', password='bench-password')
+        token = Token.objects.create(user=user)
+        ids = [
+            DogImage.objects.create(owner=user, url=image_server.image_url(BREEDS[n % len(BREEDS)], f'seed-{n}')).id
+            for n in range(favorites_per_user)
+        ]
+        accounts.append((token.key, ids))
+    return accounts
+
+
+def run(*, concurrency, duration, max_requests, mix, seed_value, image_server, accounts, images_per_user, use_etags):
+    """以 concurrency 個執行緒執行 duration 秒 (或總共 max_requests 個請求)，回傳 (Recorder, 實際秒數)。"""
+    recorder = Recorder()
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    counter = itertools.count()
+    barrier = threading.Barrier(concurrency + 1)
+    deadline = [None]
+
+    def work(index):
+        rng = random.Random(seed_value + index)
+        token, favorite_ids = accounts[index % len(accounts)]
+        worker = Worker(
+            client=Client(HTTP_AUTHORIZATION=f'Token {token}'),
+            images=[image_server.image_url(BREEDS[(index + n) % len(BREEDS)], n) for n in range(images_per_user)],
+            rng=rng,
+            image_server=image_server,
+            use_etags=use_etags,
+            favorite_ids=list(favorite_ids) if index < len(accounts) else [],
+        )
+        barrier.wait()
+        try:
+            while time.monotonic() < deadline[0]:
+                if max_requests and next(counter) >= max_requests:
+                    break
+                op = rng.choices(names, weights)[0]
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    try:
+                        status = OPERATIONS[op](worker).status_code
+                    except Exception:
+                        status = 599
+                    seconds = time.perf_counter() - started
+                recorder.add(op, seconds, status, len(queries))
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=work, args=(i,), name=f'bench-{i}') for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.monotonic() + duration
+    started = time.perf_counter()
+    barrier.wait()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+
+def environment():
+    """記錄在結果中的執行環境，方便比較不同次的結果。"""
+    from django.conf import settings
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'database': connection.vendor,
+        'sqlite_concurrent': getattr(settings, 'SQLITE_CONCURRENT', False),
+        'db_write_batching': getattr(settings, 'DB_WRITE_BATCHING', False),
+        'chat_ask_mode': settings.CHAT_ASK_MODE,
+    }
+
+
+def write_json(path, result):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,48 @@
+"""
+回填 ChatSession 的活動資訊 (message_count / last_message_at / last_message_preview)。
+
+新增這些欄位的 migration (0006_chatsession_activity) 已經回填過既有的 Session；
+這個指令用於欄位與訊息不一致時 (例如直接修改過資料庫) 重新計算：
+
+    python manage.py backfill_session_activity
+
+每批以一個 UPDATE + 子查詢完成，不會把訊息內容讀進 Python；可重複執行，結果相同。
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+from chat.models import PREVIEW_LENGTH, ChatMessage, ChatSession
+
+
+class Command(BaseCommand):
+    help = '依現有訊息重新計算每個對話 Session 的訊息數、最後活動時間與預覽'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='每批更新的 Session 數 (預設 500)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        messages = ChatMessage.objects.filter(session=OuterRef('pk'))
+        latest = messages.order_by('-created_at', '-id')
+        message_count = messages.order_by().values('session').annotate(n=Count('id')).values('n')
+
+        updated = 0
+        last_id = 0
+        while True:
+            ids = list(
+                ChatSession.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            updated += ChatSession.objects.filter(pk__in=ids).update(
+                message_count=Coalesce(Subquery(message_count, output_field=IntegerField()), Value(0)),
+                last_message_at=Subquery(latest.values('created_at')[:1]),
+                last_message_preview=Coalesce(
+                    Substr(Subquery(latest.values('content')[:1]), 1, PREVIEW_LENGTH), Value('')
+                ),
+            )
+            last_id = ids[-1]
+            self.stdout.write(f'已更新 {updated} 個 Session')
+
+        self.stdout.write(self.style.SUCCESS(f'完成，共更新 {updated} 個 Session'))
@@ -0,0 +1,135 @@
+"""
+端對端壓力測試：以本機替身取代 Gemini 與狗狗圖片來源，對整個 Django app 送出混合的請求。
+
+    python manage.py benchmark_load --users 20 --concurrency 16 --duration 30 --latency 0.3 --token-rate 50
+    python manage.py benchmark_load --mix favorites_list=50,history_read=50 --etag --output result.json
+
+資料庫為全新的暫存 SQLite 檔案 (沿用目前的資料庫設定，例如 SQLITE_CONCURRENT=1)，不會動到 db.sqlite3；
+圖片快取也改放在暫存目錄。實作細節見 chat/loadtest.py。
+
+輸出每種操作與整體的請求數、錯誤數、p50 / p95 / p99、每秒請求數與每請求 SQL 查詢數；
+--output 另外寫出機器可讀的 JSON，方便比較不同版本或設定的結果。
+"""
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from chat import loadtest
+from chat.fakes import FakeGenAIClient
+from chat.genai_client import override_client
+from chat.response_cache import response_cache
+
+
+class Command(BaseCommand):
+    help = '以本機的 Gemini 與圖片替身，對收藏、對話紀錄與發問 API 執行混合負載的壓力測試'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10, help='測試使用者數 (預設 10)')
+        parser.add_argument('--concurrency', type=int, default=8, help='同時送出請求的執行緒數 (預設 8)')
+        parser.add_argument('--duration', type=float, default=10, help='執行秒數 (預設 10)')
+        parser.add_argument('--requests', type=int, default=0, help='總請求數上限 (0 表示只以 --duration 為準)')
+        parser.add_argument('--latency', type=float, default=0.2, help='假 Gemini 首個 token 前的延遲秒數 (預設 0.2)')
+        parser.add_argument('--token-rate', type=float, default=None, help='假 Gemini 串流時每秒的段數 (預設不限速)')
+        parser.add_argument('--favorites', type=int, default=20, help='每個使用者預先建立的收藏數 (預設 20)')
+        parser.add_argument('--images', type=int, default=5, help='每個執行緒輪流發問的圖片數 (預設 5)')
+        parser.add_argument(
+            '--mix', default='',
+            help='操作權重，例如 favorites_list=30,chat_turn=10 (可用：%s)' % ', '.join(loadtest.OPERATIONS),
+        )
+        parser.add_argument('--etag', action='store_true', help='讀取時帶上 If-None-Match，模擬前端的條件式輪詢')
+        parser.add_argument('--response-cache', action='store_true', help='保留 AI 回覆快取 (預設停用，讓每次發問都呼叫假 Gemini)')
+        parser.add_argument(
+            '--throttle', action='store_true',
+            help='保留每位使用者的發問限流 (預設停用，少數測試使用者連續發問時會被限流而量不到伺服器本身的成本)',
+        )
+        parser.add_argument('--seed', type=int, default=0, help='亂數種子 (預設 0)')
+        parser.add_argument('--output', help='將結果以 JSON 寫入此路徑')
+
+    def handle(self, *args, **options):
+        try:
+            mix = loadtest.parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        users = max(1, options['users'])
+        concurrency = max(1, options['concurrency'])
+
+        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmp:
+            setup_test_environment()
+            old_name = connection.settings_dict['NAME']
+            connection.settings_dict['TEST'] = {
+                **connection.settings_dict.get('TEST', {}), 'NAME': str(Path(tmp) / 'bench.sqlite3'),
+            }
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            fake = FakeGenAIClient(latency=options['latency'], token_rate=options['token_rate'])
+            try:
+                with override_settings(
+                    CHAT_IMAGE_CACHE_DIR=Path(tmp) / 'images',
+                    CHAT_ASK_MODE='sync',
+                    CHAT_RESPONSE_CACHE_ENABLED=options['response_cache'],
+                    CHAT_ASK_RATE=settings.CHAT_ASK_RATE if options['throttle'] else 0,
+                ), override_client(fake), loadtest.ImageServer() as image_server:
+                    response_cache.clear()
+                    started_at = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+                    started = time.perf_counter()
+                    accounts = loadtest.seed(users, max(0, options['favorites']), image_server)
+                    seed_seconds = time.perf_counter() - started
+                    recorder, elapsed = loadtest.run(
+                        concurrency=concurrency,
+                        duration=options['duration'],
+                        max_requests=options['requests'],
+                        mix=mix,
+                        seed_value=options['seed'],
+                        image_server=image_server,
+                        accounts=accounts,
+                        images_per_user=max(1, options['images']),
+                        use_etags=options['etag'],
+                    )
+                    environment = loadtest.environment()
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        totals, operations = recorder.summarize(elapsed)
+        result = {
+            'config': {
+                'users': users,
+                'concurrency': concurrency,
+                'duration': options['duration'],
+                'requests': options['requests'],
+                'latency': options['latency'],
+                'token_rate': options['token_rate'],
+                'favorites': options['favorites'],
+                'images': options['images'],
+                'mix': mix,
+                'etag': options['etag'],
+                'response_cache': options['response_cache'],
+                'seed': options['seed'],
+            },
+            'environment': environment,
+            'started_at': started_at,
+            'seed_seconds': round(seed_seconds, 3),
+            'elapsed_seconds': round(elapsed, 3),
+            'model_calls': len(fake.calls),
+            'totals': totals,
+            'operations': operations,
+        }
+        if options['output']:
+            loadtest.write_json(options['output'], result)
+        self.print_table(totals, operations)
+
+    def print_table(self, totals, operations):
+        self.stdout.write(
+            f"{'operation':<16} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+            f"{'p99 ms':>8} {'queries':>8}"
+        )
+        for name, stats in [*operations.items(), ('total', totals)]:
+            self.stdout.write(
+                f"{name:<16} {stats['requests']:>8} {stats['errors']:>6} {stats['requests_per_second'] or 0:>8} "
+                f"{stats['p50_ms'] or '-':>8} {stats['p95_ms'] or '-':>8} {stats['p99_ms'] or '-':>8} "
+                f"{stats['queries_per_request'] if stats['queries_per_request'] is not None else '-':>8}"
+            )
@@ -0,0 +1,77 @@
+"""
+啟動背景對話 worker：
+
+    python manage.py chat_worker --processes 4
+
+每個 worker process 反覆從資料庫佇列 (ChatJob) 領取工作並執行，收到 SIGTERM / Ctrl+C 時會做完手上的工作再結束。
+"""
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from chat import jobs
+
+
+def work_loop(worker_id, poll_interval, once):
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while not stopping:
+        close_old_connections()
+        job = jobs.process_next(worker_id)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = '啟動處理 AI 對話工作佇列 (ChatJob) 的背景 worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='worker process 數量')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='佇列為空時的輪詢間隔 (秒)')
+        parser.add_argument('--once', action='store_true', help='處理完目前佇列中的工作後即結束')
+
+    def handle(self, *args, **options):
+        processes = max(1, options['processes'])
+        prefix = f'{socket.gethostname()}-{os.getpid()}'
+
+        if processes == 1:
+            self.stdout.write(f'chat_worker 啟動 (單一 process: {prefix}-0)')
+            work_loop(f'{prefix}-0', options['poll_interval'], options['once'])
+            return
+
+        # fork 之前關閉資料庫連線，避免子行程共用父行程的連線
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(
+                target=work_loop,
+                args=(f'{prefix}-{i}', options['poll_interval'], options['once']),
+                name=f'chat-worker-{i}',
+            )
+            for i in range(processes)
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f'chat_worker 啟動 {processes} 個 process')
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
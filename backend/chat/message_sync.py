@@ -0,0 +1,108 @@
+"""
+對話訊息的增量同步與分頁 (Incremental Message Sync)。
+
+原本每次打開對話視窗都會重新下載整段對話，對話越長，重新打開的成本就越高。
+前端會保留已讀取過的訊息，這裡讓它只需要補上缺少的部分：
+
+1. ?since=<訊息 id>：只回傳這則訊息之後的新訊息 (依時間由舊到新)。
+   以訊息 id 作為游標 (遞增且不會重複)，順便確認這則訊息仍存在於 Session 中。
+2. ?before=<訊息 id>：往回讀取更早的一頁，用於長對話的「載入更早的訊息」。
+3. 都未提供時只回傳最新的一頁 (CHAT_MESSAGES_PAGE_SIZE 則)，has_older 表示是否還有更早的訊息。
+4. 游標已失效 (對話被清空、訊息不存在) 或新訊息超過一頁時，改回傳最新的一頁並標記 reset，
+   前端應以這一頁取代手上的副本，而不是合併。
+
+每種情況都只需要一到兩個以 (session, created_at, id) 索引完成的查詢。
+"""
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+
+@dataclass
+class MessagePage:
+    """一次同步的結果：messages 依時間由舊到新排列。"""
+    messages: list = field(default_factory=list)
+    has_older: bool = False
+    reset: bool = False
+
+
+def page_size(value=None):
+    """每頁訊息數，預設為 CHAT_MESSAGES_PAGE_SIZE，上限為 CHAT_MESSAGES_MAX_PAGE_SIZE。"""
+    default = getattr(settings, 'CHAT_MESSAGES_PAGE_SIZE', 50)
+    maximum = getattr(settings, 'CHAT_MESSAGES_MAX_PAGE_SIZE', 200)
+    try:
+        size = int(value) if value not in (None, '') else default
+    except (TypeError, ValueError):
+        return default
+    return min(max(size, 1), maximum)
+
+
+def parse_cursor(params, name):
+    """讀取 since / before 參數 (訊息 id)；未提供時回傳 None，格式錯誤時回傳 400。"""
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        cursor = int(value)
+    except (TypeError, ValueError):
+        cursor = -1
+    if cursor < 0:
+        raise ValidationError({name: '必須是訊息 id (非負整數)。'})
+    return cursor
+
+
+def parse_params(params):
+    """從查詢參數取出 (since, before, limit)。"""
+    return parse_cursor(params, 'since'), parse_cursor(params, 'before'), page_size(params.get('page_size'))
+
+
+# --- 查詢 ---
+def latest_query(session, limit, before=None):
+    """最新 (或 before 之前) 的 limit + 1 則訊息，由新到舊；多取的一則用來判斷 has_older。"""
+    queryset = session.messages.order_by('-created_at', '-id')
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    return queryset[:limit + 1]
+
+
+def delta_query(session, since, limit):
+    """
+    從游標那則訊息 (含) 開始由舊到新取 limit + 2 則：
+    第一則用來確認游標仍存在，最後多取的一則用來判斷新訊息是否超過一頁。
+    """
+    return session.messages.filter(id__gte=since).order_by('created_at', 'id')[:limit + 2]
+
+
+def latest_page(rows, limit, reset=False):
+    return MessagePage(messages=list(reversed(rows[:limit])), has_older=len(rows) > limit, reset=reset)
+
+
+def delta_page(rows, since, limit):
+    """游標仍有效且新訊息不超過一頁時回傳 MessagePage，否則回傳 None (需要 reset)。"""
+    if not rows or rows[0].id != since or len(rows) > limit + 1:
+        return None
+    # has_older 只描述最新一頁的情況；增量同步時前端沿用自己的狀態
+    return MessagePage(messages=rows[1:])
+
+
+def load_page(session, since=None, before=None, limit=None):
+    """依游標讀取一頁訊息，回傳 MessagePage。since=0 視為沒有任何已知訊息。"""
+    limit = limit or page_size()
+    if since:
+        page = delta_page(list(delta_query(session, since, limit)), since, limit)
+        if page is not None:
+            return page
+        return latest_page(list(latest_query(session, limit)), limit, reset=True)
+    return latest_page(list(latest_query(session, limit, before)), limit)
+
+
+async def aload_page(session, since=None, before=None, limit=None):
+    """load_page 的非同步版本。"""
+    limit = limit or page_size()
+    if since:
+        page = delta_page([msg async for msg in delta_query(session, since, limit)], since, limit)
+        if page is not None:
+            return page
+        return latest_page([msg async for msg in latest_query(session, limit)], limit, reset=True)
+    return latest_page([msg async for msg in latest_query(session, limit, before)], limit)
@@ -0,0 +1,38 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatsession_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_handle',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_mime_type',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_uri',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:22
+
+import django.db.models.deletion
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_image_url_hash(apps, schema_editor):
+    """既有的 Session 補上 image_url_hash (與 chat.models.hash_image_url 相同的算法)。"""
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    for session in ChatSession.objects.only('id', 'image_url').iterator():
+        ChatSession.objects.filter(pk=session.pk).update(
+            image_url_hash=hashlib.sha256(session.image_url.encode('utf-8')).hexdigest()
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatsession_image_handle'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='chatsession',
+            unique_together=set(),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='image_url_hash',
+            field=models.CharField(default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_image_url_hash, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='session',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.chatsession'),
+        ),
+        migrations.AlterField(
+            model_name='chatsession',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='chat_sessions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session', 'created_at', 'id'], name='chat_message_session_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='chat_session_user_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatsession',
+            constraint=models.UniqueConstraint(fields=('user', 'image_url_hash'), name='chat_session_user_image_uniq'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 6.1.2 on 2026-10-18 07:24
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+
+# 與 chat.models.PREVIEW_LENGTH 相同；migration 不引用目前的程式碼，避免之後修改影響歷史版本
+PREVIEW_LENGTH = 100
+BATCH_SIZE = 500
+
+
+def backfill_activity(apps, schema_editor):
+    """
+    依現有訊息回填新增的欄位：否則既有的 Session message_count 都是 0，會被 with_messages() 過濾掉。
+    每批以一個 UPDATE + 子查詢完成 (與 backfill_session_activity 指令相同)，不會把訊息內容讀進 Python。
+    """
+    ChatSession = apps.get_model('chat', 'ChatSession')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    messages = ChatMessage.objects.filter(session=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    message_count = messages.order_by().values('session').annotate(n=Count('id')).values('n')
+
+    last_id = 0
+    while True:
+        ids = list(ChatSession.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:BATCH_SIZE])
+        if not ids:
+            break
+        ChatSession.objects.filter(pk__in=ids).update(
+            message_count=Coalesce(Subquery(message_count, output_field=IntegerField()), Value(0)),
+            last_message_at=Subquery(latest.values('created_at')[:1]),
+            last_message_preview=Coalesce(Substr(Subquery(latest.values('content')[:1]), 1, PREVIEW_LENGTH), Value('')),
+        )
+        last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_session_url_hash_and_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatsession',
+            name='chat_session_user_created_idx',
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='last_message_preview',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatsession',
+            index=models.Index(fields=['user', '-last_message_at', '-id'], name='chat_session_user_active_idx'),
+        ),
+        migrations.RunPython(backfill_activity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 6.1.2 on 2026-10-18 08:22
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatsession_activity'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='chatsession',
+            name='chat_session_user_image_uniq',
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='chatsession',
+            constraint=models.UniqueConstraint(condition=models.Q(('deleted_at__isnull', True)), fields=('user', 'image_url_hash'), name='chat_session_user_image_uniq'),
+        ),
+    ]
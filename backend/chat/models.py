@@ -1,5 +1,46 @@
+import hashlib
+
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
+
+
+def hash_image_url(image_url):
+    """圖片網址的 SHA-256 (64 字元)，作為 (user, 圖片) 唯一鍵與查詢用的索引欄位。"""
+    return hashlib.sha256(image_url.encode('utf-8')).hexdigest()
+
+
+# 對話列表顯示的最後一則訊息預覽長度 (字元)
+PREVIEW_LENGTH = 100
+
+
+class ChatSessionQuerySet(models.QuerySet):
+    """以網址雜湊查詢 Session，讓 (user, 圖片) 的查詢走固定長度的唯一索引，而不是比對 500 字元的網址。"""
+
+    def for_image(self, user, image_url):
+        return self.filter(user=user, image_url_hash=hash_image_url(image_url))
+
+    def get_or_create_for(self, user, image_url):
+        return self.get_or_create(
+            user=user, image_url_hash=hash_image_url(image_url), defaults={'image_url': image_url}
+        )
+
+    async def aget_or_create_for(self, user, image_url):
+        return await self.aget_or_create(
+            user=user, image_url_hash=hash_image_url(image_url), defaults={'image_url': image_url}
+        )
+
+    def with_messages(self):
+        """只保留至少有一則訊息的 Session (讀取反正規化的 message_count，不需要 JOIN 訊息表)。"""
+        return self.filter(message_count__gt=0)
+
+
+class ChatSessionManager(models.Manager.from_queryset(ChatSessionQuerySet)):
+    """預設只看得到未刪除的 Session；已標記刪除、等待背景清除的 Session (見 api/purge.py) 一律隱藏。"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 
 class ChatSession(models.Model):
     """
@@ -8,15 +49,53 @@ class ChatSession(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, 
         on_delete=models.CASCADE,
-        related_name='chat_sessions'
+        related_name='chat_sessions',
+        # 由 (user, image_url_hash) 唯一鍵與 (user, created_at, id) 複合索引涵蓋
+        db_index=False,
     )
     image_url = models.URLField(max_length=500)
+    # image_url 的 SHA-256，由 save() 自動填入；唯一鍵與查詢都使用這個欄位
+    image_url_hash = models.CharField(max_length=64, default='', editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # 反正規化的活動資訊：寫入或清空訊息時同步更新 (見 chat/services.py)，對話列表只需讀取這張表
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    # 滾動摘要：較早的對話會被濃縮成摘要，只有最近幾輪會原文送給模型 (見 chat/history.py)
+    summary = models.TextField(blank=True, default='')
+    # 已併入摘要的最後一則 ChatMessage id (0 表示尚未有任何訊息被摘要)
+    summary_until = models.PositiveBigIntegerField(default=0)
+    # 已登記的圖片附件：之後的對話以 handle 引用，不必重新附加圖片 (見 chat/attachments.py)
+    image_handle = models.CharField(max_length=255, blank=True)
+    image_uri = models.CharField(max_length=500, blank=True)
+    image_mime_type = models.CharField(max_length=100, blank=True)
+    image_sha256 = models.CharField(max_length=64, blank=True)
+    image_expires_at = models.DateTimeField(null=True, blank=True)
+    # 刪除全部對話時只在請求中標記，資料由背景分批清除 (見 api/purge.py)；標記後預設的 objects 就查不到
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    objects = ChatSessionManager()
+    # 包含已標記刪除的 Session (背景清除使用)
+    all_objects = ChatSessionQuerySet.as_manager()
 
     class Meta:
-        # 確保同一個使用者對同一張圖片只會產生一個對話 Session
-        unique_together = ('user', 'image_url')
         ordering = ['-created_at']
+        constraints = [
+            # 確保同一個使用者對同一張圖片只會產生一個 (未刪除的) 對話 Session；
+            # 等待清除的舊 Session 不佔用唯一鍵，刪除後立刻可以重新開始同一張圖片的對話
+            models.UniqueConstraint(
+                fields=['user', 'image_url_hash'], condition=models.Q(deleted_at__isnull=True),
+                name='chat_session_user_image_uniq',
+            ),
+        ]
+        indexes = [
+            # 對話列表：WHERE user_id = ? ORDER BY last_message_at DESC, id DESC (依最近活動的游標分頁)
+            models.Index(fields=['user', '-last_message_at', '-id'], name='chat_session_user_active_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.image_url_hash = hash_image_url(self.image_url)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.user.username} - {self.image_url[:30]}..."
@@ -33,7 +112,9 @@ class ChatMessage(models.Model):
     session = models.ForeignKey(
         ChatSession, 
         on_delete=models.CASCADE, 
-        related_name='messages'
+        related_name='messages',
+        # 由 Meta.indexes 的 (session, created_at, id) 複合索引涵蓋，不需要另一個單欄索引
+        db_index=False,
     )
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
@@ -41,6 +122,50 @@ class ChatMessage(models.Model):
 
     class Meta:
         ordering = ['created_at'] # 對話依時間正序排列，方便前端直接渲染
+        indexes = [
+            # 讀取單一 Session 的對話：WHERE session_id = ? ORDER BY created_at, id
+            models.Index(fields=['session', 'created_at', 'id'], name='chat_message_session_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.role}: {self.content[:20]}..."
+
+class ChatJob(models.Model):
+    """
+    背景對話工作 (存放在資料庫中的工作佇列，不需要額外的 Broker)。
+    POST /api/chat/ask/ 以非同步模式發問時會建立一筆工作，由 chat_worker 指令啟動的 worker 領取執行。
+    """
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),    # 等待領取 (含等待重試)
+        ('running', 'Running'),  # 已被 worker 領取，租約期限內由該 worker 負責
+        ('done', 'Done'),
+        ('failed', 'Failed'),    # 已用完重試次數或遇到不可重試的錯誤
+    )
+
+    session = models.ForeignKey(
+        ChatSession,
+        on_delete=models.CASCADE,
+        related_name='jobs'
+    )
+    prompt = models.TextField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    # 最早可被領取的時間 (重試時用來實作退避等待)
+    run_after = models.DateTimeField(default=timezone.now)
+    # 租約：領取的 worker 與租約到期時間；worker 當掉時，租約到期後可被其他 worker 重新領取
+    lease_owner = models.CharField(max_length=100, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['id']  # 先進先出
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
+        ]
 
     def __str__(self):
-        return f"{self.role}: {self.content[:20]}..."
\ No newline at end of file
+        return f"Job {self.id} ({self.status})"
@@ -0,0 +1,350 @@
+"""
+對外呼叫的韌性層 (Deadlines / Retries / Hedging / Circuit Breaker)。
+
+圖片下載與 Gemini 呼叫原本各試一次：來源時好時壞時，每個請求都要等到逾時才失敗。
+這裡提供對話流程共用的幾個工具：
+
+1. 期限 (Deadline)：每個呼叫 (含所有重試) 有總時間上限，每次嘗試的逾時也不會超過剩餘時間。
+2. 重試 (call / acall)：只重試暫時性的失敗 (連線錯誤、逾時、5xx)，間隔以指數成長並加上完全隨機抖動
+   (full jitter)，避免大量請求同時重試；剩餘時間不夠等下一次時直接放棄。
+3. 對沖請求 (hedged / ahedged)：圖片下載超過 CHAT_FETCH_HEDGE_AFTER 秒還沒完成時，再送出一個相同的請求，
+   採用先成功的結果 (只用於 GET 這類冪等的請求；預設關閉)。
+4. 斷路器 (CircuitBreaker)：同一個上游連續失敗 CHAT_BREAKER_FAILURE_THRESHOLD 次後開啟，
+   CHAT_BREAKER_RESET_TIMEOUT 秒內的呼叫直接拋出 CircuitOpen，不再等待；之後放行一個試探請求 (half-open)，
+   成功才關閉。4xx 這類「上游正常、請求本身有問題」的錯誤不計入失敗。
+
+斷路器狀態、重試與對沖次數會輸出到 /metrics (api.metrics)。狀態只存在目前的 process。
+"""
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import httpx
+from django.conf import settings
+from google.genai import errors
+
+from api import metrics
+
+
+class CircuitOpen(Exception):
+    """上游的斷路器開啟中，呼叫沒有送出。"""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f'{upstream} 暫時無法使用 (斷路器開啟，{retry_after:.0f} 秒後再試)')
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class Deadline:
+    """以 monotonic 時間計算的期限。"""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+# =========================================
+# 重試
+# =========================================
+
+@dataclass
+class RetryPolicy:
+    """attempts 為總嘗試次數 (1 表示不重試)；deadline 為整個呼叫 (含重試) 的時間上限 (秒)。"""
+    attempts: int
+    deadline: float
+    base_delay: float = 0.2
+    max_delay: float = 2.0
+
+    def backoff(self, retry):
+        """第 retry 次重試前的等待秒數 (指數成長 + full jitter)。"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+def fetch_policy():
+    return RetryPolicy(
+        attempts=getattr(settings, 'CHAT_FETCH_ATTEMPTS', 3),
+        deadline=getattr(settings, 'CHAT_FETCH_DEADLINE', 15),
+        base_delay=getattr(settings, 'CHAT_RETRY_BASE_DELAY', 0.2),
+        max_delay=getattr(settings, 'CHAT_RETRY_MAX_DELAY', 2),
+    )
+
+
+def gemini_policy():
+    return RetryPolicy(
+        attempts=getattr(settings, 'CHAT_AI_ATTEMPTS', 3),
+        deadline=getattr(settings, 'CHAT_AI_DEADLINE', 60),
+        base_delay=getattr(settings, 'CHAT_RETRY_BASE_DELAY', 0.2),
+        max_delay=getattr(settings, 'CHAT_RETRY_MAX_DELAY', 2),
+    )
+
+
+def transient_gemini_error(e):
+    """Gemini 的暫時性失敗：5xx、請求逾時與連線錯誤。429 (配額) 交給 chat.admission 退讓，不在這裡重試。"""
+    if isinstance(e, errors.ServerError):
+        return True
+    if isinstance(e, errors.ClientError):
+        return getattr(e, 'code', None) == 408
+    return isinstance(e, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+def call(fn, *, policy, breaker=None, retryable=lambda e: False):
+    """
+    以重試與斷路器執行 fn(deadline)。
+    只有 retryable(e) 為 True 的例外會重試並計入斷路器的失敗；其他例外 (例如 4xx) 直接拋出，
+    也不算成功：斷路器維持原本的狀態，不會因此歸零失敗次數或關閉 half-open 的斷路器。
+    """
+    deadline = Deadline(policy.deadline)
+    for attempt in range(policy.attempts):
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = fn(deadline)
+        except Exception as e:
+            transient = retryable(e)
+            _record_error(breaker, transient)
+            delay = _next_delay(policy, attempt, deadline, transient)
+            if delay is None:
+                raise
+            retries.inc(upstream=breaker.name if breaker else '')
+            time.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record(failed=False)
+            return result
+
+
+async def acall(fn, *, policy, breaker=None, retryable=lambda e: False):
+    """call 的非同步版本：fn(deadline) 回傳 awaitable。"""
+    deadline = Deadline(policy.deadline)
+    for attempt in range(policy.attempts):
+        if breaker is not None:
+            breaker.before_call()
+        try:
+            result = await fn(deadline)
+        except Exception as e:
+            transient = retryable(e)
+            _record_error(breaker, transient)
+            delay = _next_delay(policy, attempt, deadline, transient)
+            if delay is None:
+                raise
+            retries.inc(upstream=breaker.name if breaker else '')
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.record(failed=False)
+            return result
+
+
+def _record_error(breaker, transient):
+    """暫時性錯誤計入失敗；其他錯誤不代表上游故障也不代表恢復，只釋出 half-open 的試探名額。"""
+    if breaker is None:
+        return
+    if transient:
+        breaker.record(failed=True)
+    else:
+        breaker.release()
+
+
+def _next_delay(policy, attempt, deadline, transient):
+    """下一次重試前要等待的秒數；不應再重試時回傳 None。"""
+    if not transient or attempt + 1 >= policy.attempts:
+        return None
+    delay = policy.backoff(attempt)
+    if delay >= deadline.remaining():
+        return None
+    return delay
+
+
+# =========================================
+# 對沖請求
+# =========================================
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """對沖請求使用的執行緒池 (第一次使用時建立)。"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=2 * getattr(settings, 'CHAT_FETCH_POOL_SIZE', 10), thread_name_prefix='hedge',
+                )
+    return _executor
+
+
+def hedged(fn, after, upstream=''):
+    """
+    執行 fn()；after 秒內沒有完成時再執行一次，回傳先成功的結果 (兩者都失敗時拋出最後一個例外)。
+    after 為 None 或 0 時直接執行。較慢的請求無法中斷，會在背景執行到結束 (受各自的逾時限制)。
+    """
+    if not after:
+        return fn()
+    first = get_executor().submit(fn)
+    done, _ = wait([first], timeout=after)
+    if done:
+        return first.result()
+    hedges.inc(upstream=upstream)
+    pending = {first, get_executor().submit(fn)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+async def ahedged(fn, after, upstream=''):
+    """hedged 的非同步版本：fn() 回傳 coroutine；先成功的結果回傳後取消另一個請求。"""
+    if not after:
+        return await fn()
+    pending = {asyncio.ensure_future(fn())}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=after)
+        if done:
+            return done.pop().result()
+        hedges.inc(upstream=upstream)
+        pending.add(asyncio.ensure_future(fn()))
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# =========================================
+# 斷路器
+# =========================================
+
+class CircuitBreaker:
+    """closed → (連續失敗) → open → (等待) → half_open → (試探成功) → closed。"""
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.opened = 0  # 開啟的次數
+
+    @property
+    def failure_threshold(self):
+        return getattr(settings, 'CHAT_BREAKER_FAILURE_THRESHOLD', 5)
+
+    @property
+    def reset_timeout(self):
+        return getattr(settings, 'CHAT_BREAKER_RESET_TIMEOUT', 30)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def before_call(self):
+        """呼叫前檢查：開啟中拋出 CircuitOpen；half-open 時只放行一個試探請求。"""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            retry_after = max(1.0, self._opened_at + self.reset_timeout - time.monotonic())
+        raise CircuitOpen(self.name, retry_after)
+
+    def record(self, failed):
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                # 試探失敗或連續失敗達到門檻：(重新) 開啟
+                if self._opened_at is None:
+                    self.opened += 1
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """呼叫結束但結果不計入 (非暫時性錯誤)：狀態不變，half-open 時讓下一個請求再試探。"""
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+            self.opened = 0
+
+    def _state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+
+class BreakerRegistry:
+    """依上游名稱 (例如 gemini、fetch:images.dog.ceo、fetch:other) 取得斷路器，第一次使用時建立。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, name):
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(name, CircuitBreaker(name))
+        return breaker
+
+    def all(self):
+        with self._lock:
+            return sorted(self._breakers.values(), key=lambda b: b.name)
+
+    def reset(self):
+        with self._lock:
+            self._breakers.clear()
+
+
+breakers = BreakerRegistry()
+
+
+# =========================================
+# /metrics
+# =========================================
+
+retries = metrics.Counter('upstream_retries_total', '對外呼叫的重試次數', ('upstream',))
+hedges = metrics.Counter('upstream_hedged_requests_total', '送出的對沖請求數', ('upstream',))
+breaker_state = metrics.Gauge(
+    'upstream_circuit_breaker_state', '斷路器狀態 (0 = closed, 1 = half_open, 2 = open)', ('upstream',),
+    lambda: [((b.name,), CircuitBreaker.STATE_VALUES[b.state]) for b in breakers.all()],
+)
+breaker_opened = metrics.Gauge(
+    'upstream_circuit_breaker_opened', '斷路器開啟過的次數', ('upstream',),
+    lambda: [((b.name,), b.opened) for b in breakers.all()],
+)
+metrics.register(retries, hedges, breaker_state, breaker_opened)
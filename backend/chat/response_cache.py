@@ -0,0 +1,202 @@
+"""
+AI 回覆的完全比對快取 (Exact-match Response Cache)。
+
+許多使用者會對同一張熱門圖片問同樣的開場問題 (例如「這是什麼品種？」)，
+只要「圖片內容 + 對話歷史 + 提問 + 模型」完全相同，回覆就可以直接重複使用：
+
+1. 快取鍵：圖片內容的 SHA-256、正規化後對話歷史的雜湊、正規化後的提問與模型名稱。
+2. 淘汰：每筆資料有 TTL，總筆數超過上限時淘汰最久未使用 (LRU) 的項目。
+3. 統計：記錄 hits / misses / coalesced / evictions，方便觀察命中率。
+4. Single-flight：相同的請求同時進來時，只有第一個真的呼叫 Gemini，其餘等待並共用結果 (失敗時共用同一個錯誤)。
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+def normalize_prompt(prompt):
+    """去除頭尾空白並將連續空白合併，讓只差在空白的提問視為相同。"""
+    return ' '.join(prompt.split())
+
+
+def make_key(image_sha256, history, prompt, model):
+    """
+    計算快取鍵。
+    history 為 (role, content) 的序列，內容同樣會做空白正規化。
+    """
+    normalized_history = [[role, normalize_prompt(content)] for role, content in history]
+    history_hash = hashlib.sha256(
+        json.dumps(normalized_history, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+    raw = json.dumps([model, image_sha256, history_hash, normalize_prompt(prompt)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    """一次進行中的上游呼叫，讓相同鍵的其他請求等待結果。"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """整個 process 共用的記憶體內 LRU + TTL 快取。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._async_flights = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    # --- 設定 ---
+    @property
+    def enabled(self):
+        return getattr(settings, 'CHAT_RESPONSE_CACHE_ENABLED', True) and self.ttl > 0
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'CHAT_RESPONSE_CACHE_TTL', 24 * 60 * 60)
+
+    @property
+    def max_entries(self):
+        return getattr(settings, 'CHAT_RESPONSE_CACHE_MAX_ENTRIES', 1000)
+
+    # --- 基本操作 ---
+    def get(self, key):
+        """取得快取值並更新 LRU 順序，不存在或已過期時回傳 None。"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def lookup(self, key):
+        """與 get 相同，但會計入 hits / misses 統計 (給無法使用 get_or_compute 的串流流程使用)。"""
+        value = self.get(key)
+        if self.enabled:
+            self._count('hits' if value is not None else 'misses')
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.coalesced = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+            }
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    # --- 查詢或計算 ---
+    def get_or_compute(self, key, compute):
+        """
+        回傳 (value, cached)。
+        命中快取或搭上其他請求的同一次呼叫時 cached 為 True；實際呼叫 compute() 時為 False。
+        """
+        if not self.enabled:
+            return compute(), False
+
+        value = self.get(key)
+        if value is not None:
+            self._count('hits')
+            return value, True
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            self._count('coalesced')
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        self._count('misses')
+        try:
+            flight.value = compute()
+            self.put(key, flight.value)
+            return flight.value, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    async def aget_or_compute(self, key, compute):
+        """get_or_compute 的非同步版本，compute 為回傳 awaitable 的函式。"""
+        if not self.enabled:
+            return await compute(), False
+
+        value = self.get(key)
+        if value is not None:
+            self._count('hits')
+            return value, True
+
+        flight = self._async_flights.get(key)
+        if flight is not None:
+            self._count('coalesced')
+            return await asyncio.shield(flight), True
+
+        self._count('misses')
+        flight = self._async_flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await compute()
+            self.put(key, value)
+            flight.set_result(value)
+            return value, False
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            # 標記例外已被讀取，避免沒有其他等待者時出現 "exception was never retrieved" 警告
+            flight.exception()
+            raise
+        finally:
+            self._async_flights.pop(key, None)
+
+
+# 整個 process 共用的快取實體
+response_cache = ResponseCache()
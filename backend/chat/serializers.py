@@ -1,5 +1,6 @@
+from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
-from .models import ChatSession, ChatMessage
+from .models import ChatSession, ChatMessage, ChatJob
 
 class ChatMessageSerializer(serializers.ModelSerializer):
     """
@@ -10,28 +11,52 @@ class ChatMessageSerializer(serializers.ModelSerializer):
         fields = ['id', 'role', 'content', 'created_at']
         read_only_fields = ['id', 'created_at']
 
-class ChatSessionSerializer(serializers.ModelSerializer):
-    """
-    用於處理對話階段的序列化，並巢狀包含該階段的所有訊息。
-    """
-    # 使用剛才定義的訊息序列化器，列出該 Session 下的所有對話
-    messages = ChatMessageSerializer(many=True, read_only=True)
-
-    class Meta: # 這是 Django Rest Framework 的固定寫法，用來告訴序列化器要操作哪個模型
-        model = ChatSession
-        fields = ['id', 'image_url', 'created_at', 'messages']
-        read_only_fields = ['id', 'created_at', 'messages']
-
 class ChatSessionListSerializer(serializers.ModelSerializer):
     """
     用於列表顯示的輕量級序列化器，不包含詳細訊息。
+    訊息數、最後活動時間與預覽直接讀取 Session 上的反正規化欄位，不需要查詢訊息表。
     """
     class Meta:
         model = ChatSession
-        fields = ['id', 'image_url', 'created_at']
-        read_only_fields = ['id', 'created_at']
+        fields = ['id', 'image_url', 'created_at', 'message_count', 'last_message_at', 'last_message_preview']
+        read_only_fields = fields
+
+class ChatSessionSerializer(ChatSessionListSerializer):
+    """
+    單一對話階段的詳情，包含一頁訊息 (見 chat.message_sync)。
+    訊息由 view 依 since / before 游標先讀好，放在 context['page'] (MessagePage)，序列化時不再查詢資料庫。
+    - has_older: 是否還有更早的訊息可用 ?before= 載入。
+    - reset: 前端的游標已失效，應以這一頁取代手上的副本。
+    """
+    messages = serializers.SerializerMethodField()
+    has_older = serializers.SerializerMethodField()
+    reset = serializers.SerializerMethodField()
+
+    class Meta(ChatSessionListSerializer.Meta):
+        fields = ChatSessionListSerializer.Meta.fields + ['messages', 'has_older', 'reset']
+        read_only_fields = fields
+
+    @extend_schema_field(ChatMessageSerializer(many=True))
+    def get_messages(self, session):
+        return ChatMessageSerializer(self.context['page'].messages, many=True).data
+
+    def get_has_older(self, session) -> bool:
+        return self.context['page'].has_older
+
+    def get_reset(self, session) -> bool:
+        return self.context['page'].reset
 
 class ChatInputSerializer(serializers.Serializer):
     """專門用於定義發問時的輸入格式"""
     image_url = serializers.URLField(help_text="狗狗圖片的網址")
-    prompt = serializers.CharField(help_text="您想問 AI 的提示詞")
\ No newline at end of file
+    prompt = serializers.CharField(help_text="您想問 AI 的提示詞")
+
+class ChatJobSerializer(serializers.ModelSerializer):
+    """背景對話工作的狀態，完成後 response 即為 AI 的回覆。"""
+    image_url = serializers.ReadOnlyField(source='session.image_url')
+    response = serializers.CharField(source='result', read_only=True)
+
+    class Meta:
+        model = ChatJob
+        fields = ['id', 'image_url', 'prompt', 'status', 'response', 'error', 'attempts', 'created_at', 'updated_at']
+        read_only_fields = fields
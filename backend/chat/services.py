@@ -0,0 +1,244 @@
+"""
+對話流程的共用邏輯 (Chat Turn Services)。
+
+一輪對話 = 準備歷史紀錄 + 準備圖片 + 呼叫 Gemini + 永久化儲存。
+圖片每個 Session 只登記一次，之後的對話以 handle 引用 (chat.attachments)。
+同步回覆 (ChatView) 與串流回覆 (ChatStreamView) 共用這裡的步驟，view 只負責 HTTP 的輸入與輸出。
+以 a 開頭的函式 (arun_turn 等) 是給 AsyncChatView 使用的非同步版本。
+
+送給模型的歷史紀錄依 token 預算裁切，較早的對話以滾動摘要取代 (chat.history)。
+呼叫 Gemini 之前會先查詢回覆快取 (chat.response_cache)：圖片內容、對話歷史與提問完全相同時直接沿用先前的回覆。
+寫入對話的函式會在同一個交易中遞增使用者的對話版本號 (api.models.DataVersion)，讓 GET 的 ETag 跟著改變。
+寫入以 serialized_write 執行 (api.db)：SQLite 高併發模式下由單一 writer 執行緒合併 commit，否則等同 transaction.atomic。
+呼叫 Gemini 的時間計入請求的 ai 階段 (api.metrics)，命中回覆快取時不計。
+每個 Gemini 呼叫都要先取得全域的同時呼叫名額 (chat.admission)，串流回覆在整段串流期間佔用名額。
+Gemini 呼叫有單次逾時 (CHAT_AI_TIMEOUT)，暫時性失敗在總期限內重試，連續失敗時由斷路器直接拒絕 (chat.resilience)；
+串流回覆只在收到第一段之前重試，已經送出的內容不會重來。
+"""
+import asyncio
+import itertools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F
+from google.genai import types
+
+from api import metrics, purge
+from api.db import serialized_write
+from api.models import DataVersion
+
+from . import admission, history as history_window, resilience
+from .attachments import aattach_image, attach_image
+from .genai_client import get_client
+from .models import PREVIEW_LENGTH, ChatMessage, ChatSession
+from .response_cache import make_key, response_cache
+
+
+def load_history(session):
+    """讀取要送給模型的對話紀錄 (滾動摘要 + 最近幾輪原文)，回傳 (role, content) 的清單。"""
+    return history_window.load_window(session)
+
+
+def to_contents(history):
+    """將 (role, content) 清單轉成新版 SDK 要求的歷史紀錄格式 (types.Content)。"""
+    return [
+        types.Content(
+            role="user" if role == "user" else "model",
+            parts=[types.Part.from_text(text=content)]
+        )
+        for role, content in history
+    ]
+
+
+def build_history(session):
+    """將資料庫中的對話紀錄轉成新版 SDK 要求的歷史紀錄格式 (types.Content)。"""
+    return to_contents(load_history(session))
+
+
+def request_config(deadline):
+    """
+    單次 Gemini 呼叫的設定：逾時 (毫秒) 為 CHAT_AI_TIMEOUT 與整個呼叫 (含重試) 剩餘時間的較小值，
+    每次嘗試各自計算，重試不會讓總時間超過 CHAT_AI_DEADLINE。
+    """
+    timeout = min(getattr(settings, 'CHAT_AI_TIMEOUT', 30), deadline.remaining())
+    return types.GenerateContentConfig(http_options=types.HttpOptions(timeout=max(1, int(timeout * 1000))))
+
+
+def start_chat(history):
+    """以 process 共用的客戶端建立帶有歷史紀錄的對話 (逾時設定在每次送出訊息時傳入)。"""
+    return get_client().chats.create(
+        model=settings.CHAT_GEMINI_MODEL,
+        history=to_contents(history),
+    )
+
+
+def call_gemini(fn):
+    """以重試與斷路器執行一次 Gemini 呼叫 fn(config) (chat.resilience)；config 帶有這次嘗試的逾時。"""
+    return resilience.call(
+        lambda deadline: fn(request_config(deadline)), policy=resilience.gemini_policy(),
+        breaker=resilience.breakers.get('gemini'), retryable=resilience.transient_gemini_error,
+    )
+
+
+async def acall_gemini(fn):
+    """call_gemini 的非同步版本：fn(config) 回傳 coroutine。"""
+    return await resilience.acall(
+        lambda deadline: fn(request_config(deadline)), policy=resilience.gemini_policy(),
+        breaker=resilience.breakers.get('gemini'), retryable=resilience.transient_gemini_error,
+    )
+
+
+def open_stream(chat, message, config):
+    """送出串流請求並等到第一段回覆 (連線錯誤通常在這時出現，才能重試)，回傳包含第一段的完整 iterator。"""
+    iterator = iter(chat.send_message_stream(message, config=config))
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+    return itertools.chain([first], iterator)
+
+
+def reply_cache_key(image_sha256, history, prompt):
+    return make_key(image_sha256, history, prompt, settings.CHAT_GEMINI_MODEL)
+
+
+# 清空對話時要重設的 Session 欄位 (活動資訊與滾動摘要)
+CLEARED_SESSION_FIELDS = {
+    'message_count': 0,
+    'last_message_at': None,
+    'last_message_preview': '',
+    'summary': '',
+    'summary_until': 0,
+}
+
+
+@serialized_write
+def save_turn(session, prompt, reply):
+    """
+    在同一個交易中寫入使用者提問與 AI 回覆，避免只存到一半；
+    並以 F() 遞增 Session 的訊息數與最後活動時間，對話列表不必再去統計訊息表。
+    """
+    ChatMessage.objects.create(session=session, role='user', content=prompt)
+    message = ChatMessage.objects.create(session=session, role='model', content=reply)
+    ChatSession.objects.filter(pk=session.pk).update(
+        message_count=F('message_count') + 2,
+        last_message_at=message.created_at,
+        last_message_preview=reply[:PREVIEW_LENGTH],
+    )
+    DataVersion.objects.bump(session.user_id, DataVersion.CHAT)
+
+
+@serialized_write
+def clear_history(session):
+    """清空對話紀錄、活動資訊與滾動摘要，Session 本身保留。"""
+    session.messages.all().delete()
+    ChatSession.objects.filter(pk=session.pk).update(**CLEARED_SESSION_FIELDS)
+    DataVersion.objects.bump(session.user_id, DataVersion.CHAT)
+    for name, value in CLEARED_SESSION_FIELDS.items():
+        setattr(session, name, value)
+
+
+def delete_sessions(user):
+    """
+    刪除使用者所有的對話 Session (連同訊息)：請求中只標記為已刪除 (立即隱藏)，
+    資料由背景分批清除，回傳記錄進度的 DataPurge (見 api/purge.py)。
+    """
+    return purge.delete_chats(user)
+
+
+def generate_reply(session, image_url, prompt):
+    """準備圖片與歷史紀錄並呼叫 Gemini (或命中回覆快取)，回傳回覆文字 (不寫入資料庫)。"""
+    image_sha256, image = attach_image(session, image_url)
+    history = load_history(session)
+
+    def call_model():
+        chat = start_chat(history)
+        with admission.slot(), metrics.phase('ai'):
+            return call_gemini(lambda config: chat.send_message([prompt, image], config=config)).text
+
+    ai_text, _ = response_cache.get_or_compute(reply_cache_key(image_sha256, history, prompt), call_model)
+    return ai_text
+
+
+def run_turn(session, image_url, prompt):
+    """執行完整的一輪對話並回傳 AI 的回覆文字。"""
+    ai_text = generate_reply(session, image_url, prompt)
+    save_turn(session, prompt, ai_text)
+    return ai_text
+
+
+def stream_turn(session, image_url, prompt):
+    """
+    串流版的一輪對話：先準備好圖片與對話 (失敗會直接拋出例外)，
+    再回傳一個逐段產生回覆文字的 generator；完整回覆產生完畢後才寫入資料庫。
+    命中回覆快取時，整段回覆會以單一段落送出。
+    """
+    image_sha256, image = attach_image(session, image_url)
+    history = load_history(session)
+    key = reply_cache_key(image_sha256, history, prompt)
+    cached = response_cache.lookup(key)
+    chat = None if cached is not None else start_chat(history)
+
+    def generate():
+        if cached is not None:
+            yield cached
+            save_turn(session, prompt, cached)
+            return
+
+        chunks = []
+        with admission.slot():
+            with metrics.phase('ai'):
+                stream = call_gemini(lambda config: open_stream(chat, [prompt, image], config))
+            for chunk in metrics.timed_iter('ai', stream):
+                text = chunk.text or ''
+                if text:
+                    chunks.append(text)
+                    yield text
+        ai_text = ''.join(chunks)
+        save_turn(session, prompt, ai_text)
+        response_cache.put(key, ai_text)
+
+    return generate()
+
+
+# =========================================
+# 非同步版本 (AsyncChatView 使用)
+# =========================================
+
+async def aload_history(session):
+    """load_history 的非同步版本，使用 Django 的 async ORM 讀取對話紀錄。"""
+    return await history_window.aload_window(session)
+
+
+async def aclear_history(session):
+    """clear_history 的非同步版本。"""
+    # transaction.atomic 尚不支援 async，交易放到執行緒中進行
+    await sync_to_async(clear_history)(session)
+
+
+async def adelete_sessions(user):
+    """delete_sessions 的非同步版本。"""
+    return await sync_to_async(delete_sessions)(user)
+
+
+async def abuild_history(session):
+    """build_history 的非同步版本。"""
+    return to_contents(await aload_history(session))
+
+
+async def arun_turn(session, image_url, prompt):
+    """run_turn 的非同步版本：圖片下載與歷史紀錄讀取同時進行，再以 client.aio 呼叫 Gemini。"""
+    history, (image_sha256, image) = await asyncio.gather(aload_history(session), aattach_image(session, image_url))
+
+    async def call_model():
+        chat = get_client().aio.chats.create(
+            model=settings.CHAT_GEMINI_MODEL, history=to_contents(history),
+        )
+        async with admission.aslot():
+            with metrics.phase('ai'):
+                return (await acall_gemini(lambda config: chat.send_message([prompt, image], config=config))).text
+
+    ai_text, _ = await response_cache.aget_or_compute(reply_cache_key(image_sha256, history, prompt), call_model)
+    # transaction.atomic 尚不支援 async，交易寫入放到執行緒中進行
+    await sync_to_async(save_turn)(session, prompt, ai_text)
+    return ai_text
@@ -1,3 +1,1653 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.migrations.loader import MigrationLoader
+from django.core.management import call_command
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from google.genai import errors
+from PIL import ExifTags, Image
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from api import metrics
+from api.models import DataVersion
+from .fakes import FakeGenAIClient
+from .fetch import FetchError, FetchResult, ResponseTooLarge, afetch, fetch, sniff_content_type
+from .genai_client import ClientRegistry, override_client
+from .image_cache import CachedImage, ImageCache
+from . import admission, history, image_normalize, jobs, loadtest, message_sync, resilience
+from .response_cache import ResponseCache, make_key, response_cache
+from .models import ChatJob, ChatMessage, ChatSession
+from .views import AsyncChatJobView, AsyncChatView
+
+JPEG_BYTES = b'\xff\xd8\xff\xe0' + b'dog' * 10
+PNG_BYTES = b'\x89PNG\r\n\x1a\n' + b'dog' * 10
+
+
+def fake_response(status_code=200, content=b'', headers=None):
+    """建立一個模擬下載結果的物件，讓測試不需要真的連網。"""
+    return FetchResult(
+        url='', status_code=status_code, content=content,
+        content_type=sniff_content_type(content) or '', headers=headers or {},
+    )
+
+
+class ImageCacheTests(TestCase):
+    """
+    針對狗狗圖片磁碟快取的單元測試。
+    每個測試都使用獨立的暫存目錄，並以 mock 取代實際的網路下載。
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.settings_override = override_settings(
+            CHAT_IMAGE_CACHE_DIR=self.tmpdir.name,
+            CHAT_IMAGE_CACHE_MAX_BYTES=1024,
+            CHAT_IMAGE_CACHE_TTL=60,
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.cache = ImageCache()
+        self.url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_second_get_is_served_from_disk(self, mock_get):
+        """測試情境：同一張圖片連續取得兩次，第二次不應再發出網路請求。"""
+        mock_get.return_value = fake_response(content=b'dog-bytes', headers={'ETag': '"v1"'})
+
+        first = self.cache.get(self.url)
+        second = self.cache.get(self.url)
+
+        self.assertEqual(first.content, b'dog-bytes')
+        self.assertEqual(second.content, b'dog-bytes')
+        self.assertEqual(first.sha256, second.sha256)
+        self.assertEqual(mock_get.call_count, 1)
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_expired_entry_is_revalidated_with_etag(self, mock_get):
+        """測試情境：快取過期後應帶 If-None-Match 重新驗證，收到 304 時沿用本機內容。"""
+        mock_get.return_value = fake_response(content=b'dog-bytes', headers={'ETag': '"v1"'})
+        self.cache.get(self.url)
+
+        mock_get.return_value = fake_response(status_code=304)
+        with override_settings(CHAT_IMAGE_CACHE_TTL=0):
+            image = self.cache.get(self.url)
+
+        self.assertEqual(image.content, b'dog-bytes')
+        self.assertEqual(mock_get.call_args.kwargs['headers'], {'If-None-Match': '"v1"'})
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_sniffed_content_type_is_kept(self, mock_get):
+        """測試情境：來源宣告錯誤的 Content-Type 時，快取應保存實際偵測到的圖片格式。"""
+        mock_get.return_value = fake_response(content=PNG_BYTES, headers={'Content-Type': 'image/jpeg'})
+        self.cache.get(self.url)
+
+        self.assertEqual(self.cache.get(self.url).content_type, 'image/png')
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_same_content_is_stored_once(self, mock_get):
+        """測試情境：兩個不同網址回傳相同內容時，磁碟上只會有一份圖片本體。"""
+        mock_get.return_value = fake_response(content=b'same-dog')
+        a = self.cache.get(self.url)
+        b = self.cache.get(self.url + '?copy=1')
+
+        self.assertEqual(a.sha256, b.sha256)
+        self.assertEqual(len(list((self.cache.root / 'blobs').glob('*/*'))), 1)
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_not_modified_without_meta_is_refetched(self, mock_get):
+        """測試情境：重新驗證期間網址索引被淘汰，收到 304 時不可存入空內容，應不帶條件標頭重新下載。"""
+        mock_get.return_value = fake_response(content=b'dog-bytes', headers={'ETag': '"v1"'})
+        self.cache.get(self.url)
+
+        lookup = self.cache._lookup
+        def evicted_lookup(url):
+            meta, headers = lookup(url)
+            self.cache._meta_path(url).unlink()
+            return None, headers
+
+        mock_get.side_effect = [fake_response(status_code=304), fake_response(content=b'dog-bytes')]
+        with override_settings(CHAT_IMAGE_CACHE_TTL=0), \
+                mock.patch.object(self.cache, '_lookup', side_effect=evicted_lookup):
+            image = self.cache.get(self.url)
+
+        self.assertEqual(image.content, b'dog-bytes')
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(mock_get.call_args.kwargs.get('headers'), None)
+
+    def test_least_recently_used_blob_is_evicted(self):
+        """測試情境：總容量超過上限時，最久未使用的圖片本體應被淘汰。"""
+        old = self.cache.store('https://example.com/old.jpg', b'o' * 600)
+        old_path = self.cache._blob_path(old.sha256)
+        # 將舊檔案的 mtime 調早，模擬它是最久沒被使用的項目
+        os.utime(old_path, (0, 0))
+
+        new = self.cache.store('https://example.com/new.jpg', b'n' * 600)
+
+        self.assertFalse(old_path.exists())
+        self.assertTrue(self.cache._blob_path(new.sha256).exists())
+
+    def test_store_below_limit_does_not_scan_blobs(self):
+        """測試情境：容量估計值未超過上限時，寫入不需要再掃描整個目錄。"""
+        self.cache.store('https://example.com/a.jpg', b'a' * 100)
+
+        with mock.patch.object(Path, 'glob', side_effect=AssertionError('scanned')):
+            self.cache.store('https://example.com/b.jpg', b'b' * 100)
+
+    def test_eviction_counts_blobs_written_since_last_scan(self):
+        """測試情境：估計值累計寫入的容量，超過上限時仍會淘汰。"""
+        old = self.cache.store('https://example.com/old.jpg', b'o' * 400)
+        os.utime(self.cache._blob_path(old.sha256), (0, 0))
+        self.cache.store('https://example.com/mid.jpg', b'm' * 400)
+
+        self.cache.store('https://example.com/new.jpg', b'n' * 400)
+
+        self.assertFalse(self.cache._blob_path(old.sha256).exists())
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_blob_evicted_after_lookup_is_refetched(self, mock_get):
+        """測試情境：查到索引後、讀取前圖片本體被其他 worker 淘汰，應重新下載而不是失敗。"""
+        mock_get.return_value = fake_response(content=b'dog-bytes')
+        image = self.cache.get(self.url)
+        blob_path = self.cache._blob_path(image.sha256)
+
+        lookup = self.cache._lookup
+        def evicted_lookup(url):
+            result = lookup(url)
+            blob_path.unlink()
+            return result
+
+        with mock.patch.object(self.cache, '_lookup', side_effect=evicted_lookup):
+            image = self.cache.get(self.url)
+
+        self.assertEqual(image.content, b'dog-bytes')
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertTrue(blob_path.exists())
+
+    @mock.patch('chat.image_cache.fetch')
+    def test_not_modified_with_missing_blob_is_refetched(self, mock_get):
+        """測試情境：重新驗證收到 304 但圖片本體已被刪除時，不帶條件標頭重新下載。"""
+        mock_get.return_value = fake_response(content=b'dog-bytes', headers={'ETag': '"v1"'})
+        image = self.cache.get(self.url)
+
+        lookup = self.cache._lookup
+        def evicted_lookup(url):
+            result = lookup(url)
+            self.cache._blob_path(image.sha256).unlink()
+            return result
+
+        mock_get.side_effect = [fake_response(status_code=304), fake_response(content=b'dog-bytes')]
+        with override_settings(CHAT_IMAGE_CACHE_TTL=0), \
+                mock.patch.object(self.cache, '_lookup', side_effect=evicted_lookup):
+            image = self.cache.get(self.url)
+
+        self.assertEqual(image.content, b'dog-bytes')
+        self.assertEqual(mock_get.call_args.kwargs.get('headers'), None)
+
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    """測試用的本機圖片伺服器：依路徑回傳不同內容。"""
+    routes = {
+        '/dog.png': (200, 'application/octet-stream', PNG_BYTES),
+        '/big.jpg': (200, 'image/jpeg', JPEG_BYTES * 1000),
+        '/missing.jpg': (404, 'text/plain', b'not found'),
+    }
+
+    def do_GET(self):
+        status_code, content_type, body = self.routes.get(self.path, (404, 'text/plain', b''))
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        # 不送 Content-Length，強迫客戶端以串流方式判斷大小上限
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTests(SimpleTestCase):
+    """針對對外下載層 (chat.fetch) 的測試，使用本機 HTTP 伺服器取代外部網路。"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_content_type_is_sniffed(self):
+        """測試情境：伺服器宣告 octet-stream，但內容是 PNG，結果應為 image/png。"""
+        result = fetch(f'{self.base_url}/dog.png')
+        self.assertEqual(result.content, PNG_BYTES)
+        self.assertEqual(result.content_type, 'image/png')
+
+    @override_settings(CHAT_FETCH_MAX_BYTES=1024)
+    def test_oversized_body_is_rejected(self):
+        """測試情境：內容超過大小上限時，應中斷讀取並拋出 ResponseTooLarge。"""
+        with self.assertRaises(ResponseTooLarge):
+            fetch(f'{self.base_url}/big.jpg')
+
+    def test_http_error_raises_fetch_error(self):
+        with self.assertRaises(FetchError):
+            fetch(f'{self.base_url}/missing.jpg')
+
+    def test_async_fetch(self):
+        """測試情境：非同步版本應回傳與同步版本相同的結果。"""
+        result = async_to_sync(afetch)(f'{self.base_url}/dog.png')
+        self.assertEqual(result.content, PNG_BYTES)
+        self.assertEqual(result.content_type, 'image/png')
+
+    def test_fetch_time_is_recorded_on_request(self):
+        """測試情境：在請求中下載時，耗時應計入目前請求的 fetch 階段。"""
+        with metrics.activate(metrics.RequestTiming()) as timing:
+            fetch(f'{self.base_url}/dog.png')
+            async_to_sync(afetch)(f'{self.base_url}/dog.png')
+        self.assertEqual(timing.counts['fetch'], 2)
+        self.assertGreater(timing.seconds['fetch'], 0)
+
+
+class _FaultyHandler(BaseHTTPRequestHandler):
+    """
+    故障注入的本機圖片伺服器：
+    /flaky/<n>/... 前 n 次回傳 503 之後正常；/down 一律 503；/slow-once/... 第一次等待 1 秒才回應；/missing 回傳 404。
+    """
+    hits = {}
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with self.lock:
+            count = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        parts = self.path.strip('/').split('/')
+        if parts[0] == 'down' or (parts[0] == 'flaky' and count <= int(parts[1])):
+            status_code, body = 503, b'unavailable'
+        elif parts[0] == 'missing':
+            status_code, body = 404, b'not found'
+        else:
+            if parts[0] == 'slow-once' and count == 1:
+                time.sleep(1)
+            status_code, body = 200, PNG_BYTES
+        try:
+            self.send_response(status_code)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass  # 用戶端已放棄這個請求 (逾時或對沖請求已先完成)
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(
+    CHAT_RETRY_BASE_DELAY=0.01, CHAT_RETRY_MAX_DELAY=0.05, CHAT_ASK_RATE=0, CHAT_FETCH_UPSTREAMS=('127.0.0.1',),
+)
+class ResilienceTests(APITestCase):
+    """重試、期限、對沖請求與斷路器 (chat/resilience.py)，以故障注入的本機替身取代圖片來源與 Gemini。"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _FaultyHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        cls.upstream = 'fetch:127.0.0.1'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        resilience.breakers.reset()
+        self.addCleanup(resilience.breakers.reset)
+        _FaultyHandler.hits.clear()
+        self.path_prefix = f'/{self._testMethodName}'
+
+    def url(self, path):
+        # 每個測試使用不同的路徑，計數不會互相影響
+        return f'{self.base_url}{path}{self.path_prefix}.png'
+
+    def hits(self, path):
+        return _FaultyHandler.hits.get(f'{path}{self.path_prefix}.png', 0)
+
+    def test_transient_failures_are_retried(self):
+        before = resilience.retries.value(upstream=self.upstream)
+
+        result = fetch(self.url('/flaky/2'))
+
+        self.assertEqual(result.content, PNG_BYTES)
+        self.assertEqual(self.hits('/flaky/2'), 3)
+        self.assertEqual(resilience.retries.value(upstream=self.upstream) - before, 2)
+        self.assertEqual(resilience.breakers.get(self.upstream).state, 'closed')
+
+    def test_client_errors_are_not_retried(self):
+        with self.assertRaises(FetchError):
+            fetch(self.url('/missing'))
+        self.assertEqual(self.hits('/missing'), 1)
+
+    @override_settings(CHAT_FETCH_UPSTREAMS=('images.dog.ceo',))
+    def test_unknown_hosts_share_one_breaker(self):
+        """測試情境：使用者提供的任意主機共用 fetch:other，不會為每個主機建立斷路器與指標標籤。"""
+        fetch(self.url('/ok'))
+        with self.assertRaises(FetchError):
+            fetch(f'http://localhost:{self.server.server_port}/missing{self.path_prefix}.png')
+
+        self.assertEqual([b.name for b in resilience.breakers.all()], ['fetch:other'])
+
+    @override_settings(CHAT_BREAKER_FAILURE_THRESHOLD=3, CHAT_BREAKER_RESET_TIMEOUT=0.2)
+    def test_breaker_opens_fails_fast_and_recovers(self):
+        with self.assertRaises(FetchError):
+            fetch(self.url('/down'))
+        self.assertEqual(self.hits('/down'), 3)
+        breaker = resilience.breakers.get(self.upstream)
+        self.assertEqual(breaker.state, 'open')
+
+        # 開啟中：不送出請求，立即失敗
+        started = time.perf_counter()
+        with self.assertRaisesMessage(FetchError, '斷路器開啟'):
+            async_to_sync(afetch)(self.url('/down'))
+        self.assertLess(time.perf_counter() - started, 0.1)
+        self.assertEqual(self.hits('/down'), 3)
+        self.assertIn(f'upstream_circuit_breaker_state{{upstream="{self.upstream}"}} 2', metrics.render())
+
+        # 等待後放行一個試探請求，成功即關閉
+        time.sleep(0.25)
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertEqual(fetch(self.url('/ok')).content, PNG_BYTES)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open_breaker_allows_a_single_probe(self):
+        breaker = resilience.CircuitBreaker('probe')
+        with override_settings(CHAT_BREAKER_FAILURE_THRESHOLD=1, CHAT_BREAKER_RESET_TIMEOUT=0):
+            breaker.record(failed=True)
+            breaker.before_call()
+            with self.assertRaises(resilience.CircuitOpen):
+                breaker.before_call()
+            breaker.record(failed=True)  # 試探失敗：重新開啟
+            self.assertEqual(breaker.opened, 1)
+            breaker.before_call()
+            breaker.record(failed=False)
+            self.assertEqual(breaker.state, 'closed')
+
+    @override_settings(CHAT_BREAKER_FAILURE_THRESHOLD=2, CHAT_BREAKER_RESET_TIMEOUT=0)
+    def test_client_errors_do_not_change_breaker_state(self):
+        """測試情境：4xx 不計入失敗也不算成功：不會歸零失敗次數，也不會關閉 half-open 的斷路器。"""
+        breaker = resilience.breakers.get(self.upstream)
+        breaker.record(failed=True)
+        with self.assertRaises(FetchError):
+            fetch(self.url('/missing'))
+        breaker.record(failed=True)
+        self.assertNotEqual(breaker.state, 'closed')  # 兩次失敗之間的 404 沒有歸零計數
+
+        with self.assertRaises(FetchError):
+            fetch(self.url('/missing'))  # half-open 的試探遇到 404
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertEqual(fetch(self.url('/ok')).content, PNG_BYTES)  # 下一個請求仍可試探
+        self.assertEqual(breaker.state, 'closed')
+
+    @override_settings(CHAT_FETCH_DEADLINE=0.3)
+    def test_deadline_bounds_the_whole_fetch(self):
+        started = time.perf_counter()
+        with self.assertRaises(FetchError):
+            fetch(self.url('/slow-once'))
+        self.assertLess(time.perf_counter() - started, 0.8)
+
+    @override_settings(CHAT_FETCH_HEDGE_AFTER=0.1)
+    def test_slow_fetch_is_hedged(self):
+        before = resilience.hedges.value(upstream=self.upstream)
+
+        started = time.perf_counter()
+        self.assertEqual(fetch(self.url('/slow-once')).content, PNG_BYTES)
+        self.assertLess(time.perf_counter() - started, 0.8)
+
+        self.assertEqual(self.hits('/slow-once'), 2)
+        self.assertEqual(resilience.hedges.value(upstream=self.upstream) - before, 1)
+
+    @override_settings(CHAT_FETCH_HEDGE_AFTER=0.1)
+    def test_async_slow_fetch_is_hedged(self):
+        started = time.perf_counter()
+        self.assertEqual(async_to_sync(afetch)(self.url('/slow-once')).content, PNG_BYTES)
+        self.assertLess(time.perf_counter() - started, 0.8)
+        self.assertEqual(self.hits('/slow-once'), 2)
+
+    # --- Gemini ---
+    def gemini_client(self, *errors_to_raise):
+        user = User.objects.create_user(username='resilience', password='password')
+        self.client.force_authenticate(user=user)
+        response_cache.clear()
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.url('/dog'), sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+        return self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！', errors=errors_to_raise)))
+
+    def ask(self, name='chat-ask'):
+        return self.client.post(reverse(name), {'image_url': self.url('/dog'), 'prompt': '品種？'}, format='json')
+
+    def test_gemini_server_errors_are_retried(self):
+        fake = self.gemini_client(errors.ServerError(503, {'error': {'message': 'overloaded'}}))
+
+        response = self.ask()
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(fake.calls), 2)
+
+    def test_stream_is_retried_before_the_first_chunk(self):
+        self.gemini_client(errors.ServerError(500, {'error': {'message': 'internal'}}))
+
+        response = self.ask('chat-ask-stream')
+
+        body = b''.join(response.streaming_content).decode()
+        self.assertIn('event: done', body)
+        self.assertIn('這是一隻哈士奇！', body)
+
+    @override_settings(CHAT_AI_TIMEOUT=0.5, CHAT_AI_DEADLINE=0.8)
+    def test_slow_gemini_attempts_share_the_deadline(self):
+        fake = self.gemini_client()
+        fake.latency = 5
+
+        started = time.monotonic()
+        with self.assertLogs('chat.views', 'ERROR'):
+            response = self.ask()
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertLess(elapsed, 1.5)
+        # 第一次嘗試用完 CHAT_AI_TIMEOUT，之後的嘗試只能使用剩餘的時間
+        timeouts = [call['timeout'] for call in fake.calls]
+        self.assertGreaterEqual(len(timeouts), 2)
+        self.assertEqual(timeouts[0], 0.5)
+        self.assertLess(timeouts[1], 0.4)
+        self.assertLessEqual(sum(timeouts), 0.8 + 0.01)
+
+    @override_settings(CHAT_AI_ATTEMPTS=1, CHAT_BREAKER_FAILURE_THRESHOLD=2)
+    def test_open_gemini_breaker_returns_503_without_calling(self):
+        fake = self.gemini_client(*[errors.ServerError(503, {'error': {'message': 'overloaded'}})] * 2)
+
+        with self.assertLogs('chat.views', 'WARNING'):
+            self.assertEqual(self.ask().status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            self.assertEqual(self.ask().status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+            response = self.ask()
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertGreaterEqual(response.data['retry_after'], 1)
+        self.assertEqual(len(fake.calls), 2)
+
+
+@override_settings(CHAT_GENAI_CLIENT_FACTORY='chat.fakes.FakeGenAIClient')
+class ClientRegistryTests(SimpleTestCase):
+    """針對 Gemini client 登錄處的測試：重複使用、金鑰輪替與注入。"""
+
+    def test_client_is_reused_across_calls(self):
+        registry = ClientRegistry()
+        with mock.patch.dict(os.environ, {'GEMINI_API_KEY': 'key-1'}):
+            self.assertIs(registry.get_client(), registry.get_client())
+
+    def test_client_is_recreated_when_key_changes(self):
+        registry = ClientRegistry()
+        with mock.patch.dict(os.environ, {'GEMINI_API_KEY': 'key-1'}):
+            first = registry.get_client()
+        with mock.patch.dict(os.environ, {'GEMINI_API_KEY': 'key-2'}):
+            second = registry.get_client()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.api_key, 'key-2')
+
+    def test_override_client(self):
+        registry = ClientRegistry()
+        fake = FakeGenAIClient(reply='override')
+        with registry.override_client(fake):
+            self.assertIs(registry.get_client(), fake)
+        self.assertIsNot(registry.get_client(), fake)
+
+
+class ResponseCacheTests(SimpleTestCase):
+    """回覆快取本身的行為：快取鍵、TTL、LRU 淘汰與 single-flight。"""
+
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def test_key_normalizes_whitespace_but_not_history(self):
+        key = make_key('a' * 64, [('user', 'hi'), ('model', 'hello')], '品種？', 'm')
+        self.assertEqual(key, make_key('a' * 64, [('user', ' hi '), ('model', 'hello')], ' 品種？\n', 'm'))
+        self.assertNotEqual(key, make_key('a' * 64, [], '品種？', 'm'))
+        self.assertNotEqual(key, make_key('b' * 64, [('user', 'hi'), ('model', 'hello')], '品種？', 'm'))
+        self.assertNotEqual(key, make_key('a' * 64, [('user', 'hi'), ('model', 'hello')], '品種？', 'other'))
+
+    @override_settings(CHAT_RESPONSE_CACHE_MAX_ENTRIES=2)
+    def test_lru_eviction(self):
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        self.cache.get('a')
+        self.cache.put('c', 3)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expired_entry_is_dropped(self):
+        self.cache.put('a', 1)
+        with mock.patch('chat.response_cache.time.monotonic', return_value=10 ** 9):
+            self.assertIsNone(self.cache.get('a'))
+
+    @override_settings(CHAT_RESPONSE_CACHE_TTL=0)
+    def test_disabled_cache_always_computes(self):
+        calls = []
+        for _ in range(2):
+            self.cache.get_or_compute('k', lambda: calls.append(1) or 'v')
+        self.assertEqual(len(calls), 2)
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        """測試情境：同時進來的相同請求只應呼叫上游一次，其餘等待並共用結果。"""
+        fake = FakeGenAIClient(reply='共用回覆', latency=0.2)
+        compute = lambda: fake.chats.create(model='m').send_message('品種？').text
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.cache.get_or_compute('k', compute)))
+            for _ in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual([value for value, _ in results], ['共用回覆'] * 5)
+        self.assertEqual(self.cache.stats()['coalesced'], 4)
+
+    def test_failure_is_shared_and_not_cached(self):
+        with self.assertRaises(ValueError):
+            self.cache.get_or_compute('k', mock.Mock(side_effect=ValueError('boom')))
+        self.assertEqual(self.cache.get_or_compute('k', lambda: 'ok'), ('ok', False))
+
+    def test_async_coalescing(self):
+        fake = FakeGenAIClient(reply='共用回覆', latency=0.05)
+
+        async def compute():
+            return (await fake.aio.chats.create(model='m').send_message('品種？')).text
+
+        async def run():
+            return await asyncio.gather(*(self.cache.aget_or_compute('k', compute) for _ in range(3)))
+
+        results = async_to_sync(run)()
+        self.assertEqual(len(fake.calls), 1)
+        self.assertEqual(sorted(cached for _, cached in results), [False, True, True])
+
+
+def make_image(size, fmt='JPEG', mode='RGB', **save_options):
+    """產生指定尺寸與格式的測試圖片 (帶有漸層，重新編碼後才有實際的大小差異)。"""
+    image = Image.linear_gradient('L').resize(size).convert(mode)
+    output = io.BytesIO()
+    image.save(output, fmt, **save_options)
+    return output.getvalue()
+
+
+def cached(content, url='https://images.dog.ceo/breeds/husky/1.jpg'):
+    return CachedImage(url=url, sha256=hashlib.sha256(content).hexdigest(), content=content, content_type='image/jpeg')
+
+
+class ImageNormalizeTests(SimpleTestCase):
+    """送給 Gemini 之前的圖片正規化 (chat/image_normalize.py)。"""
+
+    def setUp(self):
+        tmp = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(CHAT_IMAGE_CACHE_DIR=Path(tmp), CHAT_IMAGE_MAX_DIMENSION=256))
+
+    def test_large_image_is_rotated_downscaled_and_stripped(self):
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6  # 需要順時針轉 90 度
+        exif[ExifTags.Base.Make] = 'DogCam'
+        source = cached(make_image((1200, 800), exif=exif.tobytes()))
+
+        result = image_normalize.normalize(source)
+
+        self.assertEqual(result.content_type, 'image/jpeg')
+        self.assertLess(len(result.content), len(source.content))
+        self.assertEqual(result.sha256, hashlib.sha256(result.content).hexdigest())
+        with Image.open(io.BytesIO(result.content)) as image:
+            self.assertEqual(image.size, (171, 256))
+            self.assertNotIn('exif', image.info)
+
+    def test_real_format_is_detected_and_transparency_flattened(self):
+        # 來源宣稱是 JPEG，實際上是帶透明度的 PNG
+        source = cached(make_image((400, 300), 'PNG', 'RGBA'))
+
+        result = image_normalize.normalize(source)
+
+        with Image.open(io.BytesIO(result.content)) as image:
+            self.assertEqual((image.format, image.mode, image.size), ('JPEG', 'RGB', (256, 192)))
+
+    def test_result_is_cached_by_content_hash(self):
+        source = cached(make_image((1200, 800)))
+        first = image_normalize.normalize(source)
+
+        with mock.patch('chat.image_normalize.encode') as encode:
+            # 不同網址但內容相同，直接沿用先前的結果
+            second = image_normalize.normalize(cached(source.content, url='https://images.dog.ceo/breeds/husky/2.jpg'))
+        encode.assert_not_called()
+        self.assertEqual((second.sha256, second.content), (first.sha256, first.content))
+
+        with override_settings(CHAT_IMAGE_MAX_DIMENSION=128):
+            self.assertLess(len(image_normalize.normalize(source).content), len(first.content))
+
+    def test_small_clean_jpeg_is_sent_as_is(self):
+        source = cached(make_image((200, 150), quality=50, optimize=True))
+        self.assertIs(image_normalize.normalize(source), source)
+
+    def test_undecodable_content_is_sent_as_is(self):
+        source = cached(JPEG_BYTES)
+        with self.assertLogs('chat.image_normalize', 'INFO'):
+            self.assertIs(image_normalize.normalize(source), source)
+
+    @override_settings(CHAT_IMAGE_NORMALIZE=False)
+    def test_disabled(self):
+        source = cached(make_image((1200, 800)))
+        self.assertIs(image_normalize.normalize(source), source)
+
+
+class ChatViewTests(APITestCase):
+    """
+    針對 /api/chat/ask/ 的整合測試。
+    Gemini 以 FakeGenAIClient 取代，圖片下載以 mock 取代，整個測試完全不連網。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='chatuser', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('chat-ask')
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.mock_image = self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def ask(self, prompt):
+        return self.client.post(self.url, {'image_url': self.image_url, 'prompt': prompt}, format='json')
+
+    def test_ask_saves_both_messages(self):
+        """測試情境：發問成功後應回傳 AI 回覆，並永久化儲存使用者與 AI 兩則訊息。"""
+        response = self.ask('這是什麼品種？')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['response'], '這是一隻哈士奇！')
+        self.assertEqual(
+            list(ChatMessage.objects.values_list('role', 'content')),
+            [('user', '這是什麼品種？'), ('model', '這是一隻哈士奇！')],
+        )
+
+    def test_follow_up_sends_history(self):
+        """測試情境：第二輪發問時，先前的對話應作為歷史紀錄傳給模型。"""
+        self.ask('這是什麼品種？')
+        self.ask('牠需要多少運動量？')
+
+        self.assertEqual(len(self.fake.calls), 2)
+        self.assertEqual(len(self.fake.calls[1]['history']), 2)
+
+    def test_identical_turn_is_served_from_cache(self):
+        """測試情境：另一位使用者對同一張圖問同樣的開場問題，應直接使用快取回覆但仍寫入自己的對話。"""
+        self.ask('這是什麼品種？')
+        other = User.objects.create_user(username='other', password='password')
+        self.client.force_authenticate(user=other)
+        response = self.ask('  這是什麼品種？ ')
+
+        self.assertEqual(response.data['response'], '這是一隻哈士奇！')
+        self.assertEqual(len(self.fake.calls), 1)
+        self.assertEqual(ChatMessage.objects.filter(session__user=other).count(), 2)
+        self.assertEqual(response_cache.stats()['hits'], 1)
+
+    def test_session_list_is_paginated(self):
+        for i in range(3):
+            self.image_url = f'https://images.dog.ceo/breeds/husky/{i}.jpg'
+            self.ask('這是什麼品種？')
+        ChatSession.objects.create(user=self.user, image_url='https://images.dog.ceo/empty.jpg')
+
+        first = self.client.get(self.url, {'page_size': 2})
+        second = self.client.get(first.data['next'])
+
+        urls = [s['image_url'] for s in first.data['results'] + second.data['results']]
+        self.assertEqual(urls, [f'https://images.dog.ceo/breeds/husky/{i}.jpg' for i in (2, 1, 0)])
+        self.assertIsNone(second.data['next'])
+
+    def test_session_activity_is_maintained(self):
+        """測試情境：寫入訊息時同步更新 Session 的訊息數、最後活動時間與預覽，清空時一併重設。"""
+        self.ask('這是什麼品種？')
+        self.ask('牠需要多少運動量？')
+
+        session = ChatSession.objects.get()
+        self.assertEqual(session.message_count, 4)
+        self.assertEqual(session.last_message_at, session.messages.last().created_at)
+        self.assertEqual(session.last_message_preview, '這是一隻哈士奇！')
+
+        self.client.delete(self.url, {'image_url': self.image_url}, format='json')
+        session.refresh_from_db()
+        self.assertEqual((session.message_count, session.last_message_at, session.last_message_preview), (0, None, ''))
+
+    def test_session_list_is_sorted_by_latest_activity(self):
+        first, second = 'https://images.dog.ceo/a.jpg', 'https://images.dog.ceo/b.jpg'
+        for url in (first, second, first):
+            self.image_url = url
+            self.ask('這是什麼品種？')
+
+        response = self.client.get(self.url)
+
+        self.assertEqual([s['image_url'] for s in response.data['results']], [first, second])
+        self.assertEqual(response.data['results'][0]['message_count'], 4)
+
+    def test_backfill_session_activity(self):
+        self.ask('這是什麼品種？')
+        ChatSession.objects.update(message_count=0, last_message_at=None, last_message_preview='')
+
+        call_command('backfill_session_activity', batch_size=1, stdout=io.StringIO())
+
+        session = ChatSession.objects.get()
+        self.assertEqual(session.message_count, 2)
+        self.assertEqual(session.last_message_preview, '這是一隻哈士奇！')
+        self.assertEqual(session.last_message_at, session.messages.last().created_at)
+
+    def test_get_history_and_delete(self):
+        self.ask('這是什麼品種？')
+
+        response = self.client.get(self.url, {'image_url': self.image_url})
+        self.assertEqual(len(response.data['messages']), 2)
+
+        response = self.client.delete(self.url, {'image_url': self.image_url}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(ChatMessage.objects.exists())
+        self.assertTrue(ChatSession.objects.exists())
+
+    def test_history_and_list_answer_304_until_chat_changes(self):
+        self.ask('這是什麼品種？')
+        detail = self.client.get(self.url, {'image_url': self.image_url})
+        listing = self.client.get(self.url)
+        self.assertNotEqual(detail['ETag'], listing['ETag'])
+
+        for query, etag in (({'image_url': self.image_url}, detail['ETag']), ({}, listing['ETag'])):
+            response = self.client.get(self.url, query, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.ask('牠怕冷嗎？')
+        response = self.client.get(self.url, {'image_url': self.image_url}, HTTP_IF_NONE_MATCH=detail['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['messages']), 4)
+
+        etag = response['ETag']
+        self.client.delete(self.url, {'image_url': self.image_url}, format='json')
+        response = self.client.get(self.url, {'image_url': self.image_url}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['messages'], [])
+
+    def test_since_returns_only_new_messages(self):
+        self.ask('這是什麼品種？')
+        response = self.client.get(self.url, {'image_url': self.image_url})
+        last_id = response.data['messages'][-1]['id']
+
+        response = self.client.get(self.url, {'image_url': self.image_url, 'since': last_id})
+        self.assertEqual(response.data['messages'], [])
+        self.assertFalse(response.data['reset'])
+
+        self.ask('牠怕冷嗎？')
+        response = self.client.get(self.url, {'image_url': self.image_url, 'since': last_id})
+        self.assertEqual([m['content'] for m in response.data['messages']], ['牠怕冷嗎？', '這是一隻哈士奇！'])
+        self.assertFalse(response.data['reset'])
+
+    @override_settings(CHAT_MESSAGES_PAGE_SIZE=4)
+    def test_long_history_is_paginated_backwards(self):
+        for i in range(5):
+            self.ask(f'問題 {i}')
+
+        response = self.client.get(self.url, {'image_url': self.image_url})
+        self.assertEqual([m['content'] for m in response.data['messages'][::2]], ['問題 3', '問題 4'])
+        self.assertTrue(response.data['has_older'])
+        self.assertEqual(response.data['message_count'], 10)
+
+        seen = response.data['messages']
+        while response.data['has_older']:
+            response = self.client.get(self.url, {'image_url': self.image_url, 'before': seen[0]['id']})
+            seen = response.data['messages'] + seen
+        self.assertEqual([m['content'] for m in seen[::2]], [f'問題 {i}' for i in range(5)])
+
+    @override_settings(CHAT_MESSAGES_PAGE_SIZE=4)
+    def test_stale_or_distant_cursor_resets_to_latest_page(self):
+        self.ask('這是什麼品種？')
+        first_id = ChatMessage.objects.earliest('id').id
+        for i in range(3):
+            self.ask(f'問題 {i}')
+
+        # 新訊息超過一頁：不逐頁補齊，直接回傳最新一頁
+        response = self.client.get(self.url, {'image_url': self.image_url, 'since': first_id})
+        self.assertTrue(response.data['reset'])
+        self.assertEqual(len(response.data['messages']), 4)
+        self.assertTrue(response.data['has_older'])
+
+        # 對話被清空後游標失效
+        self.client.delete(self.url, {'image_url': self.image_url}, format='json')
+        response = self.client.get(self.url, {'image_url': self.image_url, 'since': first_id})
+        self.assertTrue(response.data['reset'])
+        self.assertEqual(response.data['messages'], [])
+
+        response = self.client.get(self.url, {'image_url': self.image_url, 'since': 'abc'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(CHAT_HISTORY_TOKEN_BUDGET=40, CHAT_HISTORY_KEEP_RATIO=0.5)
+class HistoryWindowTests(APITestCase):
+    """對話歷史依 token 預算裁切，較早的對話以滾動摘要取代。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='longchat', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        # 每輪 (提問 + 回覆) 約 15 個 token，預算 40 放得下兩輪
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='x' * 44, summary='先前聊過品種')))
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def ask(self, prompt):
+        return self.client.post(reverse('chat-ask'), {'image_url': self.image_url, 'prompt': prompt}, format='json')
+
+    def test_split_window_keeps_recent_turns_in_pairs(self):
+        messages = [(i, 'user' if i % 2 == 0 else 'model', 'y' * 36) for i in range(8)]
+
+        folded, keep = history.split_window(messages, budget=40, keep_ratio=0.5)
+
+        self.assertEqual([m[0] for m in keep], [6, 7])
+        self.assertEqual([m[0] for m in folded], [0, 1, 2, 3, 4, 5])
+        self.assertEqual(history.split_window(messages[:2], budget=40, keep_ratio=0.5), ([], messages[:2]))
+
+    def test_long_chat_is_summarized_incrementally(self):
+        """測試情境：對話超出預算時才摘要一次，之後數輪不再摘要，送出的歷史維持在預算附近。"""
+        for i in range(3):
+            self.ask(f'問題 {i}')
+        self.assertEqual(self.fake.generate_calls, [])
+
+        self.ask('問題 3')
+        session = ChatSession.objects.get()
+        self.assertEqual(len(self.fake.generate_calls), 1)
+        self.assertEqual(session.summary, '先前聊過品種')
+        sent = self.fake.calls[-1]['history']
+        self.assertIn('先前聊過品種', sent[0].parts[0].text)
+        self.assertEqual(len(sent), 4)  # 摘要 (一組) + 最近一輪
+
+        self.ask('問題 4')
+        self.assertEqual(len(self.fake.generate_calls), 1)
+
+        self.ask('問題 5')
+        self.assertEqual(len(self.fake.generate_calls), 2)
+        self.assertIn('先前聊過品種', self.fake.generate_calls[-1]['contents'])
+        # 前端顯示的完整紀錄不受影響
+        self.assertEqual(ChatMessage.objects.count(), 12)
+
+    def test_summary_failure_sends_full_history(self):
+        for i in range(3):
+            self.ask(f'問題 {i}')
+        self.fake.errors = [RuntimeError('quota')]
+
+        with self.assertLogs('chat.history', 'WARNING'):
+            response = self.ask('問題 3')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(self.fake.calls[-1]['history']), 6)
+        self.assertEqual(ChatSession.objects.get().summary, '')
+
+    @override_settings(CHAT_AI_TIMEOUT=0.2, CHAT_AI_DEADLINE=0.3, CHAT_RETRY_BASE_DELAY=0.01)
+    def test_slow_summary_is_bounded_by_the_deadline(self):
+        """測試情境：摘要呼叫卡住時，受 CHAT_AI_DEADLINE 限制而放棄，改送完整訊息，不會無限期佔用名額。"""
+        for i in range(3):
+            self.ask(f'問題 {i}')
+        session = ChatSession.objects.get()
+        self.fake.latency = 5
+
+        started = time.monotonic()
+        with self.assertLogs('chat.history', 'WARNING'):
+            window = history.load_window(session)
+
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(len(window), 6)
+        timeouts = [call['timeout'] for call in self.fake.generate_calls]
+        self.assertTrue(timeouts and all(t <= 0.3 for t in timeouts))
+
+    async def test_slow_async_summary_is_bounded_by_the_deadline(self):
+        for i in range(3):
+            await sync_to_async(self.ask)(f'問題 {i}')
+        session = await ChatSession.objects.aget()
+        self.fake.latency = 5
+
+        started = time.monotonic()
+        with override_settings(CHAT_AI_TIMEOUT=0.2, CHAT_AI_DEADLINE=0.3, CHAT_RETRY_BASE_DELAY=0.01), \
+                self.assertLogs('chat.history', 'WARNING'):
+            window = await history.aload_window(session)
+
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(len(window), 6)
+
+    def test_clearing_history_resets_summary(self):
+        for i in range(4):
+            self.ask(f'問題 {i}')
+        self.client.delete(reverse('chat-ask'), {'image_url': self.image_url}, format='json')
+
+        session = ChatSession.objects.get()
+        self.assertEqual((session.summary, session.summary_until), ('', 0))
+
+
+class ImageAttachmentTests(APITestCase):
+    """圖片每個 Session 只登記一次，之後的對話以 handle 引用。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='attach', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.mock_image = self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def ask(self, prompt):
+        return self.client.post(reverse('chat-ask'), {'image_url': self.image_url, 'prompt': prompt}, format='json')
+
+    def test_image_is_uploaded_once_and_referenced_by_uri(self):
+        self.ask('這是什麼品種？')
+        self.ask('牠需要多少運動量？')
+
+        self.assertEqual(self.mock_image.call_count, 1)
+        self.assertEqual(len(self.fake.uploads), 1)
+        image = self.fake.calls[1]['message'][1]
+        self.assertEqual(image.file_data.file_uri, self.fake.uploads[0].uri)
+        self.assertEqual(ChatSession.objects.get().image_handle, 'files/fake-1')
+
+    def test_handle_close_to_expiry_is_refreshed(self):
+        self.ask('這是什麼品種？')
+        ChatSession.objects.update(image_expires_at=timezone.now() + timedelta(minutes=1))
+
+        self.ask('牠需要多少運動量？')
+
+        self.assertEqual(len(self.fake.uploads), 2)
+        self.assertEqual(ChatSession.objects.get().image_handle, 'files/fake-2')
+
+    def test_upload_failure_sends_image_inline(self):
+        self.enterContext(mock.patch.object(self.fake.files, 'upload', side_effect=RuntimeError('files api down')))
+
+        with self.assertLogs('chat.attachments', 'WARNING'):
+            response = self.ask('這是什麼品種？')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.fake.calls[0]['message'][1].inline_data.data, JPEG_BYTES)
+        self.assertEqual(ChatSession.objects.get().image_handle, '')
+
+    def test_uploaded_image_is_normalized(self):
+        source = make_image((1600, 1200), 'PNG')
+        self.mock_image.return_value = cached(source, url=self.image_url)
+        with tempfile.TemporaryDirectory() as tmp, override_settings(CHAT_IMAGE_CACHE_DIR=tmp):
+            self.ask('這是什麼品種？')
+
+        upload = self.fake.uploads[0]
+        self.assertEqual(upload.mime_type, 'image/jpeg')
+        self.assertLess(upload.size_bytes, len(source))
+        self.assertNotEqual(ChatSession.objects.get().image_sha256, hashlib.sha256(source).hexdigest())
+
+    @override_settings(CHAT_IMAGE_STORE='chat.attachments.LocalImageStore')
+    def test_local_store_reads_blob_and_reregisters_after_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp, override_settings(CHAT_IMAGE_CACHE_DIR=tmp):
+            cache = ImageCache()
+            self.mock_image.side_effect = lambda url: cache.store(url, JPEG_BYTES, 'image/jpeg')
+            self.ask('這是什麼品種？')
+            self.ask('牠需要多少運動量？')
+            self.assertEqual(self.mock_image.call_count, 1)
+            self.assertEqual(self.fake.calls[1]['message'][1].inline_data.data, JPEG_BYTES)
+
+            for blob in (Path(tmp) / 'blobs').glob('*/*'):
+                blob.unlink()
+            self.ask('牠怕冷嗎？')
+            self.assertEqual(self.mock_image.call_count, 2)
+        self.assertEqual(self.fake.uploads, [])
+
+
+class ChatQueryTests(APITestCase):
+    """
+    對話端點的查詢次數與索引回歸測試。
+    查詢次數包含 Session 查詢、歷史紀錄讀取與交易寫入 (SAVEPOINT 也算在內)，
+    數字改變時請確認是刻意的調整，而不是新增了 N+1 查詢。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='chatqueries', password='password')
+        self.client.force_authenticate(user=self.user)
+        # 版本號那一列只會在第一次寫入時建立，這裡先建好，量測的是之後每次請求的查詢次數
+        DataVersion.objects.bump(self.user.pk, DataVersion.CHAT)
+        self.url = reverse('chat-ask')
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def ask(self, prompt, **extra):
+        return self.client.post(self.url, {'image_url': self.image_url, 'prompt': prompt}, format='json', **extra)
+
+    def test_ask_query_counts(self):
+        # 第一輪：建立 Session (含 SAVEPOINT) + 記錄圖片 handle + 讀取歷史 + 寫入兩則訊息、活動資訊與版本號
+        with self.assertNumQueries(12):
+            self.ask('這是什麼品種？')
+        # 之後：查詢 Session + 讀取歷史 + 寫入兩則訊息、活動資訊與版本號，不隨對話長度增加
+        for i in range(3):
+            with self.assertNumQueries(8):
+                self.ask(f'問題 {i}')
+
+    def test_stream_and_queue_query_counts(self):
+        self.ask('這是什麼品種？')
+        with self.assertNumQueries(8):
+            response = self.client.post(
+                reverse('chat-ask-stream'), {'image_url': self.image_url, 'prompt': '牠怕冷嗎？'}, format='json'
+            )
+            b''.join(response.streaming_content)
+        with self.assertNumQueries(2):
+            response = self.ask('牠需要多少運動量？', HTTP_PREFER='respond-async')
+        with self.assertNumQueries(1):
+            self.client.get(reverse('chat-job', args=[response.data['job_id']]))
+
+    def test_read_and_delete_query_counts(self):
+        for i in range(5):
+            self.image_url = f'https://images.dog.ceo/breeds/husky/{i}.jpg'
+            self.ask('這是什麼品種？')
+
+        # 讀取都先查一次版本號 (ETag)；版本沒變時只有這一個查詢
+        with self.assertNumQueries(3):
+            response = self.client.get(self.url, {'image_url': self.image_url})
+        with self.assertNumQueries(1):
+            self.client.get(self.url, {'image_url': self.image_url}, HTTP_IF_NONE_MATCH=response['ETag'])
+        # 增量同步：查詢 Session + 只讀取游標之後的訊息
+        with self.assertNumQueries(3):
+            self.client.get(self.url, {'image_url': self.image_url, 'since': response.data['messages'][-1]['id']})
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 5)
+        with self.assertNumQueries(6):
+            self.client.delete(self.url, {'image_url': self.image_url}, format='json')
+        # 交易 (SAVEPOINT) + 估計列數 + 標記 Session 與工作 + 遞增版本號 + 建立清除工作 (資料在背景清除)
+        with self.assertNumQueries(8):
+            self.client.delete(self.url, format='json')
+
+    def test_server_timing_breaks_down_turn(self):
+        """測試情境：一輪對話的 Server-Timing 應分別列出 SQL (含查詢數) 與 Gemini 的耗時。"""
+        self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！', latency=0.05)))
+        self.ask('這是什麼品種？')
+
+        response = self.ask('牠怕冷嗎？')
+
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertIn('desc="8 queries"', timing['db'])
+        self.assertIn('desc="1 calls"', timing['ai'])
+        self.assertGreaterEqual(float(timing['ai'].split('dur=')[1].split(';')[0]), 50)
+        self.assertNotIn('fetch', timing)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN 輸出格式依資料庫而異')
+    def test_hot_queries_use_indexes(self):
+        self.ask('這是什麼品種？')
+        session = ChatSession.objects.get()
+
+        lookup = ChatSession.objects.for_image(self.user, self.image_url).explain()
+        self.assertIn('image_url_hash=?', lookup)
+        self.assertIn('USING INDEX', lookup)
+
+        session_list = ChatSession.objects.filter(user=self.user).with_messages().order_by('-last_message_at', '-id')
+        self.assertIn('chat_session_user_active_idx', session_list[:21].explain())
+
+        for messages in (
+            session.messages.all(),
+            history.pending_messages(session),
+            message_sync.latest_query(session, 50),
+            message_sync.delta_query(session, 1, 50),
+        ):
+            plan = messages.explain()
+            self.assertIn('chat_message_session_idx', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ChatStreamViewTests(APITestCase):
+    """針對串流版 /api/chat/ask/stream/ 的測試。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='streamuser', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('chat-ask-stream')
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！', chunk_size=3)))
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def test_tokens_are_streamed_and_turn_is_saved(self):
+        """測試情境：回覆應以多個 token 事件送出，結束後以 done 事件收尾並寫入資料庫。"""
+        response = self.client.post(self.url, {'image_url': self.image_url, 'prompt': '品種？'}, format='json')
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(body.count('event: token'), 3)
+        self.assertIn('event: done', body)
+        self.assertEqual(ChatMessage.objects.filter(role='model').get().content, '這是一隻哈士奇！')
+
+    def test_disconnect_does_not_save_partial_reply(self):
+        """測試情境：用戶端只讀了第一個 token 就斷線，不應寫入不完整的對話。"""
+        response = self.client.post(self.url, {'image_url': self.image_url, 'prompt': '品種？'}, format='json')
+
+        stream = iter(response.streaming_content)
+        next(stream)
+        response.close()
+
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_stream_metrics_recorded_after_stream_ends(self):
+        """測試情境：串流回應的 Gemini 耗時在串流結束後才寫入直方圖，且包含整段串流。"""
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        response = self.client.post(self.url, {'image_url': self.image_url, 'prompt': '品種？'}, format='json')
+        self.assertNotIn('phase="ai"', metrics.render())
+
+        b''.join(response.streaming_content)
+
+        ai_count = [line for line in metrics.render().splitlines()
+                    if line.startswith('http_request_phase_duration_seconds_count') and 'phase="ai"' in line]
+        self.assertEqual(len(ai_count), 1)
+        self.assertIn('ask/stream/', ai_count[0])
+
+    def test_missing_prompt_returns_400(self):
+        response = self.client.post(self.url, {'image_url': self.image_url}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AsyncChatViewTests(TestCase):
+    """
+    針對原生 async 版本 AsyncChatView 的測試。
+    直接以 AsyncRequestFactory 呼叫 view，並以 Token 標頭驗證身分 (與前端相同)。
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='asyncuser', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.factory = AsyncRequestFactory()
+        self.view = AsyncChatView.as_view()
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.enterContext(mock.patch('chat.attachments.image_cache.aget', new=mock.AsyncMock(return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        ))))
+
+    def request(self, method, data=None, query=None, token=True):
+        headers = {'Authorization': f'Token {self.token.key}'} if token else {}
+        if method == 'get':
+            return self.factory.get('/api/chat/ask/', query or {}, headers=headers)
+        return getattr(self.factory, method)(
+            '/api/chat/ask/', data=json.dumps(data or {}), content_type='application/json', headers=headers,
+        )
+
+    async def test_ask_and_read_history(self):
+        """測試情境：async 版本發問後，回覆與歷史紀錄格式應與同步版本一致。"""
+        response = await self.view(self.request('post', {'image_url': self.image_url, 'prompt': '品種？'}))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(json.loads(response.content)['response'], '這是一隻哈士奇！')
+
+        response = await self.view(self.request('get', query={'image_url': self.image_url}))
+        data = json.loads(response.content)
+        self.assertEqual([m['role'] for m in data['messages']], ['user', 'model'])
+        self.assertFalse(data['has_older'])
+
+        response = await self.view(self.request('get', query={
+            'image_url': self.image_url, 'since': data['messages'][0]['id'],
+        }))
+        self.assertEqual([m['role'] for m in json.loads(response.content)['messages']], ['model'])
+
+        response = await self.view(self.request('get'))
+        data = json.loads(response.content)
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNone(data['next'])
+
+    async def test_unchanged_history_returns_304(self):
+        await self.view(self.request('post', {'image_url': self.image_url, 'prompt': '品種？'}))
+        response = await self.view(self.request('get', query={'image_url': self.image_url}))
+
+        request = self.request('get', query={'image_url': self.image_url})
+        request.META['HTTP_IF_NONE_MATCH'] = response['ETag']
+        response = await self.view(request)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    async def test_delete_clears_messages(self):
+        await self.view(self.request('post', {'image_url': self.image_url, 'prompt': '品種？'}))
+
+        response = await self.view(self.request('delete', {'image_url': self.image_url}))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(await ChatMessage.objects.aexists())
+
+    async def test_unauthenticated_request_is_rejected(self):
+        response = await self.view(self.request('get', token=False))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ChatJobQueueTests(APITestCase):
+    """針對資料庫背景工作佇列 (chat.jobs) 與相關 API 的測試。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='jobuser', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        self.session = ChatSession.objects.create(user=self.user, image_url=self.image_url)
+        response_cache.clear()
+        # 發問限流另外由 AdmissionTests 測試，這裡連續發問不受限制
+        self.enterContext(override_settings(CHAT_ASK_RATE=0))
+        # 故障注入的測試會讓 Gemini 的斷路器累積失敗，不影響其他測試
+        self.addCleanup(resilience.breakers.reset)
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def test_ask_with_prefer_header_enqueues_job(self):
+        """測試情境：帶 Prefer: respond-async 發問應回傳 202 與 job_id，worker 執行後可查到結果。"""
+        response = self.client.post(
+            reverse('chat-ask'), {'image_url': self.image_url, 'prompt': '品種？'},
+            format='json', HTTP_PREFER='respond-async',
+        )
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertFalse(ChatMessage.objects.exists())
+
+        jobs.process_next('worker-1')
+
+        response = self.client.get(reverse('chat-job', args=[response.data['job_id']]))
+        self.assertEqual(response.data['status'], 'done')
+        self.assertEqual(response.data['response'], '這是一隻哈士奇！')
+        self.assertEqual(ChatMessage.objects.count(), 2)
+
+    def test_jobs_in_same_session_run_in_order(self):
+        """測試情境：同一個 Session 的第一筆工作尚未完成前，第二筆不可被領取。"""
+        first = jobs.enqueue(self.session, '第一題')
+        jobs.enqueue(self.session, '第二題')
+
+        self.assertEqual(jobs.claim('worker-1').id, first.id)
+        self.assertIsNone(jobs.claim('worker-2'))
+
+    def test_backlogged_session_does_not_starve_others(self):
+        """測試情境：單一 Session 積壓的工作超過一批候選時，其他 Session 可執行的工作仍能被領取。"""
+        for i in range(5):
+            jobs.enqueue(self.session, f'第 {i} 題')
+        other = ChatSession.objects.create(user=self.user, image_url='https://images.dog.ceo/breeds/pug/1.jpg')
+        waiting = jobs.enqueue(other, '品種？')
+
+        jobs.claim('worker-1', batch=2)
+
+        self.assertEqual(jobs.claim('worker-2', batch=2).id, waiting.id)
+
+    def test_expired_lease_is_reclaimed(self):
+        """測試情境：worker 領取後當掉，租約到期後工作可被其他 worker 重新領取。"""
+        job = jobs.enqueue(self.session, '品種？')
+        jobs.claim('worker-1')
+        ChatJob.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        reclaimed = jobs.claim('worker-2')
+
+        self.assertEqual(reclaimed.lease_owner, 'worker-2')
+        self.assertEqual(reclaimed.attempts, 2)
+
+    def test_expired_lease_after_max_attempts_is_failed(self):
+        """測試情境：worker 每次都在租約內當掉，用完嘗試次數後不再被領取，而是標記為 failed。"""
+        job = jobs.enqueue(self.session, '品種？')
+        waiting = jobs.enqueue(self.session, '第二題')
+        for attempt in range(job.max_attempts):
+            self.assertEqual(jobs.claim(f'worker-{attempt}').id, job.id)
+            ChatJob.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+
+        with self.assertLogs('chat.jobs', 'WARNING'):
+            claimed = jobs.claim('worker-last')
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('failed', job.max_attempts))
+        # 同一個 Session 後面的工作不再被擋住
+        self.assertEqual(claimed.id, waiting.id)
+
+    @override_settings(CHAT_AI_ATTEMPTS=1)  # 只測試工作層級的重新排入，不在單次呼叫內重試 (見 ResilienceTests)
+    def test_retryable_failure_is_requeued_then_failed(self):
+        """測試情境：暫時性錯誤會以退避重新排入佇列，用完嘗試次數後標記為 failed。"""
+        self.fake.errors = [ConnectionError('boom')] * 3
+        job = jobs.enqueue(self.session, '品種？')
+
+        with self.assertLogs('chat.jobs', 'WARNING'):
+            for attempt in range(3):
+                ChatJob.objects.filter(id=job.id).update(run_after=timezone.now())
+                job = jobs.process_next('worker-1')
+
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 3)
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_client_error_is_not_retried(self):
+        self.fake.errors = [errors.ClientError(400, {'error': {'message': 'bad request'}})]
+        jobs.enqueue(self.session, '品種？')
+
+        with self.assertLogs('chat.jobs', 'WARNING'):
+            job = jobs.process_next('worker-1')
+
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 1)
+
+    def test_worker_command_drains_queue(self):
+        """測試情境：chat_worker --once 應處理完佇列中的工作後結束。"""
+        jobs.enqueue(self.session, '第一題')
+        jobs.enqueue(self.session, '第二題')
+
+        call_command('chat_worker', '--once', '--processes', '1', stdout=io.StringIO())
+
+        self.assertEqual(list(ChatJob.objects.values_list('status', flat=True)), ['done', 'done'])
+        self.assertEqual(ChatMessage.objects.count(), 4)
+
+    def test_other_users_job_is_hidden(self):
+        other = User.objects.create_user(username='other', password='password')
+        job = jobs.enqueue(ChatSession.objects.create(user=other, image_url=self.image_url), '品種？')
+
+        response = self.client.get(reverse('chat-job', args=[job.id]))
+
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_sync_job_view_does_not_long_poll(self):
+        """測試情境：同步版本忽略 ?wait=，工作未完成時立即回應並以 Retry-After 請用戶端稍後再查詢。"""
+        job = jobs.enqueue(self.session, '品種？')
+
+        started = time.monotonic()
+        response = self.client.get(reverse('chat-job', args=[job.id]), {'wait': 5})
+
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertEqual(response['Retry-After'], str(settings.CHAT_JOB_RETRY_AFTER))
+
+
+@override_settings(CHAT_JOB_POLL_INTERVAL=0.05)
+class AsyncChatJobViewTests(TestCase):
+    """async 版本的工作狀態查詢 (長輪詢以 asyncio.sleep 等待，不佔用執行緒)。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='asyncjob', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.session = ChatSession.objects.create(
+            user=self.user, image_url='https://images.dog.ceo/breeds/husky/n02110185_1469.jpg',
+        )
+        self.job = jobs.enqueue(self.session, '品種？')
+        self.view = AsyncChatJobView.as_view()
+
+    def request(self, query, token=True):
+        headers = {'Authorization': f'Token {self.token.key}'} if token else {}
+        return AsyncRequestFactory().get(f'/api/chat/jobs/{self.job.id}/', query, headers=headers)
+
+    async def test_long_poll_returns_when_job_finishes(self):
+        """測試情境：等待期間工作完成，應立即回傳結果而不是等到逾時。"""
+        async def finish():
+            await asyncio.sleep(0.1)
+            await ChatJob.objects.filter(pk=self.job.pk).aupdate(status='done', result='這是一隻哈士奇！')
+
+        started = time.monotonic()
+        response, _ = await asyncio.gather(self.view(self.request({'wait': 5}), pk=self.job.pk), finish())
+
+        self.assertLess(time.monotonic() - started, 2)
+        data = json.loads(response.content)
+        self.assertEqual((data['status'], data['response']), ('done', '這是一隻哈士奇！'))
+        self.assertFalse(response.has_header('Retry-After'))
+
+    async def test_long_poll_times_out_with_retry_after(self):
+        response = await self.view(self.request({'wait': 0.1}), pk=self.job.pk)
+
+        self.assertEqual(json.loads(response.content)['status'], 'queued')
+        self.assertEqual(response['Retry-After'], str(settings.CHAT_JOB_RETRY_AFTER))
+
+    async def test_requires_authentication(self):
+        response = await self.view(self.request({}, token=False), pk=self.job.pk)
+
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class SessionActivityMigrationTests(TransactionTestCase):
+    """0006_chatsession_activity 應回填既有 Session 的活動資訊，否則它們會被 with_messages() 隱藏。"""
+
+    def migrate(self, target):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate([('chat', target)])
+        return executor.loader.project_state([('chat', target)]).apps
+
+    def test_existing_sessions_are_backfilled(self):
+        old = self.migrate('0005_session_url_hash_and_indexes')
+        user = old.get_model('auth', 'User').objects.create(username='legacy')
+        session = old.get_model('chat', 'ChatSession').objects.create(
+            user_id=user.pk, image_url='https://images.dog.ceo/a.jpg', image_url_hash='0' * 64,
+        )
+        ChatMessage = old.get_model('chat', 'ChatMessage')
+        ChatMessage.objects.create(session_id=session.pk, role='user', content='品種？')
+        last = ChatMessage.objects.create(session_id=session.pk, role='model', content='這是一隻哈士奇！')
+
+        self.migrate('0006_chatsession_activity')
+        # 回到最新的 schema，後續的測試使用完整的資料表
+        self.migrate(MigrationLoader(connection).graph.leaf_nodes('chat')[0][1])
+
+        session = ChatSession.objects.with_messages().get(pk=session.pk)
+        self.assertEqual(session.message_count, 2)
+        self.assertEqual(session.last_message_preview, '這是一隻哈士奇！')
+        self.assertEqual(session.last_message_at, last.created_at)
+
+
+class AdmissionTests(APITestCase):
+    """發問限流與 Gemini 同時呼叫上限 (chat/admission.py)。"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='admission', password='password')
+        self.client.force_authenticate(user=self.user)
+        self.image_url = 'https://images.dog.ceo/breeds/husky/n02110185_1469.jpg'
+        response_cache.clear()
+        admission.ask_buckets.clear()
+        self.addCleanup(admission.ask_buckets.clear)
+        self.gate = self.enterContext(mock.patch('chat.admission.gate', admission.ConcurrencyGate()))
+        self.fake = self.enterContext(override_client(FakeGenAIClient(reply='這是一隻哈士奇！')))
+        self.enterContext(mock.patch('chat.attachments.image_cache.get', return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        )))
+
+    def ask(self, prompt='這是什麼品種？'):
+        return self.client.post(reverse('chat-ask'), {'image_url': self.image_url, 'prompt': prompt}, format='json')
+
+    @override_settings(CHAT_ASK_RATE=60, CHAT_ASK_BURST=2, CHAT_ASK_MAX_DELAY=1.5)
+    def test_token_bucket_allows_burst_then_delays_then_rejects(self):
+        buckets = admission.TokenBuckets()
+
+        self.assertEqual(buckets.reserve(1), (True, 0.0))
+        self.assertEqual(buckets.reserve(1), (True, 0.0))
+        allowed, delay = buckets.reserve(1)
+        self.assertTrue(allowed)
+        self.assertAlmostEqual(delay, 1, places=1)
+        allowed, retry_after = buckets.reserve(1)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 0.5, places=1)
+        # 其他使用者不受影響
+        self.assertEqual(buckets.reserve(2), (True, 0.0))
+
+    @override_settings(CHAT_ASK_RATE=60, CHAT_ASK_BURST=1, CHAT_ASK_MAX_DELAY=0)
+    def test_flooding_user_gets_429_with_retry_after(self):
+        self.assertEqual(self.ask().status_code, status.HTTP_201_CREATED)
+
+        response = self.ask('牠需要多少運動量？')
+
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertIn('error', response.data)
+        self.assertEqual(len(self.fake.calls), 1)
+        # 讀取對話紀錄不受發問限流影響
+        self.assertEqual(self.client.get(reverse('chat-ask')).status_code, status.HTTP_200_OK)
+
+    @override_settings(CHAT_ASK_RATE=600, CHAT_ASK_BURST=1, CHAT_ASK_MAX_DELAY=1)
+    def test_sync_view_rejects_instead_of_sleeping(self):
+        """測試情境：同步版本不在 worker 執行緒中等待，小幅超量也直接回傳 429 與 Retry-After。"""
+        self.ask()
+
+        response = self.ask('牠需要多少運動量？')
+
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1')
+
+    @override_settings(CHAT_ASK_RATE=600, CHAT_ASK_BURST=1, CHAT_ASK_MAX_DELAY=1)
+    def test_async_small_overload_is_delayed_instead_of_rejected(self):
+        async def ask_twice():
+            await admission.athrottle(self.user)
+            with metrics.activate(metrics.RequestTiming()) as timing:
+                await admission.athrottle(self.user)
+            return timing
+
+        timing = async_to_sync(ask_twice)()
+
+        self.assertGreaterEqual(timing.seconds['queue'], 0.05)
+
+    @override_settings(CHAT_AI_MAX_CONCURRENCY=1, CHAT_AI_MAX_QUEUE=1, CHAT_AI_QUEUE_TIMEOUT=5)
+    def test_gate_queues_then_rejects_when_queue_is_full(self):
+        gate = admission.ConcurrencyGate()
+        gate.acquire()
+        queued = threading.Thread(target=gate.acquire)
+        queued.start()
+        while not gate.waiting:
+            time.sleep(0.01)
+
+        with self.assertRaises(admission.Overloaded):
+            gate.acquire()
+        self.assertEqual(gate.rejected, 1)
+
+        gate.release()
+        queued.join(5)
+        self.assertEqual((gate.active, gate.waiting), (1, 0))
+
+    @override_settings(CHAT_AI_MAX_CONCURRENCY=1, CHAT_AI_QUEUE_TIMEOUT=0.05)
+    def test_queue_timeout_returns_503(self):
+        self.gate.acquire()
+        self.addCleanup(self.gate.release)
+
+        with self.assertLogs('chat.views', 'WARNING'):
+            response = self.ask()
+
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['retry_after'], 1)
+        self.assertEqual(self.fake.calls, [])
+
+    @override_settings(CHAT_AI_MAX_CONCURRENCY=4, CHAT_AI_BACKOFF_SECONDS=0.2)
+    def test_quota_error_halves_concurrency_and_pauses_admissions(self):
+        self.fake.errors = [errors.ClientError(429, {'error': {'message': 'RESOURCE_EXHAUSTED'}})]
+        with self.assertLogs('chat.views', 'WARNING'):
+            self.assertEqual(self.ask().status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual((self.gate.throttled, self.gate.limit), (1, 2))
+
+        # 暫停期間的發問排隊等待，而不是失敗
+        started = time.perf_counter()
+        self.assertEqual(self.ask('牠需要多少運動量？').status_code, status.HTTP_201_CREATED)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.15)
+        # 成功之後逐步恢復上限
+        self.assertEqual(self.gate.limit, 3)
+
+    @override_settings(CHAT_ASK_RATE=60, CHAT_ASK_BURST=1, CHAT_ASK_MAX_DELAY=0, CHAT_AI_MAX_CONCURRENCY=1)
+    def test_async_view_applies_the_same_limits(self):
+        factory = AsyncRequestFactory()
+        self.enterContext(mock.patch('chat.attachments.image_cache.aget', new=mock.AsyncMock(return_value=CachedImage(
+            url=self.image_url, sha256='0' * 64, content=JPEG_BYTES, content_type='image/jpeg',
+        ))))
+
+        async def ask():
+            request = factory.post(
+                reverse('chat-ask'), {'image_url': self.image_url, 'prompt': '這是什麼品種？'},
+                content_type='application/json',
+            )
+            request.user = self.user
+            return await AsyncChatView().post(request)
+
+        async def run():
+            first = await ask()
+            self.assertEqual(self.gate.active, 0)
+            return first, await ask()
+
+        first, second = async_to_sync(run)()
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(second.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(second['Retry-After'], '1')
+
+
+class LoadBenchmarkTests(SimpleTestCase):
+    """針對 benchmark_load 壓力測試指令的冒煙測試。"""
+
+    def test_parse_mix(self):
+        self.assertEqual(loadtest.parse_mix('favorites_list=3,chat_turn'), {'favorites_list': 3.0, 'chat_turn': 1.0})
+        with self.assertRaises(ValueError):
+            loadtest.parse_mix('unknown=1')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertIsNone(loadtest.percentile([], 50))
+
+    def test_command_writes_json_report(self):
+        """
+        測試情境：以少量請求執行完整流程，JSON 結果應包含每種操作的百分位數與查詢數，且沒有錯誤。
+        指令會建立自己的暫存資料庫並使用多個執行緒，因此在子行程中執行 (不與測試資料庫互相干擾)。
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / 'result.json'
+            subprocess.run(
+                [sys.executable, 'manage.py', 'benchmark_load', '--users', '2', '--concurrency', '2',
+                 '--duration', '30', '--requests', '40', '--latency', '0', '--favorites', '2', '--etag',
+                 '--output', str(output)],
+                cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+            )
+            result = json.loads(output.read_text(encoding='utf-8'))
+
+        self.assertEqual(result['totals']['requests'], 40)
+        self.assertEqual(result['totals']['errors'], 0)
+        self.assertEqual(set(result['operations']) - set(loadtest.OPERATIONS), set())
+        for stats in result['operations'].values():
+            self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+            self.assertGreater(stats['queries_per_request'], 0)
+        self.assertEqual(result['environment']['database'], 'sqlite')
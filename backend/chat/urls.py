@@ -1,7 +1,17 @@
+from django.conf import settings
 from django.urls import path
-from .views import ChatView
+from .views import ChatView, ChatStreamView, AsyncChatView, ChatJobView, AsyncChatJobView
+
+# 以 ASGI 伺服器部署時，可將 CHAT_ASYNC_VIEWS 設為 True 改用原生 async 版本的對話介面
+ask_view = AsyncChatView if settings.CHAT_ASYNC_VIEWS else ChatView
+# 長輪詢只在 async 版本支援 (同步版本立即回應，以 Retry-After 請用戶端稍後再查詢)
+job_view = AsyncChatJobView if settings.CHAT_ASYNC_VIEWS else ChatJobView
 
 urlpatterns = [
     # 這將對應到 /api/chat/ask/
-    path('ask/', ChatView.as_view(), name='chat-ask'),
+    path('ask/', ask_view.as_view(), name='chat-ask'),
+    # 串流版 (Server-Sent Events)，對應 /api/chat/ask/stream/
+    path('ask/stream/', ChatStreamView.as_view(), name='chat-ask-stream'),
+    # 背景對話工作的狀態查詢 (async 版本支援 ?wait= 長輪詢)，對應 /api/chat/jobs/<id>/
+    path('jobs/<int:pk>/', job_view.as_view(), name='chat-job'),
 ]
\ No newline at end of file
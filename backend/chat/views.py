@@ -1,54 +1,161 @@
-import os
-import requests
+import asyncio
+import json
+import logging
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, permissions
 from django.shortcuts import get_object_or_404
-from drf_spectacular.utils import extend_schema
-from .models import ChatSession, ChatMessage
-from .serializers import ChatSessionSerializer, ChatInputSerializer, ChatSessionListSerializer
+from django.urls import reverse
+from drf_spectacular.utils import extend_schema, OpenApiParameter
+from api import conditional
+from api.models import DataVersion
+from api.pagination import KeysetPagination
+from .models import ChatSession, ChatJob
+from .serializers import (
+    ChatSessionSerializer, ChatInputSerializer, ChatSessionListSerializer, ChatJobSerializer,
+)
+from .fetch import FetchError
+from . import admission, jobs, message_sync, resilience, services
 
 # 引入全新世代的 Google SDK
-from google import genai
-from google.genai import types, errors
+from google.genai import errors
 
-class ChatView(APIView):
+logger = logging.getLogger(__name__)
+
+
+def upstream_error_response(e, where):
+    """
+    將對話流程中的例外轉成統一的錯誤回應 (同步與串流版本共用)。
+    - 圖片下載失敗 -> 502
+    - Gemini 配額用盡 -> 429
+    - Gemini 呼叫的等待佇列已滿或等待逾時 -> 503 (見 chat.admission)
+    - Gemini 的斷路器開啟中 (連續失敗) -> 503 (見 chat.resilience)
+    - 其他錯誤 -> 500
+    """
+    if isinstance(e, FetchError):
+        logger.warning(f"Image fetch failed in {where}: {str(e)}")
+        return {"error": f"圖片下載失敗: {str(e)}"}, status.HTTP_502_BAD_GATEWAY
+
+    if isinstance(e, admission.Overloaded):
+        logger.warning(f"Gemini admission rejected in {where}: {str(e)}")
+        return (
+            {"error": "目前發問的人數較多，請稍後再試。", "retry_after": e.retry_after},
+            status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+    if isinstance(e, resilience.CircuitOpen):
+        logger.warning(f"Circuit open in {where}: {str(e)}")
+        return (
+            {"error": "AI 服務暫時無法使用，請稍後再試。", "retry_after": round(e.retry_after)},
+            status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+    if isinstance(e, errors.ClientError):
+        if admission.is_quota_error(e):
+            logger.warning(f"Gemini API Quota Exceeded: {str(e)}")
+            return (
+                {"error": "API 使用量已達上限 (429 Resource Exhausted)，請稍後再試或聯繫管理員更換模型。"},
+                status.HTTP_429_TOO_MANY_REQUESTS
+            )
+        logger.error(f"GenAI ClientError in {where}: {str(e)}", exc_info=True)
+        return {"error": f"AI 服務連線錯誤: {str(e)}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+    logger.error(f"Error in {where}: {str(e)}", exc_info=True)
+    return {"error": f"AI 處理失敗: {str(e)}"}, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def wants_queued_turn(request):
+    """
+    是否以背景工作模式處理發問：
+    - settings.CHAT_ASK_MODE = 'queue' 時全部走背景工作
+    - 或用戶端帶上 `Prefer: respond-async` 標頭 (RFC 7240) 主動要求
+    """
+    return settings.CHAT_ASK_MODE == 'queue' or 'respond-async' in request.headers.get('Prefer', '')
+
+
+def job_accepted_payload(job):
+    """建立背景工作後回傳的 202 內容與輪詢網址。"""
+    location = reverse('chat-job', args=[job.id])
+    return {"job_id": job.id, "status": job.status, "location": location}, location
+
+
+def purge_accepted_payload(purge):
+    """刪除全部對話後回傳的 202 內容與清除進度的查詢網址。"""
+    location = reverse('data-purge', args=[purge.id])
+    data = {"message": "所有對話紀錄已刪除，資料將在背景清除", "purge_id": purge.id, "status": purge.status}
+    return {**data, "location": location}, location
+
+
+class AskThrottleMixin:
+    """發問 (POST) 套用每位使用者的 token bucket (chat.admission)，超量時以與其他錯誤相同的格式回傳 429。"""
+    throttle_classes = [admission.ChatAskThrottle]
+
+    def throttled(self, request, wait):
+        raise admission.AskThrottled(wait)
+
+
+class ChatView(AskThrottleMixin, APIView):
     """
     狗狗 AI 對話介面
     提供針對狗狗圖片的發問、歷史紀錄獲取與清空功能。
     """
     permission_classes = [permissions.IsAuthenticated]
 
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('image_url', str, description="指定圖片時回傳該圖片的對話詳情，否則回傳對話列表"),
+            OpenApiParameter('since', int, description="只回傳這則訊息 (id) 之後的新訊息"),
+            OpenApiParameter('before', int, description="回傳這則訊息 (id) 之前的一頁較早訊息"),
+        ],
+        responses=ChatSessionSerializer,
+    )
     def get(self, request):
         """
         獲取對話紀錄
-        - 若提供 image_url: 回傳該圖片的詳細對話紀錄。
-        - 若未提供 image_url: 回傳使用者的「所有」對話階段列表 (List)。
+        - 若提供 image_url: 回傳該圖片的對話詳情與最新一頁訊息；
+          可帶 ?since=<訊息 id> 只取新訊息，或 ?before=<訊息 id> 往回載入更早的訊息 (見 chat.message_sync)。
+        - 若未提供 image_url: 回傳使用者的對話階段列表，依最近活動排序並以 (last_message_at, id) 游標分頁 (見 api.pagination)。
+        兩者都帶有 ETag / Last-Modified，使用者的對話沒有變動時回傳 304 (見 api.conditional)。
         """
+        validators = conditional.validators(request, DataVersion.CHAT)
+        return validators.not_modified(request) or validators.apply(self.get_response(request))
+
+    def get_response(self, request):
         image_url = request.query_params.get('image_url')
 
         if image_url:
             # 有指定圖片 -> 獲取單一對話詳情
-            session, _ = ChatSession.objects.get_or_create(user=request.user, image_url=image_url)
-            serializer = ChatSessionSerializer(session)
+            since, before, limit = message_sync.parse_params(request.query_params)
+            session, _ = ChatSession.objects.get_or_create_for(request.user, image_url)
+            page = message_sync.load_page(session, since=since, before=before, limit=limit)
+            serializer = ChatSessionSerializer(session, context={'page': page})
             return Response(serializer.data)
         else:
             # 未指定圖片 -> 獲取對話列表
-            # 過濾掉沒有任何訊息的空 Session
-            sessions = ChatSession.objects.filter(user=request.user, messages__isnull=False).distinct()
-            serializer = ChatSessionListSerializer(sessions, many=True)
-            return Response(serializer.data)
+            # 過濾掉沒有任何訊息的空 Session，依最近活動時間由新到舊排列
+            sessions = ChatSession.objects.filter(user=request.user).with_messages()
+            paginator = KeysetPagination(ordering_field='last_message_at')
+            page = paginator.paginate_queryset(sessions, request, view=self)
+            return paginator.get_paginated_response(ChatSessionListSerializer(page, many=True).data)
 
     @extend_schema(
         request=ChatInputSerializer, 
-        responses={201: ChatSessionSerializer},
-        description="傳送狗狗圖片網址與問題，獲取 AI 的多模態回覆"
+        responses={201: ChatSessionSerializer, 202: ChatJobSerializer},
+        description="傳送狗狗圖片網址與問題，獲取 AI 的多模態回覆。"
+                    "帶上 `Prefer: respond-async` 標頭時改為建立背景工作並回傳 202 與 job_id。"
     )
     def post(self, request):
         """針對狗狗圖片進行 AI 多模態發問 (Gemini 2.5 Flash)"""
-        import logging
-        logger = logging.getLogger(__name__)
-
         try:
             image_url = request.data.get('image_url')
             prompt = request.data.get('prompt')
@@ -57,74 +164,264 @@ class ChatView(APIView):
                 return Response({"error": "缺少 image_url 或 prompt"}, status=status.HTTP_400_BAD_REQUEST)
 
             # 1. 獲取 Session
-            session, _ = ChatSession.objects.get_or_create(user=request.user, image_url=image_url)
-
-            # 2. 準備新版 SDK 要求的歷史紀錄格式 (types.Content)
-            history_messages = session.messages.all().order_by('created_at')
-            gemini_history = []
-            for msg in history_messages:
-                gemini_history.append(
-                    types.Content(
-                        role="user" if msg.role == "user" else "model",
-                        parts=[types.Part.from_text(text=msg.content)]
-                    )
-                )
-
-            # 3. 下載圖片
-            img_response = requests.get(image_url)
-            img_response.raise_for_status()
-            
-            # 新版 SDK 處理圖片二進位的專屬寫法
-            img_part = types.Part.from_bytes(
-                data=img_response.content, 
-                mime_type='image/jpeg'
-            )
+            session, _ = ChatSession.objects.get_or_create_for(request.user, image_url)
 
-            # 4. 初始化新版客戶端與建立對話，並指定最新版的模型
-            client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
-            chat = client.chats.create(
-                model='gemini-2.5-flash',
-                history=gemini_history
-            )
-            
-            # 5. 發送文字與圖片多模態陣列
-            ai_response = chat.send_message([prompt, img_part])
-            ai_text = ai_response.text
+            # 背景工作模式：只建立工作並立即回傳 202，由 chat_worker 執行後以 GET /api/chat/jobs/<id>/ 取得結果
+            if wants_queued_turn(request):
+                data, location = job_accepted_payload(jobs.enqueue(session, prompt))
+                return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
 
-            # 6. 永久化儲存
-            ChatMessage.objects.create(session=session, role='user', content=prompt)
-            ChatMessage.objects.create(session=session, role='model', content=ai_text)
+            # 2. 準備歷史紀錄與圖片、呼叫 Gemini，並永久化儲存 (詳見 chat.services)
+            ai_text = services.run_turn(session, image_url, prompt)
 
             return Response({"response": ai_text}, status=status.HTTP_201_CREATED)
 
-        except errors.ClientError as e:
-            if getattr(e, 'code', None) == 429 or '429' in str(e):
-                logger.warning(f"Gemini API Quota Exceeded: {str(e)}")
-                return Response(
-                    {"error": "API 使用量已達上限 (429 Resource Exhausted)，請稍後再試或聯繫管理員更換模型。"},
-                    status=status.HTTP_429_TOO_MANY_REQUESTS
-                )
-            logger.error(f"GenAI ClientError in ChatView post: {str(e)}", exc_info=True)
-            return Response({"error": f"AI 服務連線錯誤: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-
         except Exception as e:
-            logger.error(f"Error in ChatView post: {str(e)}", exc_info=True)
-            return Response({"error": f"AI 處理失敗: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            data, status_code = upstream_error_response(e, 'ChatView post')
+            return Response(data, status=status_code)
 
     def delete(self, request):
         """
         刪除對話紀錄
         - 若提供 image_url: 刪除該圖片的對話紀錄。
         - 若未提供 image_url: (危險操作) 刪除使用者「所有」對話紀錄。
+          對話會立即隱藏，資料在背景分批清除，回傳 202 與進度查詢網址 (GET /api/purges/<id>/)。
         """
         image_url = request.data.get('image_url')
 
         if image_url:
             # 刪除單一圖片的對話
-            session = get_object_or_404(ChatSession, user=request.user, image_url=image_url)
-            session.messages.all().delete()
+            session = get_object_or_404(ChatSession.objects.for_image(request.user, image_url))
+            services.clear_history(session)
             return Response({"message": "對話紀錄已成功清空"}, status=status.HTTP_204_NO_CONTENT)
         else:
-            # 刪除所有圖片的對話
-            ChatSession.objects.filter(user=request.user).delete()
-            return Response({"message": "所有對話紀錄已全部刪除"}, status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+            # 刪除所有圖片的對話：立即隱藏，資料在背景分批清除，回傳 202 與進度查詢網址
+            data, location = purge_accepted_payload(services.delete_sessions(request.user))
+            return Response(data, status=status.HTTP_202_ACCEPTED, headers={'Location': location})
+
+
+def job_poll_headers(job):
+    """工作尚未完成時，以 Retry-After 告訴用戶端多久後再查詢。"""
+    if job.status in jobs.UNFINISHED:
+        return {'Retry-After': str(settings.CHAT_JOB_RETRY_AFTER)}
+    return {}
+
+
+class ChatJobView(APIView):
+    """
+    查詢背景對話工作的狀態 (同步版本)
+    一律立即回應：在同步的 worker 中等待會佔住這個功能原本要釋放的執行緒，
+    因此忽略 ?wait=，工作尚未完成時以 Retry-After 請用戶端稍後再查詢。
+    長輪詢由 AsyncChatJobView 提供 (CHAT_ASYNC_VIEWS = True 時使用)。
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        parameters=[OpenApiParameter('wait', int, description="最長等待秒數 (長輪詢，僅 async 部署支援)，預設 0 表示立即回應")],
+        responses={200: ChatJobSerializer},
+    )
+    def get(self, request, pk):
+        job = get_object_or_404(ChatJob.objects.select_related('session'), pk=pk, session__user=request.user)
+        return Response(ChatJobSerializer(job).data, headers=job_poll_headers(job))
+
+
+def sse_event(event, data):
+    """組成一則 Server-Sent Events 訊息。"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ChatStreamView(AskThrottleMixin, APIView):
+    """
+    狗狗 AI 對話 (串流版)
+    以 Server-Sent Events 逐段推送 AI 回覆，前端不必等整段回覆產生完畢才顯示。
+
+    事件格式：
+    - event: token  data: {"text": "..."}      逐段回覆文字
+    - event: done   data: {"response": "..."}  完整回覆 (此時已寫入資料庫)
+    - event: error  data: {"error": "...", "status": 500}
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    @extend_schema(
+        request=ChatInputSerializer,
+        responses={(200, 'text/event-stream'): str},
+        description="傳送狗狗圖片網址與問題，以 Server-Sent Events 串流獲取 AI 回覆"
+    )
+    def post(self, request):
+        """串流版的 AI 多模態發問"""
+        image_url = request.data.get('image_url')
+        prompt = request.data.get('prompt')
+
+        if not image_url or not prompt:
+            return Response({"error": "缺少 image_url 或 prompt"}, status=status.HTTP_400_BAD_REQUEST)
+
+        session, _ = ChatSession.objects.get_or_create_for(request.user, image_url)
+
+        # 圖片下載等前置步驟在開始串流前完成，失敗時仍可回傳一般的 JSON 錯誤與狀態碼
+        try:
+            chunks = services.stream_turn(session, image_url, prompt)
+        except Exception as e:
+            data, status_code = upstream_error_response(e, 'ChatStreamView post')
+            return Response(data, status=status_code)
+
+        response = StreamingHttpResponse(self.event_stream(chunks), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # 關閉 nginx 等反向代理的緩衝，讓每個 token 立即送達瀏覽器
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def event_stream(self, chunks):
+        parts = []
+        try:
+            for text in chunks:
+                parts.append(text)
+                yield sse_event('token', {'text': text})
+            # chunks 完整跑完代表對話已寫入資料庫
+            yield sse_event('done', {'response': ''.join(parts)})
+        except GeneratorExit:
+            # 用戶端中途斷線：關閉上游串流，不儲存不完整的回覆
+            logger.info("Client disconnected during ChatStreamView stream")
+            chunks.close()
+            raise
+        except Exception as e:
+            data, status_code = upstream_error_response(e, 'ChatStreamView stream')
+            yield sse_event('error', {**data, 'status': status_code})
+
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAuthenticatedView(View):
+    """
+    原生 async view 的共用基底：DRF 的 APIView 不支援 async，因此直接繼承 Django 的 View，
+    在 dispatch 中自行以 DRF 的驗證類別驗證身分。
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        # 沿用 REST_FRAMEWORK 設定的驗證類別 (Token / Session，含 CSRF 檢查)，與同步版行為一致
+        drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+        try:
+            user = await sync_to_async(lambda: drf_request.user)()
+        except APIException as e:
+            return JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+        if not user.is_authenticated:
+            return JsonResponse({"detail": "未提供身分驗證憑證。"}, status=status.HTTP_401_UNAUTHORIZED)
+
+        request.user = user
+        return await super().dispatch(request, *args, **kwargs)
+
+    def json_body(self, request):
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+
+
+class AsyncChatJobView(AsyncAuthenticatedView):
+    """
+    查詢背景對話工作的狀態 (原生 async 版本，CHAT_ASYNC_VIEWS = True 時使用)
+    帶上 ?wait=秒數 時以長輪詢 (long-poll) 等待，直到工作完成/失敗或等待逾時才回應；
+    等待期間以 asyncio.sleep 讓出事件迴圈，不佔用執行緒。
+    """
+
+    async def get(self, request, pk):
+        queryset = ChatJob.objects.select_related('session')
+        job = await queryset.filter(pk=pk, session__user=request.user).afirst()
+        if job is None:
+            return JsonResponse({"detail": "找不到。"}, status=status.HTTP_404_NOT_FOUND)
+
+        try:
+            wait = min(float(request.GET.get('wait', 0)), settings.CHAT_JOB_MAX_WAIT)
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        while job.status in jobs.UNFINISHED and time.monotonic() < deadline:
+            await asyncio.sleep(settings.CHAT_JOB_POLL_INTERVAL)
+            await job.arefresh_from_db(from_queryset=queryset)
+
+        response = JsonResponse(ChatJobSerializer(job).data)
+        for name, value in job_poll_headers(job).items():
+            response[name] = value
+        return response
+
+
+class AsyncChatView(AsyncAuthenticatedView):
+    """
+    狗狗 AI 對話介面 (原生 async 版本)
+    與 ChatView 提供相同的 GET / POST / DELETE 行為與回應格式，但全程不佔用執行緒：
+    - 資料庫使用 Django async ORM (aget_or_create / async for / adelete)
+    - 圖片下載使用 httpx 非同步 client，Gemini 使用 client.aio
+    - 發問時，圖片下載與歷史紀錄讀取同時進行
+    需以 ASGI 伺服器執行 (例如 uvicorn config.asgi:application)，並設定 CHAT_ASYNC_VIEWS = True。
+    """
+
+    async def get(self, request):
+        """獲取對話紀錄 (行為同 ChatView.get)"""
+        validators = await conditional.avalidators(request, DataVersion.CHAT)
+        return validators.not_modified(request) or validators.apply(await self.get_response(request))
+
+    async def get_response(self, request):
+        image_url = request.GET.get('image_url')
+
+        if image_url:
+            try:
+                since, before, limit = message_sync.parse_params(request.GET)
+            except APIException as e:
+                return JsonResponse(e.detail, status=e.status_code)
+            session, _ = await ChatSession.objects.aget_or_create_for(request.user, image_url)
+            page = await message_sync.aload_page(session, since=since, before=before, limit=limit)
+            # 訊息已先以 async 讀好，序列化時不會再查詢資料庫
+            return JsonResponse(ChatSessionSerializer(session, context={'page': page}).data)
+
+        paginator = KeysetPagination(ordering_field='last_message_at')
+        try:
+            page = await paginator.apaginate_queryset(
+                ChatSession.objects.filter(user=request.user).with_messages(), request
+            )
+        except APIException as e:
+            return JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+        return JsonResponse(paginator.get_paginated_data(ChatSessionListSerializer(page, many=True).data))
+
+    async def post(self, request):
+        """針對狗狗圖片進行 AI 多模態發問 (行為同 ChatView.post)"""
+        body = self.json_body(request)
+        image_url = body.get('image_url')
+        prompt = body.get('prompt')
+
+        if not image_url or not prompt:
+            return JsonResponse({"error": "缺少 image_url 或 prompt"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            await admission.athrottle(request.user)
+        except admission.AskThrottled as e:
+            response = JsonResponse(e.detail, status=e.status_code)
+            response['Retry-After'] = str(e.wait)
+            return response
+
+        try:
+            session, _ = await ChatSession.objects.aget_or_create_for(request.user, image_url)
+            if wants_queued_turn(request):
+                data, location = job_accepted_payload(await sync_to_async(jobs.enqueue)(session, prompt))
+                response = JsonResponse(data, status=status.HTTP_202_ACCEPTED)
+                response['Location'] = location
+                return response
+            ai_text = await services.arun_turn(session, image_url, prompt)
+            return JsonResponse({"response": ai_text}, status=status.HTTP_201_CREATED)
+        except Exception as e:
+            data, status_code = upstream_error_response(e, 'AsyncChatView post')
+            return JsonResponse(data, status=status_code)
+
+    async def delete(self, request):
+        """刪除對話紀錄 (行為同 ChatView.delete)"""
+        image_url = self.json_body(request).get('image_url')
+
+        if image_url:
+            session = await ChatSession.objects.for_image(request.user, image_url).afirst()
+            if session is None:
+                return JsonResponse({"detail": "找不到。"}, status=status.HTTP_404_NOT_FOUND)
+            await services.aclear_history(session)
+            return JsonResponse({"message": "對話紀錄已成功清空"}, status=status.HTTP_204_NO_CONTENT)
+
+        data, location = purge_accepted_payload(await services.adelete_sessions(request.user))
+        response = JsonResponse(data, status=status.HTTP_202_ACCEPTED)
+        response['Location'] = location
+        return response
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -59,6 +60,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.ServerTimingMiddleware',  # 請求耗時 (Server-Timing / 直方圖)，放在最外層才能量到完整的時間
     'corsheaders.middleware.CorsMiddleware',  # 處理跨域請求的中介軟體，應放在 SecurityMiddleware 之前。
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -100,6 +102,37 @@ DATABASES = {
     }
 }
 
+# SQLite 高併發模式 (SQLITE_CONCURRENT=1 啟用)，適合多個 worker / 執行緒同時寫入：
+# - WAL：讀取不會被寫入擋住；synchronous=NORMAL 在 WAL 下仍不會損毀資料，只是斷電時可能遺失最後幾筆 commit
+# - busy_timeout：搶不到寫入鎖時等待而不是立即回傳 "database is locked"
+# - transaction_mode=IMMEDIATE：交易一開始就取得寫入鎖，避免兩個交易都從讀取升級成寫入時互相卡住
+# - CONN_MAX_AGE：保留連線，不必每個請求重新開檔並重新執行 PRAGMA
+# - DB_WRITE_BATCHING：寫入交給單一 writer 執行緒並合併 commit (見 api/db.py)
+# 效果可用 python manage.py benchmark_sqlite_writes 比較
+SQLITE_CONCURRENT = os.environ.get('SQLITE_CONCURRENT', '').lower() in ('1', 'true', 'yes')
+SQLITE_CONCURRENT_OPTIONS = {
+    'timeout': 20,
+    'transaction_mode': 'IMMEDIATE',
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        'PRAGMA busy_timeout=20000;'
+        'PRAGMA mmap_size=134217728;'
+        'PRAGMA temp_store=MEMORY;'
+    ),
+}
+if SQLITE_CONCURRENT:
+    DATABASES['default'].update({
+        'OPTIONS': SQLITE_CONCURRENT_OPTIONS,
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+    })
+
+# 寫入序列化：一批最多幾筆寫入、第一筆到達後最多再等幾秒湊齊一批
+DB_WRITE_BATCHING = SQLITE_CONCURRENT
+DB_WRITE_BATCH_MAX = 50
+DB_WRITE_BATCH_WAIT = 0.002
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -169,11 +202,18 @@ SPECTACULAR_SETTINGS = {
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        # 與 TokenAuthentication 相同，但以快取省下每個請求的 token / user 查詢 (見 api/authentication.py)
+        'api.authentication.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication', 
     ),
 }
 
+# Token 驗證快取：token -> User 保留 TTL 秒 (0 為停用)，process 內最多 MAX_ENTRIES 筆
+# ALIAS 設為 CACHES 中的名稱時，多個 worker 另外共用該快取
+AUTH_TOKEN_CACHE_TTL = 30
+AUTH_TOKEN_CACHE_MAX_ENTRIES = 1000
+AUTH_TOKEN_CACHE_ALIAS = None
+
 # 2. Allauth 必要設定
 SITE_ID = 1  # 這是 django.contrib.sites 需要的
 
@@ -204,4 +244,155 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
-]
\ No newline at end of file
+    'if-none-match',  # 條件式 GET：前端帶上先前的 ETag (見 api/conditional.py)
+]
+
+# 3. 允許前端讀取的回應 Headers：條件式 GET 需要讀取 ETag，背景工作輪詢需要讀取 Retry-After
+CORS_EXPOSE_HEADERS = ['etag', 'last-modified', 'server-timing', 'retry-after']
+
+# =========================================
+# Chat (AI 對話) 相關設定
+# =========================================
+
+# 狗狗圖片本機磁碟快取：存放目錄、容量上限 (bytes) 與新鮮期 (秒)
+# 新鮮期內直接使用本機檔案；過期後以 ETag / Last-Modified 向來源重新驗證。
+CHAT_IMAGE_CACHE_DIR = BASE_DIR / '.cache' / 'chat_images'
+CHAT_IMAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+CHAT_IMAGE_CACHE_TTL = 60 * 60
+
+# 對外下載 (chat.fetch)：連線逾時 / 讀取逾時 (秒)、單次下載大小上限 (bytes) 與每個主機的連線池大小
+CHAT_FETCH_CONNECT_TIMEOUT = 3.05
+CHAT_FETCH_READ_TIMEOUT = 10
+CHAT_FETCH_MAX_BYTES = 10 * 1024 * 1024
+CHAT_FETCH_POOL_SIZE = 10
+
+# Gemini 模型名稱 (chat.views 與背景工作共用)
+CHAT_GEMINI_MODEL = 'gemini-2.5-flash'
+
+# 替換 Gemini client 的類別路徑 (None 表示使用真正的 genai.Client)
+# 測試或壓測時可設為 'chat.fakes.FakeGenAIClient'，完全不需要連網
+CHAT_GENAI_CLIENT_FACTORY = None
+
+# 是否以原生 async 版本 (AsyncChatView) 提供 /api/chat/ask/
+# 需搭配 ASGI 伺服器 (例如 uvicorn config.asgi:application)；一般的 runserver / WSGI 部署請維持 False
+CHAT_ASYNC_VIEWS = os.environ.get('CHAT_ASYNC_VIEWS', '').lower() in ('1', 'true', 'yes')
+
+# 發問模式：'sync' 在請求中直接呼叫 Gemini；'queue' 改為建立背景工作 (ChatJob) 並回傳 202
+# 即使為 'sync'，用戶端仍可用 `Prefer: respond-async` 標頭要求背景模式
+# 背景工作由 `python manage.py chat_worker --processes N` 執行
+CHAT_ASK_MODE = os.environ.get('CHAT_ASK_MODE', 'sync')
+CHAT_JOB_MAX_ATTEMPTS = 3       # 每筆工作最多嘗試次數
+CHAT_JOB_LEASE_SECONDS = 120    # worker 領取工作後的租約長度 (秒)，逾時未完成會被其他 worker 接手
+CHAT_JOB_MAX_WAIT = 25          # 長輪詢最長等待秒數 (僅 CHAT_ASYNC_VIEWS 的 async 版本支援長輪詢)
+CHAT_JOB_POLL_INTERVAL = 0.5    # 長輪詢時檢查工作狀態的間隔 (秒)
+CHAT_JOB_RETRY_AFTER = 1        # 工作尚未完成時，回應的 Retry-After (秒)，用戶端依此間隔再查詢
+
+# Gemini 呼叫的流量控制 (見 chat/admission.py)
+# 1. 每位使用者的發問限流：每分鐘 RATE 次 (0 為停用)、可累積 BURST 次；
+#    async 版本 (CHAT_ASYNC_VIEWS) 在下一個額度 MAX_DELAY 秒內就會出現時先等待再處理，否則回傳 429；
+#    同步版本不等待，額度用完就回傳 429
+CHAT_ASK_RATE = 10
+CHAT_ASK_BURST = 5
+CHAT_ASK_MAX_DELAY = 3
+# 2. 每個 process 同時進行的 Gemini 呼叫上限，超過時排隊 (最多 MAX_QUEUE 個、QUEUE_TIMEOUT 秒) 否則回傳 503
+#    Gemini 回傳 429 時上限減半並暫停放行 BACKOFF_SECONDS 秒，之後逐步恢復
+CHAT_AI_MAX_CONCURRENCY = 8
+CHAT_AI_MAX_QUEUE = 32
+CHAT_AI_QUEUE_TIMEOUT = 10
+CHAT_AI_BACKOFF_SECONDS = 5
+
+# 對外呼叫的韌性設定 (見 chat/resilience.py)
+# 圖片下載：總嘗試次數、整個下載 (含重試) 的期限 (秒)，以及超過幾秒未完成時送出對沖請求 (None 為停用)
+CHAT_FETCH_ATTEMPTS = 3
+CHAT_FETCH_DEADLINE = 15
+CHAT_FETCH_HEDGE_AFTER = None
+# 各自擁有斷路器與指標標籤的圖片來源主機，其他主機共用一個 (fetch:other)
+CHAT_FETCH_UPSTREAMS = ('dog.ceo', 'images.dog.ceo')
+# Gemini：單次呼叫的逾時、總嘗試次數與整個呼叫 (含重試) 的期限 (秒)
+CHAT_AI_TIMEOUT = 30
+CHAT_AI_ATTEMPTS = 3
+CHAT_AI_DEADLINE = 60
+# 重試間隔：第 n 次重試前隨機等待 0 ~ min(MAX_DELAY, BASE_DELAY * 2^n) 秒
+CHAT_RETRY_BASE_DELAY = 0.2
+CHAT_RETRY_MAX_DELAY = 2
+# 斷路器：同一個上游連續失敗幾次後開啟，開啟後幾秒放行一個試探請求
+CHAT_BREAKER_FAILURE_THRESHOLD = 5
+CHAT_BREAKER_RESET_TIMEOUT = 30
+
+# AI 回覆快取：圖片內容、對話歷史與提問完全相同時直接沿用先前的回覆
+# TTL (秒) 設為 0 即停用；MAX_ENTRIES 為每個 process 保留的最大筆數 (LRU 淘汰)
+CHAT_RESPONSE_CACHE_ENABLED = True
+CHAT_RESPONSE_CACHE_TTL = 24 * 60 * 60
+CHAT_RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# 對話歷史裁切：最近幾輪在 token 預算內原文送出，較早的對話濃縮成 ChatSession.summary
+# 超出預算時一次裁到預算的 KEEP_RATIO，之後數輪不必再摘要
+CHAT_HISTORY_TOKEN_BUDGET = 2000
+CHAT_HISTORY_KEEP_RATIO = 0.5
+CHAT_HISTORY_SUMMARY_MAX_CHARS = 600
+CHAT_HISTORY_SUMMARY_MODEL = None  # None 表示使用 CHAT_GEMINI_MODEL
+
+# 圖片附件：每個 Session 只登記一次圖片，之後的對話以 handle 引用
+# GeminiFileStore 上傳到 Gemini Files API；LocalImageStore 為不連網的替代實作 (沿用本機磁碟快取)
+CHAT_IMAGE_STORE = os.environ.get('CHAT_IMAGE_STORE', 'chat.attachments.GeminiFileStore')
+CHAT_IMAGE_HANDLE_REFRESH_MARGIN = 10 * 60  # 距離到期不足此秒數時重新登記
+CHAT_LOCAL_IMAGE_HANDLE_TTL = 24 * 60 * 60
+
+# 送給 Gemini 之前的圖片正規化 (見 chat/image_normalize.py)：長邊上限 (像素)、輸出格式 (JPEG / WEBP / PNG) 與編碼品質
+# Gemini 以 768x768 為單位切塊計算圖片 token，長邊不超過 768 時整張圖的成本最低
+CHAT_IMAGE_NORMALIZE = True
+CHAT_IMAGE_MAX_DIMENSION = 768
+CHAT_IMAGE_FORMAT = 'JPEG'
+CHAT_IMAGE_QUALITY = 85
+
+# 對話訊息增量同步 (?since= / ?before=)：每頁訊息數與 ?page_size= 的上限
+CHAT_MESSAGES_PAGE_SIZE = 50
+CHAT_MESSAGES_MAX_PAGE_SIZE = 200
+
+# 游標分頁 (收藏列表與對話列表)：預設每頁筆數與 ?page_size= 的上限
+KEYSET_PAGE_SIZE = 20
+KEYSET_MAX_PAGE_SIZE = 100
+
+# 批次收藏 / 批次刪除一次最多處理的筆數
+DOG_BULK_MAX_ITEMS = 500
+
+# 收藏圖片的縮圖代理 (見 api/thumbnails.py)：允許的來源主機、可用的寬度、編碼品質與磁碟快取
+THUMBNAIL_ALLOWED_HOSTS = ['images.dog.ceo']
+THUMBNAIL_WIDTHS = (160, 320, 640)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_CACHE_DIR = BASE_DIR / '.cache' / 'thumbnails'
+THUMBNAIL_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# 刪除帳號 / 刪除全部對話的背景清除 (見 api/purge.py)：每批刪除的列數、批次之間讓出寫入鎖的秒數、
+# 多久沒有進度視為執行的 process 已中止 (可被接手)，以及是否由 web process 的背景執行緒清除
+# (設為 False 時改由 `python manage.py purge_deleted_data` 執行)
+DATA_PURGE_BATCH_SIZE = 500
+DATA_PURGE_BATCH_PAUSE = 0.05
+DATA_PURGE_STALE_SECONDS = 300
+DATA_PURGE_IN_BACKGROUND = True
+
+# 隨機狗狗池 (見 api/random_dogs.py)：來源 API (dog.ceo 格式，測試或壓測時可指向本機替身)、
+# 每個 process 保留的網址數，以及低於多少時在背景補充
+RANDOM_DOG_SOURCE_URL = os.environ.get('RANDOM_DOG_SOURCE_URL', 'https://dog.ceo/api/breeds/image/random/50')
+RANDOM_DOG_POOL_SIZE = 50
+RANDOM_DOG_POOL_LOW_WATER = 20
+# 首頁顯示的縮圖規格 (預先產生，寬度需為 THUMBNAIL_WIDTHS 之一)
+RANDOM_DOG_DISPLAY_WIDTH = 640
+RANDOM_DOG_DISPLAY_FORMAT = 'webp'
+
+# =========================================
+# 效能監測 (見 api/metrics.py)
+# =========================================
+
+# 在回應加上 Server-Timing 標頭 (db / fetch / ai 各階段耗時)
+SERVER_TIMING_ENABLED = True
+
+# /metrics (Prometheus 文字格式)：設定 METRICS_TOKEN 時需帶 Authorization: Bearer <token>，
+# 否則只允許 METRICS_ALLOWED_IPS 中的來源 (預設只有本機)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# 慢請求紀錄：總耗時超過此秒數時以 api.slow_requests logger 記錄各階段耗時 (None 表示停用)
+# SLOW_REQUEST_PROFILE 會讓每個同步請求都在 cProfile 下執行並在慢請求紀錄附上結果，只在排查問題時開啟
+SLOW_REQUEST_THRESHOLD = float(os.environ['SLOW_REQUEST_THRESHOLD']) if os.environ.get('SLOW_REQUEST_THRESHOLD') else None
+SLOW_REQUEST_PROFILE = os.environ.get('SLOW_REQUEST_PROFILE', '').lower() in ('1', 'true', 'yes')
@@ -18,6 +18,8 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
+from api.views import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/',include('api.urls')),  # 將 api.urls 的路由配置包含進來，前綴為 'api/'
@@ -27,6 +29,9 @@ urlpatterns = [
     
     path('api/chat/', include('chat.urls')), # 將 chat.urls 的路由配置包含進來，前綴為 'api/chat/'
 
+    # Prometheus 指標 (請求耗時與各階段的直方圖，見 api/metrics.py)
+    path('metrics', metrics_view, name='metrics'),
+
     # --- 以下為 API 文件路由 ---
     # 1. 生成 OpenAPI Schema (YAML 格式的定義檔)
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
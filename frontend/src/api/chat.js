@@ -1,14 +1,17 @@
-import api from '../utils/api';
+import api, { fetchPage } from '../utils/api';
 
 export const chatApi = {
     /**
-     * 獲取特定圖片的歷史對話紀錄
+     * 獲取特定圖片的歷史對話紀錄 (預設只回傳最新一頁訊息)
+     * 回應中的 has_older 表示還有更早的訊息；reset 為 true 時應以這一頁取代手上的副本
      * @param {string} imageUrl - 狗狗圖片網址
+     * @param {{since?: number, before?: number}} cursor - since: 只取這則訊息之後的新訊息；before: 取這則訊息之前的一頁
      */
-    getHistory(imageUrl) {
-        return api.get('/api/chat/ask/', {
-            params: { image_url: imageUrl }
-        });
+    getHistory(imageUrl, { since = null, before = null } = {}) {
+        const params = { image_url: imageUrl };
+        if (since) params.since = since;
+        if (before) params.before = before;
+        return api.get('/api/chat/ask/', { params });
     },
 
     /**
@@ -23,6 +26,104 @@ export const chatApi = {
         });
     },
 
+    /**
+     * 針對狗狗圖片發送新問題 (串流版，Server-Sent Events)
+     * axios 無法逐段讀取回應內容，因此這裡改用原生 fetch 讀取 ReadableStream。
+     * @param {string} imageUrl - 狗狗圖片網址
+     * @param {string} prompt - 使用者的提問
+     * @param {(text: string) => void} onToken - 每收到一段回覆時呼叫
+     * @returns {Promise<string>} 完整的 AI 回覆
+     */
+    async askQuestionStream(imageUrl, prompt, onToken) {
+        const token = localStorage.getItem('token');
+        const response = await fetch(`${api.defaults.baseURL}/api/chat/ask/stream/`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                Accept: 'text/event-stream',
+                ...(token ? { Authorization: `Token ${token}` } : {}),
+            },
+            body: JSON.stringify({ image_url: imageUrl, prompt }),
+        });
+
+        // 串流開始前的錯誤 (例如 400 / 429 / 502) 仍是一般的 JSON 回應
+        if (!response.ok) {
+            const data = await response.json().catch(() => ({}));
+            const error = new Error(data.error || `HTTP ${response.status}`);
+            error.response = { status: response.status, data };
+            throw error;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let fullText = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            // SSE 以空行分隔每一則事件
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, boundary);
+                buffer = buffer.slice(boundary + 2);
+
+                let event = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event: ')) event = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                }
+                const payload = data ? JSON.parse(data) : {};
+
+                if (event === 'token') {
+                    fullText += payload.text;
+                    onToken(payload.text);
+                } else if (event === 'done') {
+                    return payload.response;
+                } else if (event === 'error') {
+                    const error = new Error(payload.error);
+                    error.response = { status: payload.status, data: payload };
+                    throw error;
+                }
+            }
+        }
+        return fullText;
+    },
+
+    /**
+     * 以背景工作模式發問：後端立即回傳 202 與 job_id，之後再以 waitForJob 取得結果
+     * @param {string} imageUrl - 狗狗圖片網址
+     * @param {string} prompt - 使用者的提問
+     */
+    enqueueQuestion(imageUrl, prompt) {
+        return api.post('/api/chat/ask/', {
+            image_url: imageUrl,
+            prompt: prompt
+        }, {
+            headers: { Prefer: 'respond-async' }
+        });
+    },
+
+    /**
+     * 等待背景工作完成，回傳最終的工作狀態 (status 為 done 或 failed)
+     * async 部署的後端以長輪詢 (long-poll) 等待；同步部署立即回應，依 Retry-After 間隔再查詢
+     * @param {number} jobId - enqueueQuestion 回傳的 job_id
+     * @param {number} wait - 每次輪詢最長等待秒數
+     */
+    async waitForJob(jobId, wait = 20) {
+        while (true) {
+            const response = await api.get(`/api/chat/jobs/${jobId}/`, { params: { wait } });
+            if (response.data.status === 'done' || response.data.status === 'failed') {
+                return response.data;
+            }
+            const retryAfter = Number(response.headers['retry-after']) || 1;
+            await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+        }
+    },
+
     /**
      * 清空特定圖片的對話紀錄
      * @param {string} imageUrl - 狗狗圖片網址
@@ -34,10 +135,12 @@ export const chatApi = {
     },
 
     /**
-     * 獲取所有對話紀錄列表
+     * 獲取對話紀錄列表 (游標分頁)
+     * @param {string|null} cursor 上一頁回傳的 nextCursor，第一頁傳 null
+     * @returns {Promise<{results: Array, nextCursor: string|null}>}
      */
-    getAllSessions() {
-        return api.get('/api/chat/ask/');
+    getAllSessions(cursor = null) {
+        return fetchPage('/api/chat/ask/', cursor);
     },
 
     /**
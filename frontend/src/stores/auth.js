@@ -1,6 +1,7 @@
 // frontend/src/stores/auth.js
 import { defineStore } from 'pinia';
-import api from '../utils/api'; // 引入我們剛剛寫好的那個 api 工具
+import api, { clearConditionalCache } from '../utils/api'; // 引入我們剛剛寫好的那個 api 工具
+import { useChatStore } from './chatStore';
 
 export const useAuthStore = defineStore('auth', {
     // 1. 狀態 (State): 就像是倉庫，存變數的地方
@@ -113,6 +114,10 @@ export const useAuthStore = defineStore('auth', {
             localStorage.removeItem('token');
             localStorage.removeItem('user');
 
+            // 3. 清除對話副本與條件式 GET 記住的資料，避免下一位登入的使用者看到
+            useChatStore().$reset();
+            clearConditionalCache();
+
             // (選用) 如果想要更嚴謹，可以發送請求通知後端銷毀 Token
             // await api.post('/auth/logout/');
         },
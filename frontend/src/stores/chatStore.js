@@ -1,6 +1,24 @@
 import { defineStore } from 'pinia';
 import { chatApi } from '../api/chat';
 
+// 最多保留幾張圖片的對話副本 (超過時移除最早放入的)
+const MAX_CACHED_SESSIONS = 20;
+
+/**
+ * 取得最後一則已存進資料庫 (有 id) 的訊息 id，作為增量同步的游標
+ */
+const lastSyncedId = (messages) => {
+    for (let i = messages.length - 1; i >= 0; i--) {
+        if (messages[i].id) return messages[i].id;
+    }
+    return null;
+};
+
+const fromServer = (messages) => (messages || []).map(msg => ({
+    ...msg,
+    isNew: false // History messages are not new
+}));
+
 export const useChatStore = defineStore('chat', {
     state: () => ({
         isOpen: false,          // 控制右側抽屜是否展開
@@ -8,6 +26,9 @@ export const useChatStore = defineStore('chat', {
         messages: [],           // 當前的對話紀錄陣列
         isLoading: false,       // 控制 AI 思考時的載入狀態
         error: null,            // 錯誤訊息狀態
+        hasOlder: false,        // 是否還有更早的訊息可載入
+        isLoadingOlder: false,  // 控制「載入更早的訊息」的載入狀態
+        cache: {},              // 已讀取過的對話副本：{ [imageUrl]: { messages, hasOlder } }
     }),
 
     actions: {
@@ -18,32 +39,59 @@ export const useChatStore = defineStore('chat', {
         async openDrawer(imageUrl) {
             this.isOpen = true;
             this.currentImageUrl = imageUrl;
+            // 先顯示上次的副本，再向後端補上新訊息
+            const cached = this.cache[imageUrl];
+            this.messages = cached ? cached.messages : [];
+            this.hasOlder = cached ? cached.hasOlder : false;
             await this.fetchHistory(imageUrl);
         },
 
         /**
-         * 關閉抽屜並重置狀態
+         * 關閉抽屜並重置狀態 (對話副本保留在 cache 中，下次打開時只需補上新訊息)
          */
         closeDrawer() {
+            this.saveToCache();
             this.isOpen = false;
             this.currentImageUrl = '';
             this.messages = [];
+            this.hasOlder = false;
             this.error = null;
         },
 
+        /**
+         * 將目前的對話存進副本
+         */
+        saveToCache() {
+            if (!this.currentImageUrl) return;
+            delete this.cache[this.currentImageUrl];
+            this.cache[this.currentImageUrl] = { messages: this.messages, hasOlder: this.hasOlder };
+            const urls = Object.keys(this.cache);
+            if (urls.length > MAX_CACHED_SESSIONS) {
+                delete this.cache[urls[0]];
+            }
+        },
+
         /**
          * 獲取歷史紀錄
+         * 手上已有副本時只以 since 取得新訊息並合併；否則 (或後端回傳 reset) 取得最新一頁
          */
         async fetchHistory(imageUrl) {
             this.isLoading = true;
             this.error = null;
             try {
-                const response = await chatApi.getHistory(imageUrl);
-                // 後端序列化器回傳的資料中包含 messages 陣列
-                this.messages = (response.data.messages || []).map(msg => ({
-                    ...msg,
-                    isNew: false // History messages are not new
-                }));
+                const since = lastSyncedId(this.messages);
+                const response = await chatApi.getHistory(imageUrl, { since });
+                // 等待回應期間使用者可能已切換到其他圖片
+                if (this.currentImageUrl !== imageUrl) return;
+                const data = response.data;
+                if (!since || data.reset) {
+                    this.messages = fromServer(data.messages);
+                    this.hasOlder = data.has_older;
+                } else {
+                    // 本地尚未取得 id 的訊息 (剛送出的提問與回覆) 由後端的正式版本取代
+                    this.messages = [...this.messages.filter(msg => msg.id), ...fromServer(data.messages)];
+                }
+                this.saveToCache();
             } catch (err) {
                 if (err.response && err.response.data && err.response.data.error) {
                     this.error = err.response.data.error;
@@ -56,6 +104,28 @@ export const useChatStore = defineStore('chat', {
             }
         },
 
+        /**
+         * 往回載入更早的一頁訊息 (長對話)
+         */
+        async loadOlder() {
+            const first = this.messages.find(msg => msg.id);
+            if (!this.hasOlder || !first || this.isLoadingOlder) return;
+            const imageUrl = this.currentImageUrl;
+            this.isLoadingOlder = true;
+            try {
+                const response = await chatApi.getHistory(imageUrl, { before: first.id });
+                if (this.currentImageUrl !== imageUrl) return;
+                this.messages = [...fromServer(response.data.messages), ...this.messages];
+                this.hasOlder = response.data.has_older;
+                this.saveToCache();
+            } catch (err) {
+                this.error = '無法載入更早的訊息';
+                console.error('Load older messages error:', err);
+            } finally {
+                this.isLoadingOlder = false;
+            }
+        },
+
         /**
          * 發送訊息給 AI
          * @param {string} prompt - 使用者輸入的問題
@@ -68,12 +138,20 @@ export const useChatStore = defineStore('chat', {
             this.isLoading = true;
             this.error = null;
 
-            try {
-                // 2. 發送 API 請求
-                const response = await chatApi.askQuestion(this.currentImageUrl, prompt);
+            // AI 回覆的訊息物件，收到第一段文字時才放進對話陣列
+            let reply = null;
 
-                // 3. 將 AI 的回覆加入對話陣列中，標記為新訊息以觸發打字機效果
-                this.messages.push({ role: 'model', content: response.data.response, isNew: true });
+            try {
+                // 2. 以串流方式發送 API 請求，之後收到的文字逐段附加到同一則訊息上
+                await chatApi.askQuestionStream(this.currentImageUrl, prompt, (text) => {
+                    if (!reply) {
+                        // 收到第一個 token：結束「思考中」的載入狀態並顯示 AI 訊息
+                        this.messages.push({ role: 'model', content: '', isNew: false, isStreaming: true });
+                        reply = this.messages[this.messages.length - 1];
+                        this.isLoading = false;
+                    }
+                    reply.content += text;
+                });
             } catch (err) {
                 if (err.response && err.response.data && err.response.data.error) {
                     this.error = err.response.data.error;
@@ -83,6 +161,7 @@ export const useChatStore = defineStore('chat', {
                 console.error('Send message error:', err);
                 // 專業做法：若發送失敗，可以選擇在此移除剛才樂觀更新的訊息，或加上錯誤標記
             } finally {
+                if (reply) reply.isStreaming = false;
                 this.isLoading = false;
             }
         },
@@ -96,6 +175,8 @@ export const useChatStore = defineStore('chat', {
             try {
                 await chatApi.clearHistory(this.currentImageUrl);
                 this.messages = []; // 清空前端畫面
+                this.hasOlder = false;
+                delete this.cache[this.currentImageUrl];
             } catch (err) {
                 if (err.response && err.response.data && err.response.data.error) {
                     this.error = err.response.data.error;
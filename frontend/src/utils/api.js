@@ -73,5 +73,112 @@ api.interceptors.response.use(
   }
 );
 
+/**
+ * 條件式 GET (ETag / 304)
+ * 說明：
+ * 後端的收藏列表、對話列表與對話紀錄都會回傳 ETag。這裡記住每個 GET 網址 (含查詢參數) 最近一次的 ETag 與資料，
+ * 下次請求時自動帶上 If-None-Match；資料沒變時後端回傳 304 (沒有內容)，這裡改以記住的資料組成 200 回應，
+ * 呼叫端不需要知道有沒有命中。
+ */
+const MAX_ETAG_ENTRIES = 100;
+const etagCache = new Map(); // 網址 -> { etag, data }
+
+const isGet = (config) => (config.method || 'get').toLowerCase() === 'get';
+
+api.interceptors.request.use((config) => {
+  if (!isGet(config)) return config;
+  const cached = etagCache.get(api.getUri(config));
+  if (cached) {
+    config.headers['If-None-Match'] = cached.etag;
+  }
+  // 304 不是錯誤，交給下面的響應攔截器處理
+  config.validateStatus = (status) => (status >= 200 && status < 300) || status === 304;
+  return config;
+});
+
+api.interceptors.response.use((response) => {
+  if (!isGet(response.config)) return response;
+  const key = api.getUri(response.config);
+
+  if (response.status === 304) {
+    const cached = etagCache.get(key);
+    if (!cached) return response;
+    // 重新放到最後 (最近使用)，並回傳副本，避免呼叫端修改到記住的資料
+    etagCache.delete(key);
+    etagCache.set(key, cached);
+    return { ...response, status: 200, data: structuredClone(cached.data) };
+  }
+
+  const etag = response.headers.etag;
+  if (etag) {
+    etagCache.delete(key);
+    etagCache.set(key, { etag, data: structuredClone(response.data) });
+    if (etagCache.size > MAX_ETAG_ENTRIES) {
+      etagCache.delete(etagCache.keys().next().value);
+    }
+  }
+  return response;
+});
+
+/**
+ * 清除記住的 ETag 與資料 (登出時呼叫，避免下一位使用者沿用)
+ */
+export const clearConditionalCache = () => {
+  etagCache.clear();
+};
+
+/**
+ * 讀取游標分頁的列表 API (收藏列表、對話列表)
+ * 說明：
+ * 後端回傳 { next, results }，next 是下一頁的完整網址，null 代表已經到底。
+ * 這裡只從 next 取出 cursor 參數，再以同一個 api 實體發送請求，
+ * 避免後端在反向代理後方時組出前端無法連線的網址。
+ *
+ * @param {string} url 列表端點，例如 '/api/dogs/'
+ * @param {string|null} cursor 上一頁回傳的 nextCursor，第一頁傳 null
+ * @param {object} params 其他查詢參數 (例如 page_size)
+ * @returns {Promise<{results: Array, nextCursor: string|null}>}
+ */
+export const fetchPage = async (url, cursor = null, params = {}) => {
+  const response = await api.get(url, {
+    params: cursor ? { ...params, cursor } : params,
+  });
+  const { results, next } = response.data;
+  return {
+    results,
+    nextCursor: next ? new URL(next, window.location.origin).searchParams.get('cursor') : null,
+  };
+};
+
+/**
+ * 批次收藏 / 批次刪除收藏
+ * 說明：
+ * 一次請求處理多筆資料 (上限由後端 DOG_BULK_MAX_ITEMS 設定)，整批在同一個交易中完成。
+ * 回傳逐筆結果 results，每筆的 status 為 created / exists / duplicate / invalid 或 deleted / not_found。
+ */
+export const bulkAddFavorites = async (urls) => {
+  const response = await api.post('/api/dogs/bulk/', { urls });
+  return response.data;
+};
+
+export const bulkDeleteFavorites = async (ids) => {
+  const response = await api.post('/api/dogs/bulk-delete/', { ids });
+  return response.data;
+};
+
+/**
+ * 收藏圖片的縮圖 srcset
+ * 說明：
+ * 後端在每筆收藏附上 thumbnail_url (已簽章的縮圖網址前綴)，接上 `<寬度>.<格式>` 即為固定規格的縮圖。
+ * 寬度需與後端的 THUMBNAIL_WIDTHS 一致；沒有 thumbnail_url (來源不支援縮圖) 時回傳 null，改用原圖。
+ */
+export const THUMBNAIL_WIDTHS = [160, 320, 640];
+
+export const thumbnailSrcset = (dog, format) => {
+  if (!dog.thumbnail_url) return null;
+  const base = `${api.defaults.baseURL}${dog.thumbnail_url}`;
+  return THUMBNAIL_WIDTHS.map((width) => `${base}${width}.${format} ${width}w`).join(', ');
+};
+
 // 匯出這個設定好的實體，供其他組件使用
 export default api;
\ No newline at end of file